@@ -3,22 +3,106 @@ Flask Web Application for Pharmacy AI Agent
 Provides web UI for chatting with the agent and viewing tool calls
 """
 
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Flask, render_template, request, jsonify, Response, g
 from flask_cors import CORS
 import json
+import time
+import weakref
 import sys
 import os
 
 # Add src to path
 sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
 
-from agent.pharmacy_agent import PharmacyAgent
+from agent.pharmacy_agent import PharmacyAgent, TurnAborted
+from agent import timing, metrics, tracing
+from server.sessions import SessionStore, SESSION_COOKIE_NAME, SESSION_HEADER_NAME, DEFAULT_IDLE_TTL_SECONDS
+from server.session_db import SqliteSessionBackend
+from server.admission import AdmissionController, Overloaded
+from server import lifecycle
+from server.disconnect import DisconnectWatcher
+from server.singleflight import SingleFlight, request_key, window_for, IDEMPOTENCY_KEY_HEADER, REPLAYED_HEADER
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=[SESSION_HEADER_NAME, REPLAYED_HEADER])
+
+# One agent (and conversation) per customer session
+sessions = SessionStore(
+    agent_factory=PharmacyAgent,
+    # SESSION_DB_PATH set: sessions are shared by all workers and survive restarts
+    backend=SqliteSessionBackend.from_env(idle_ttl=DEFAULT_IDLE_TTL_SECONDS)
+)
+metrics.ACTIVE_SESSIONS.set_function(lambda: len(sessions))
+
+# Bounded concurrency + wait queue for LLM-bound endpoints
+admission = AdmissionController()
+
+# Duplicate /api/chat submissions attach to the turn already running
+chat_flight = SingleFlight()
+
+
+def _requested_session_id():
+    """Session id sent by the client, via header (API clients) or cookie (browser)"""
+    return request.headers.get(SESSION_HEADER_NAME) or request.cookies.get(SESSION_COOKIE_NAME)
+
+
+def _attach_session(response, session):
+    """Send the session id back so the client keeps using the same conversation"""
+    response.set_cookie(
+        SESSION_COOKIE_NAME,
+        session.session_id,
+        max_age=int(sessions.idle_ttl) or None,
+        httponly=True,
+        samesite='Lax'
+    )
+    response.headers[SESSION_HEADER_NAME] = session.session_id
+    return response
+
+
+def _wants_timings(data):
+    """Whether the client asked for the `timings` block (?timings=1 or "timings": true)"""
+    return request.args.get('timings') in ('1', 'true') or bool(data.get('timings'))
+
+
+def _timed_json(payload, timings, include_timings=False):
+    """JSON response with a Server-Timing header (serialization is timed too)"""
+    with timings.measure(timing.SERIALIZE, 'json'):
+        body = json.dumps(payload)
+    if include_timings:
+        payload['timings'] = timings.as_dict()
+        body = json.dumps(payload)
+    response = app.response_class(body, mimetype='application/json')
+    response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+
+def _overloaded_response(error):
+    """429/503 with Retry-After when admission control turns a request away"""
+    response = jsonify({'error': str(error)})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.status_code
+
+@app.before_request
+def start_request_timer():
+    """Remember when the request started, for the latency histogram"""
+    g.request_started = time.perf_counter()
+    # Whatever WSGI server runs us, make sure this process prewarms (no-op once started)
+    lifecycle.start_prewarm(PharmacyAgent)
+
+
+@app.after_request
+def observe_request_latency(response):
+    """Record request latency per endpoint (for streams: time until headers are sent)"""
+    started = g.get('request_started')
+    if started is not None:
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            endpoint=request.endpoint or 'unknown',
+            method=request.method,
+            status=str(response.status_code)
+        )
+    return response
 
-# Initialize the agent
-agent = PharmacyAgent()
 
 @app.route('/')
 def index():
@@ -34,92 +118,122 @@ def chat():
     if not user_message:
         return jsonify({'error': 'No message provided'}), 400
     
+    session = sessions.get_or_create(_requested_session_id())
+    agent = session.agent
+    timings = timing.RequestTimings()
+    # Stop spending LLM rounds and tool calls on a client that has gone away
+    client_gone = DisconnectWatcher.from_environ(request.environ)
+    
+    def run_turn(cancel_check):
+        # Get response from agent (one turn at a time per session)
+        with admission.admit(), timing.activate(timings), session.lock:
+            response = agent.chat(user_message, stream=False, cancel_check=cancel_check)
+            sessions.end_turn(session)
+            # Extract tool calls from conversation history
+            return {'response': response, 'tool_calls': agent.get_last_tool_calls(), 'usage': agent.usage_summary()}
+    
     try:
-        # Get response from agent
-        response = agent.chat(user_message, stream=False)
-        
-        # Extract tool calls from conversation history
-        tool_calls = []
-        if agent.conversation_history:
-            last_assistant_msg = None
-            for msg in reversed(agent.conversation_history):
-                if msg.get('role') == 'assistant' and msg.get('tool_calls'):
-                    last_assistant_msg = msg
-                    break
-            
-            if last_assistant_msg and last_assistant_msg.get('tool_calls'):
-                for tc in last_assistant_msg['tool_calls']:
-                    tool_calls.append({
-                        'name': tc['function']['name'],
-                        'arguments': json.loads(tc['function']['arguments'])
-                    })
+        # A duplicate submission (double-click, client retry) shares the turn in flight
+        key, match = request_key(session.session_id, user_message, request.headers.get(IDEMPOTENCY_KEY_HEADER))
+        payload, replayed = chat_flight.do(
+            key, run_turn, window=window_for(match), cancel_check=client_gone, match=match
+        )
         
-        return jsonify({
-            'response': response,
-            'tool_calls': tool_calls
-        })
+        response = _timed_json(dict(payload), timings, _wants_timings(data))
+        if replayed:
+            response.headers[REPLAYED_HEADER] = 'true'
+        return _attach_session(response, session)
     
+    except Overloaded as e:
+        return _overloaded_response(e)
+    except TurnAborted as e:
+        # Nobody is listening any more; 499 = client closed request (nginx convention)
+        return jsonify({'error': str(e)}), 499
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return _attach_session(jsonify({'error': str(e)}), session), 500
 
 @app.route('/api/reset', methods=['POST'])
 def reset():
-    """Reset the conversation"""
-    agent.reset_conversation()
+    """Reset the conversation for this session"""
+    sessions.reset(_requested_session_id())
     return jsonify({'status': 'success'})
 
 @app.route('/api/stream', methods=['POST'])
 def stream():
-    """Stream chat responses"""
+    """
+    Stream chat responses as server-sent events:
+    content tokens, tool_call_started / tool_result progress, then done
+    """
     data = request.json
     user_message = data.get('message', '')
     
     if not user_message:
         return jsonify({'error': 'No message provided'}), 400
     
+    try:
+        # Admit before responding, so an overloaded server can still answer 429/503
+        ticket = admission.acquire()
+    except Overloaded as e:
+        return _overloaded_response(e)
+    
+    session = sessions.get_or_create(_requested_session_id())
+    agent = session.agent
+    client_gone = DisconnectWatcher.from_environ(request.environ)
+    
     def generate():
         """Generator for streaming response"""
+        session.lock.acquire()
+        # One streaming provider call per round; tool calls run in between
+        turn = agent.stream_turn(user_message, cancel_check=client_gone)
+        ended = False
         try:
-            # Add user message to history
-            agent.conversation_history.append({
-                "role": "user",
-                "content": user_message
-            })
-            
-            # Create messages
-            messages = [
-                {"role": "system", "content": agent.system_prompt}
-            ] + agent.conversation_history
-            
-            # Stream response
-            stream = agent.client.chat.completions.create(
-                model=agent.model,
-                messages=messages,
-                tools=agent.tools.__class__.__dict__.get('TOOL_DEFINITIONS', []),
-                tool_choice="auto",
-                stream=True
-            )
-            
-            full_response = ""
-            
-            for chunk in stream:
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    full_response += content
-                    yield f"data: {json.dumps({'type': 'content', 'data': content})}\n\n"
-            
-            # Add to history
-            agent.conversation_history.append({
-                "role": "assistant",
-                "content": full_response
-            })
-            
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
+            for event in turn:
+                if event['type'] == 'done':
+                    # Saved before the client sees the turn end (its next message may go to another worker)
+                    sessions.end_turn(session)
+                    ended = True
+                yield f"data: {json.dumps(event)}\n\n"
             
+        except TurnAborted:
+            pass
         except Exception as e:
             yield f"data: {json.dumps({'type': 'error', 'data': str(e)})}\n\n"
+        finally:
+            # The server closes this generator when a write fails; abort the turn with it
+            turn.close()
+            if not ended:
+                sessions.end_turn(session)
+            session.lock.release()
+            ticket.release()
     
-    return Response(generate(), mimetype='text/event-stream')
+    body = generate()
+    # Also free the slot if the client goes away before the stream starts
+    weakref.finalize(body, ticket.release)
+    return _attach_session(Response(body, mimetype='text/event-stream'), session)
+
+@app.route('/healthz')
+def healthz():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+def readyz():
+    """Readiness probe: 200 only once the database, provider client and connection are warm"""
+    status = lifecycle.readiness.status()
+    return jsonify(status), (200 if lifecycle.readiness.ready else 503)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text-format metrics for this process"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/debug/traces')
+def debug_traces():
+    """Recent turn traces of this process (AGENT_TRACE=ring only), newest first"""
+    if tracing.TRACE_SINK != 'ring':
+        return jsonify({'error': 'Trace ring buffer disabled (set AGENT_TRACE=ring)'}), 404
+    limit = min(request.args.get('limit', 20, type=int), 200)
+    return jsonify({'traces': tracing.recent_traces(limit)})
 
 if __name__ == '__main__':
     print("="*80)
@@ -129,4 +243,8 @@ if __name__ == '__main__':
     print("Open your browser to: http://localhost:5000 (or http://localhost:5001 if using Docker)")
     print("Press Ctrl+C to stop")
     print("="*80)
-    app.run(host='0.0.0.0', debug=True, port=5000)
+    # Prewarm now rather than on the first request; the reloader (which imports
+    # everything twice) only runs when FLASK_DEBUG=1
+    lifecycle.start_prewarm(PharmacyAgent)
+    debug = os.getenv('FLASK_DEBUG') == '1'
+    app.run(host='0.0.0.0', debug=debug, use_reloader=debug, port=5000)
@@ -0,0 +1,322 @@
+"""
+ASGI Web Application for Pharmacy AI Agent
+Async twin of app.py (same routes and UI) built on Quart and the AsyncOpenAI client.
+A turn waiting on the LLM holds no worker thread, so one process can keep
+hundreds of conversations in flight.
+
+Run with:
+    hypercorn asgi:app --bind 0.0.0.0:5000
+"""
+
+from quart import Quart, render_template, request, jsonify, Response, g, websocket
+import json
+import time
+import weakref
+import sys
+import os
+
+# Add src to path
+sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
+
+from agent.pharmacy_agent import PharmacyAgent
+from agent import timing, metrics, tracing
+from server.sessions import SessionStore, SESSION_COOKIE_NAME, SESSION_HEADER_NAME, DEFAULT_IDLE_TTL_SECONDS
+from server.session_db import SqliteSessionBackend
+from server.admission import AsyncAdmissionController, Overloaded
+from server import lifecycle
+from server.singleflight import AsyncSingleFlight, request_key, window_for, IDEMPOTENCY_KEY_HEADER, REPLAYED_HEADER
+
+app = Quart(__name__)
+
+# One agent (and conversation) per customer session
+sessions = SessionStore(
+    agent_factory=PharmacyAgent,
+    # SESSION_DB_PATH set: sessions are shared by all workers and survive restarts
+    backend=SqliteSessionBackend.from_env(idle_ttl=DEFAULT_IDLE_TTL_SECONDS)
+)
+metrics.ACTIVE_SESSIONS.set_function(lambda: len(sessions))
+
+# Bounded concurrency + wait queue for LLM-bound endpoints
+admission = AsyncAdmissionController()
+
+# Duplicate /api/chat submissions attach to the turn already running
+chat_flight = AsyncSingleFlight()
+
+
+def _requested_session_id():
+    """Session id sent by the client, via header (API clients) or cookie (browser)"""
+    return request.headers.get(SESSION_HEADER_NAME) or request.cookies.get(SESSION_COOKIE_NAME)
+
+
+def _attach_session(response, session):
+    """Send the session id back so the client keeps using the same conversation"""
+    response.set_cookie(
+        SESSION_COOKIE_NAME,
+        session.session_id,
+        max_age=int(sessions.idle_ttl) or None,
+        httponly=True,
+        samesite='Lax'
+    )
+    response.headers[SESSION_HEADER_NAME] = session.session_id
+    return response
+
+
+def _wants_timings(data):
+    """Whether the client asked for the `timings` block (?timings=1 or "timings": true)"""
+    return request.args.get('timings') in ('1', 'true') or bool(data.get('timings'))
+
+
+def _timed_json(payload, timings, include_timings=False):
+    """JSON response with a Server-Timing header (serialization is timed too)"""
+    with timings.measure(timing.SERIALIZE, 'json'):
+        body = json.dumps(payload)
+    if include_timings:
+        payload['timings'] = timings.as_dict()
+        body = json.dumps(payload)
+    response = app.response_class(body, mimetype='application/json')
+    response.headers['Server-Timing'] = timings.server_timing()
+    return response
+
+
+def _overloaded_response(error):
+    """429/503 with Retry-After when admission control turns a request away"""
+    response = jsonify({'error': str(error)})
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, error.status_code
+
+
+@app.before_serving
+async def start_prewarm():
+    """Prewarm in the background; /readyz turns 200 when it is done"""
+    app.add_background_task(lifecycle.aprewarm, PharmacyAgent)
+
+
+@app.before_request
+async def start_request_timer():
+    """Remember when the request started, for the latency histogram"""
+    g.request_started = time.perf_counter()
+
+
+@app.after_request
+async def observe_request_latency(response):
+    """Record request latency per endpoint (for streams: time until headers are sent)"""
+    started = g.get('request_started')
+    if started is not None:
+        metrics.HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            endpoint=request.endpoint or 'unknown',
+            method=request.method,
+            status=str(response.status_code)
+        )
+    return response
+
+
+@app.after_request
+async def add_cors_headers(response):
+    """Same permissive CORS policy app.py gets from flask_cors"""
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = f'Content-Type, {SESSION_HEADER_NAME}, {IDEMPOTENCY_KEY_HEADER}'
+    response.headers['Access-Control-Expose-Headers'] = f'{SESSION_HEADER_NAME}, {REPLAYED_HEADER}'
+    return response
+
+
+@app.route('/')
+async def index():
+    """Serve the main chat interface"""
+    return await render_template('index.html')
+
+@app.route('/api/chat', methods=['POST'])
+async def chat():
+    """Handle chat messages from the user"""
+    data = await request.get_json()
+    user_message = (data or {}).get('message', '')
+
+    if not user_message:
+        return jsonify({'error': 'No message provided'}), 400
+
+    session = sessions.get_or_create(_requested_session_id())
+    agent = session.agent
+    timings = timing.RequestTimings()
+
+    async def run_turn():
+        # Get response from agent (one turn at a time per session)
+        async with admission.admit(), session.async_lock:
+            with timing.activate(timings):
+                response = await agent.achat(user_message)
+            await sessions.aend_turn(session)
+            return {'response': response, 'tool_calls': agent.get_last_tool_calls(), 'usage': agent.usage_summary()}
+
+    try:
+        # A duplicate submission (double-click, client retry) shares the turn in flight
+        key, match = request_key(session.session_id, user_message, request.headers.get(IDEMPOTENCY_KEY_HEADER))
+        payload, replayed = await chat_flight.do(key, run_turn, window=window_for(match), match=match)
+
+        response = _timed_json(dict(payload), timings, _wants_timings(data))
+        if replayed:
+            response.headers[REPLAYED_HEADER] = 'true'
+        return _attach_session(response, session)
+
+    except Overloaded as e:
+        return _overloaded_response(e)
+    except Exception as e:
+        return _attach_session(jsonify({'error': str(e)}), session), 500
+
+@app.route('/api/reset', methods=['POST'])
+async def reset():
+    """Reset the conversation for this session"""
+    session_id = _requested_session_id()
+    session = sessions.get(session_id)
+    if session is not None:
+        async with session.async_lock:
+            session.agent.reset_conversation()
+            sessions.save(session)
+            await sessions.aflush()
+    elif session_id:
+        # Not cached in this process, but it may still be stored
+        sessions.discard(session_id)
+    return jsonify({'status': 'success'})
+
+@app.route('/api/stream', methods=['POST'])
+async def stream():
+    """
+    Stream chat responses as server-sent events:
+    content tokens, tool_call_started / tool_result progress, then done
+    """
+    data = await request.get_json()
+    user_message = (data or {}).get('message', '')
+
+    if not user_message:
+        return jsonify({'error': 'No message provided'}), 400
+
+    try:
+        # Admit before responding, so an overloaded server can still answer 429/503
+        ticket = await admission.acquire()
+    except Overloaded as e:
+        return _overloaded_response(e)
+
+    session = sessions.get_or_create(_requested_session_id())
+    agent = session.agent
+
+    async def generate():
+        """Generator for streaming response"""
+        async with session.async_lock:
+            turn = agent.astream_turn(user_message)
+            ended = False
+            try:
+                async for event in turn:
+                    if event['type'] == 'done':
+                        # Saved before the client sees the turn end (its next message may go to another worker)
+                        await sessions.aend_turn(session)
+                        ended = True
+                    yield f"data: {json.dumps(event)}\n\n"
+            except Exception as e:
+                yield f"data: {json.dumps({'type': 'error', 'data': str(e)})}\n\n"
+            finally:
+                # Closed on client disconnect: abort the turn and its provider stream too
+                await turn.aclose()
+                if not ended:
+                    await sessions.aend_turn(session)
+                ticket.release()
+
+    body = generate()
+    # Also free the slot if the client goes away before the stream starts
+    weakref.finalize(body, ticket.release)
+    return _attach_session(Response(body, mimetype='text/event-stream'), session)
+
+@app.websocket('/ws/chat')
+async def ws_chat():
+    """
+    Chat over one WebSocket per customer. The session is bound to the connection
+    for its whole lifetime; tokens and tool progress are pushed as they happen.
+
+    Client frames: {"type": "message", "message": "..."} or {"type": "reset"}
+    Server frames: {"type": "session", "session_id": ...} on connect, then per turn
+    the /api/stream events (content, tool_call_started, tool_result, done) or error
+    """
+    requested = websocket.args.get('session_id') or websocket.cookies.get(SESSION_COOKIE_NAME)
+    session = sessions.get_or_create(requested)
+    agent = session.agent
+
+    async def send(frame):
+        await websocket.send(json.dumps(frame))
+
+    await send({'type': 'session', 'session_id': session.session_id})
+
+    while True:
+        try:
+            frame = json.loads(await websocket.receive())
+        except (TypeError, ValueError):
+            frame = None
+        if not isinstance(frame, dict):
+            await send({'type': 'error', 'data': 'Frames must be JSON objects'})
+            continue
+        session.touch()
+        kind = frame.get('type', 'message')
+
+        if kind == 'reset':
+            async with session.async_lock:
+                agent.reset_conversation()
+                sessions.save(session)
+                await sessions.aflush()
+            await send({'type': 'reset'})
+            continue
+
+        user_message = frame.get('message', '')
+        if kind != 'message' or not user_message:
+            await send({'type': 'error', 'data': 'No message provided'})
+            continue
+
+        try:
+            async with admission.admit(), session.async_lock:
+                turn = agent.astream_turn(user_message)
+                ended = False
+                try:
+                    async for event in turn:
+                        if event['type'] == 'done':
+                            # Saved before the client sees the turn end
+                            await sessions.aend_turn(session)
+                            ended = True
+                        await send(event)
+                finally:
+                    # Closed on disconnect: abort the turn (and drop its partial history)
+                    # now, before saving, not when the generator is garbage-collected
+                    await turn.aclose()
+                    if not ended:
+                        await sessions.aend_turn(session)
+        except Overloaded as e:
+            await send({'type': 'error', 'data': str(e), 'retry_after': e.retry_after})
+        except Exception as e:
+            await send({'type': 'error', 'data': str(e)})
+
+@app.route('/healthz')
+async def healthz():
+    """Liveness probe: the process is up and serving requests"""
+    return jsonify({'status': 'ok'})
+
+@app.route('/readyz')
+async def readyz():
+    """Readiness probe: 200 only once the database, provider client and connection are warm"""
+    status = lifecycle.readiness.status()
+    return jsonify(status), (200 if lifecycle.readiness.ready else 503)
+
+@app.route('/metrics')
+async def metrics_endpoint():
+    """Prometheus text-format metrics for this process"""
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/debug/traces')
+async def debug_traces():
+    """Recent turn traces of this process (AGENT_TRACE=ring only), newest first"""
+    if tracing.TRACE_SINK != 'ring':
+        return jsonify({'error': 'Trace ring buffer disabled (set AGENT_TRACE=ring)'}), 404
+    limit = min(request.args.get('limit', 20, type=int), 200)
+    return jsonify({'traces': tracing.recent_traces(limit)})
+
+if __name__ == '__main__':
+    print("="*80)
+    print("🏥 PHARMACY AI AGENT - WEB INTERFACE (ASGI)")
+    print("="*80)
+    print("Open your browser to: http://localhost:5000")
+    print("For production run: hypercorn asgi:app --bind 0.0.0.0:5000")
+    print("="*80)
+    app.run(host='0.0.0.0', port=5000)
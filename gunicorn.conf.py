@@ -0,0 +1,47 @@
+"""
+Production server configuration for the Pharmacy AI Agent (Flask app)
+
+    gunicorn -c gunicorn.conf.py app:app
+
+The app is imported once in the master (preload_app), then forked into N workers.
+Conversations live in the shared SQLite session store, so any worker can serve
+any request of any session, and sessions survive restarts.
+"""
+
+import os
+import multiprocessing
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+
+# Agent turns mostly wait on the LLM provider: a few processes, each with threads
+workers = int(os.getenv("WEB_CONCURRENCY", str(min(4, multiprocessing.cpu_count()))))
+worker_class = "gthread"
+threads = int(os.getenv("WORKER_THREADS", "16"))
+
+# Streams and multi-round turns can take a while; don't kill a busy worker
+timeout = int(os.getenv("WORKER_TIMEOUT_SECONDS", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+# Import the app (openai SDK, prompts, tool definitions) once, share it copy-on-write
+preload_app = True
+
+# Without a shared session store, workers would each see different conversations
+os.environ.setdefault("SESSION_DB_PATH", os.path.join(os.getcwd(), "data", "sessions.db"))
+
+accesslog = "-"
+
+
+def post_fork(server, worker):
+    """Each worker prewarms its own provider client and connection right away"""
+    from agent.pharmacy_agent import PharmacyAgent
+    from server import lifecycle
+
+    lifecycle.start_prewarm(PharmacyAgent)
+
+
+def worker_exit(server, worker):
+    """Commit queued session writes before the worker goes away"""
+    import app
+
+    app.sessions.flush()
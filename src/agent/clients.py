@@ -0,0 +1,256 @@
+"""
+Process-wide provider clients for the Pharmacy AI Agent
+Building an OpenAI client costs an SDK import plus an HTTP client with its own
+connection pool and TLS context, so every agent in a process shares one client
+per provider instead of building its own. The openai package is only imported
+when the first client is needed.
+
+Each shared client runs on a tuned HTTP connection pool:
+- Pool size and keep-alive are configurable (LLM_POOL_* below)
+- HTTP/2 is used when the h2 package is installed (one multiplexed connection)
+- Warm-up opens the connections ahead of the first customer request
+- Requests, newly opened connections (i.e. no reuse) and pool saturation
+  (active / idle connections, requests waiting for one) are exported as metrics
+"""
+
+import os
+import asyncio
+import threading
+import importlib.util
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
+
+from agent import metrics
+
+
+# Connection pool tuning, per provider client
+POOL_MAX_CONNECTIONS = int(os.getenv("LLM_POOL_MAX_CONNECTIONS", "100"))
+POOL_MAX_KEEPALIVE = int(os.getenv("LLM_POOL_MAX_KEEPALIVE", "20"))
+# Idle connections are kept this long (providers close theirs after a few minutes)
+POOL_KEEPALIVE_SECONDS = float(os.getenv("LLM_POOL_KEEPALIVE_SECONDS", "90"))
+HTTP2_ENABLED = (os.getenv("LLM_HTTP2", "1").lower() not in ("0", "false", "no")
+                 and importlib.util.find_spec("h2") is not None)
+# Connections opened by warm_up() (one is enough with HTTP/2)
+WARM_CONNECTIONS = int(os.getenv("LLM_POOL_WARM_CONNECTIONS", "4"))
+
+POOL_REQUESTS = metrics.REGISTRY.counter(
+    "pharmacy_http_pool_requests_total",
+    "HTTP requests sent to a provider",
+    ("pool",),
+)
+POOL_CONNECTIONS_OPENED = metrics.REGISTRY.counter(
+    "pharmacy_http_pool_connections_opened_total",
+    "New provider connections (TCP connect, plus TLS handshake for https); requests minus these reused a connection",
+    ("pool",),
+)
+POOL_CONNECTIONS = metrics.REGISTRY.gauge(
+    "pharmacy_http_pool_connections",
+    "Provider connections in the pool by state (active = serving a request)",
+    ("pool", "state"),
+)
+POOL_WAITING = metrics.REGISTRY.gauge(
+    "pharmacy_http_pool_waiting_requests",
+    "Requests waiting for a provider connection (pool saturated)",
+    ("pool",),
+)
+
+_lock = threading.Lock()
+_clients: Dict[Tuple, Any] = {}
+_transports: List[Any] = []
+
+
+def _running_loop_id() -> Optional[int]:
+    """Async clients hold connections bound to an event loop, so they are cached per loop"""
+    try:
+        return id(asyncio.get_running_loop())
+    except RuntimeError:
+        return None
+
+
+def _pool_name(base_url: Optional[str], async_client: bool) -> str:
+    host = urlsplit(base_url).netloc if base_url else urlsplit(
+        os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+    ).netloc
+    return f"{host}/{'async' if async_client else 'sync'}"
+
+
+def _pool_state(transport) -> Dict[str, int]:
+    """Active / idle connections and queued requests of a transport's httpcore pool"""
+    pool = getattr(transport, "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    # httpcore keeps requests in flight here; queued ones have no connection yet
+    requests = list(getattr(pool, "_requests", []))
+    return {
+        "active": len(connections) - idle,
+        "idle": idle,
+        "waiting": sum(1 for request in requests if request.is_queued()),
+    }
+
+
+def _build_http_client(base_url: Optional[str], async_client: bool):
+    """httpx client for one provider on a tuned, instrumented connection pool"""
+    import httpx
+    from openai import DefaultHttpxClient, DefaultAsyncHttpxClient
+
+    pool = _pool_name(base_url, async_client)
+    limits = httpx.Limits(
+        max_connections=POOL_MAX_CONNECTIONS,
+        max_keepalive_connections=POOL_MAX_KEEPALIVE,
+        keepalive_expiry=POOL_KEEPALIVE_SECONDS,
+    )
+
+    def count_connection(event: str):
+        # Fires only when a request had to open a connection (not for reused ones)
+        if event == "connection.connect_tcp.complete":
+            POOL_CONNECTIONS_OPENED.inc(pool=pool)
+
+    if async_client:
+        class ObservedTransport(httpx.AsyncHTTPTransport):
+            async def handle_async_request(self, request):
+                POOL_REQUESTS.inc(pool=pool)
+                request.extensions.setdefault("trace", trace)
+                return await super().handle_async_request(request)
+
+        async def trace(event, info):
+            count_connection(event)
+
+        transport = ObservedTransport(limits=limits, http2=HTTP2_ENABLED)
+        http_client = DefaultAsyncHttpxClient(transport=transport)
+    else:
+        class ObservedTransport(httpx.HTTPTransport):
+            def handle_request(self, request):
+                POOL_REQUESTS.inc(pool=pool)
+                request.extensions.setdefault("trace", trace)
+                return super().handle_request(request)
+
+        def trace(event, info):
+            count_connection(event)
+
+        transport = ObservedTransport(limits=limits, http2=HTTP2_ENABLED)
+        http_client = DefaultHttpxClient(transport=transport)
+
+    transport.pool_name = pool
+    transport.pool_pid = os.getpid()
+    _transports.append(transport)
+    return http_client
+
+
+def get_client(api_key: str, base_url: Optional[str] = None, async_client: bool = False):
+    """
+    Return the shared OpenAI (or AsyncOpenAI) client for a provider, creating it on first use.
+
+    Clients are cached per process (a forked worker builds its own) and, for async
+    clients, per event loop.
+
+    Args:
+        api_key: Provider API key (OpenAI key or HF token)
+        base_url: Provider base URL (None for OpenAI)
+        async_client: Return an AsyncOpenAI client instead of OpenAI
+
+    Returns:
+        The shared client
+    """
+    loop_id = _running_loop_id() if async_client else None
+    key = (os.getpid(), async_client, loop_id, base_url, api_key)
+    client = _clients.get(key)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(key)
+        if client is None:
+            from openai import OpenAI, AsyncOpenAI
+
+            client_class = AsyncOpenAI if async_client else OpenAI
+            client = client_class(
+                api_key=api_key, base_url=base_url,
+                http_client=_build_http_client(base_url, async_client)
+            )
+            _clients[key] = client
+        return client
+
+
+def pool_stats() -> List[Dict[str, Any]]:
+    """Per provider connection pool in this process: settings, reuse and saturation"""
+    stats = []
+    for transport in list(_transports):
+        if transport.pool_pid != os.getpid():
+            continue
+        requests = POOL_REQUESTS.value(pool=transport.pool_name)
+        opened = POOL_CONNECTIONS_OPENED.value(pool=transport.pool_name)
+        stats.append(dict(
+            pool=transport.pool_name,
+            http2=HTTP2_ENABLED,
+            max_connections=POOL_MAX_CONNECTIONS,
+            requests=int(requests),
+            connections_opened=int(opened),
+            reuse_ratio=round(1 - opened / requests, 3) if requests else None,
+            **_pool_state(transport)
+        ))
+    return stats
+
+
+def _connection_gauge():
+    values = {}
+    for stat in pool_stats():
+        values[(stat["pool"], "active")] = values.get((stat["pool"], "active"), 0) + stat["active"]
+        values[(stat["pool"], "idle")] = values.get((stat["pool"], "idle"), 0) + stat["idle"]
+    return values
+
+
+def _waiting_gauge():
+    values = {}
+    for stat in pool_stats():
+        values[(stat["pool"],)] = values.get((stat["pool"],), 0) + stat["waiting"]
+    return values
+
+
+POOL_CONNECTIONS.set_function(_connection_gauge)
+POOL_WAITING.set_function(_waiting_gauge)
+
+
+def _warm_connections(client) -> int:
+    # HTTP/2 (negotiated over TLS only) multiplexes every request over one connection
+    if HTTP2_ENABLED and str(getattr(client, "base_url", "")).startswith("https"):
+        return 1
+    return max(1, WARM_CONNECTIONS)
+
+
+def warm_up(client, timeout: float = 5.0) -> Dict[str, Any]:
+    """
+    Open the HTTP connections (DNS, TCP, TLS) to the provider ahead of the first
+    customer request, using the free model-listing endpoint (several at once, so
+    several pooled connections are ready).
+
+    Returns:
+        {"success": bool, ...} - failures are reported, not raised
+    """
+    def list_models():
+        client.with_options(timeout=timeout, max_retries=0).models.list()
+
+    connections = _warm_connections(client)
+    try:
+        if connections == 1:
+            list_models()
+        else:
+            with ThreadPoolExecutor(max_workers=connections) as pool:
+                for future in [pool.submit(list_models) for _ in range(connections)]:
+                    future.result()
+        return {"success": True, "connections": connections}
+    except Exception as e:
+        return {"success": False, "error": f"{type(e).__name__}: {e}"}
+
+
+async def awarm_up(client, timeout: float = 5.0) -> Dict[str, Any]:
+    """Async version of warm_up() for AsyncOpenAI clients"""
+    connections = _warm_connections(client)
+    try:
+        await asyncio.gather(*(
+            client.with_options(timeout=timeout, max_retries=0).models.list()
+            for _ in range(connections)
+        ))
+        return {"success": True, "connections": connections}
+    except Exception as e:
+        return {"success": False, "error": f"{type(e).__name__}: {e}"}
@@ -0,0 +1,184 @@
+"""
+Token-budgeted history compaction for the Pharmacy AI Agent
+Every provider round resends the whole conversation, old tool results included,
+so a long session gets slower and more expensive with every turn. Before each
+round the history is fitted to a token budget:
+
+- The current turn and the last few turns are sent verbatim
+- Older turns keep their messages, but tool results are collapsed to short summaries
+- If that is still over budget, the oldest turns are dropped
+- Safety facts found by tools anywhere in the conversation (allergies, current
+  medications, prescriptions on file) are pinned in a system note, so compaction
+  never makes the agent forget them
+
+The stored conversation_history is never modified; only what is sent shrinks.
+"""
+
+import os
+import json
+from typing import Any, Dict, List, Tuple
+
+
+HISTORY_TOKEN_BUDGET = int(os.getenv("AGENT_HISTORY_TOKEN_BUDGET", "3000"))
+# Previous turns (besides the current one) always sent in full
+KEEP_RECENT_TURNS = int(os.getenv("AGENT_HISTORY_KEEP_RECENT_TURNS", "2"))
+
+# Fields kept when an old tool result is collapsed (everything else is dropped)
+_SUMMARY_FIELDS = {
+    "get_medication_info": ("name", "generic_name", "active_ingredients", "requires_prescription"),
+    "check_active_ingredients_and_interactions": ("medication", "active_ingredients"),
+    "check_inventory": ("medication", "in_stock", "requires_prescription"),
+    "get_user_allergies": ("user", "allergies", "current_medications"),
+    "check_prescription": ("requires_prescription", "has_prescription"),
+    "refer_to_professional": ("query_type", "referral_needed"),
+}
+_MAX_SUMMARY_VALUE_CHARS = 80
+
+
+def estimate_tokens(message: Dict[str, Any]) -> int:
+    """Rough token count of a message (about 4 characters per token, no tokenizer needed)"""
+    return len(json.dumps(message, ensure_ascii=False)) // 4 + 4
+
+
+def _split_turns(history: List[Dict[str, Any]]) -> List[List[Dict[str, Any]]]:
+    """Group a history into turns, each starting at a user message"""
+    turns = []
+    for message in history:
+        if message.get("role") == "user" or not turns:
+            turns.append([])
+        turns[-1].append(message)
+    return turns
+
+
+def _tool_calls_by_id(history: List[Dict[str, Any]]) -> Dict[str, Tuple[str, Dict[str, Any]]]:
+    """tool_call_id -> (tool name, arguments) for every tool call in the history"""
+    calls = {}
+    for message in history:
+        for tool_call in message.get("tool_calls") or []:
+            try:
+                arguments = json.loads(tool_call["function"]["arguments"] or "{}")
+            except ValueError:
+                arguments = {}
+            calls[tool_call["id"]] = (tool_call["function"]["name"], arguments)
+    return calls
+
+
+def _tool_results(history, calls):
+    """(tool name, arguments, parsed result) for every tool message in the history"""
+    for message in history:
+        if message.get("role") != "tool" or message.get("tool_call_id") not in calls:
+            continue
+        try:
+            result = json.loads(message["content"])
+        except (TypeError, ValueError):
+            continue
+        if isinstance(result, dict):
+            name, arguments = calls[message["tool_call_id"]]
+            yield name, arguments, result
+
+
+def pinned_facts(history: List[Dict[str, Any]], calls=None) -> List[str]:
+    """Safety-relevant facts established by tools in this conversation, oldest first"""
+    calls = _tool_calls_by_id(history) if calls is None else calls
+    facts = []
+    for name, arguments, result in _tool_results(history, calls):
+        if not result.get("success"):
+            continue
+        if name == "get_user_allergies":
+            fact = (f"{result.get('user')}: allergies: {result.get('allergies') or 'none on file'}; "
+                    f"current medications: {result.get('current_medications') or 'none on file'}")
+        elif name == "check_prescription" and result.get("requires_prescription"):
+            patient = arguments.get("user_name", "customer")
+            medication = arguments.get("medication_name", "medication")
+            if result.get("has_prescription"):
+                refills = (result.get("prescription") or {}).get("refills_remaining")
+                fact = f"{patient}: valid prescription on file for {medication} (refills remaining: {refills})"
+            else:
+                fact = f"{patient}: NO prescription on file for {medication}"
+        else:
+            continue
+        if fact not in facts:
+            facts.append(fact)
+    return facts
+
+
+def _summarize(name: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Collapse a tool result to the fields that still matter turns later"""
+    if not result.get("success"):
+        return {"success": False, "error": str(result.get("error", ""))[:_MAX_SUMMARY_VALUE_CHARS]}
+    source = result.get("medication") if name == "get_medication_info" and isinstance(result.get("medication"), dict) else result
+    summary = {"success": True}
+    for field in _SUMMARY_FIELDS.get(name, ()):
+        value = source.get(field)
+        if value is not None:
+            summary[field] = value[:_MAX_SUMMARY_VALUE_CHARS] if isinstance(value, str) else value
+    if len(summary) == 1 and "message" in result:
+        summary["message"] = str(result["message"])[:_MAX_SUMMARY_VALUE_CHARS]
+    summary["summarized"] = True
+    return summary
+
+
+def _collapse_turn(turn, calls):
+    collapsed = []
+    for message in turn:
+        if message.get("role") == "tool" and message.get("tool_call_id") in calls:
+            try:
+                result = json.loads(message["content"])
+            except (TypeError, ValueError):
+                result = None
+            if isinstance(result, dict):
+                name = calls[message["tool_call_id"]][0]
+                message = dict(message, content=json.dumps(_summarize(name, result)))
+        collapsed.append(message)
+    return collapsed
+
+
+def compact(history: List[Dict[str, Any]], budget_tokens: int = HISTORY_TOKEN_BUDGET,
+            keep_recent_turns: int = KEEP_RECENT_TURNS) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    Fit a conversation history to a token budget (see the module docstring).
+
+    Args:
+        history: The full conversation history (not modified)
+        budget_tokens: Target size of the returned messages (0 disables compaction)
+        keep_recent_turns: Previous turns that are always sent verbatim
+
+    Returns:
+        (messages to send after the system prompt, stats) where stats has
+        tokens, collapsed_turns and dropped_turns
+    """
+    sizes = [estimate_tokens(message) for message in history]
+    total = sum(sizes)
+    if budget_tokens <= 0 or total <= budget_tokens:
+        return history, {"tokens": total, "collapsed_turns": 0, "dropped_turns": 0}
+
+    turns = _split_turns(history)
+    split = max(0, len(turns) - keep_recent_turns - 1)
+    older, recent = turns[:split], turns[split:]
+    if not older:
+        return history, {"tokens": total, "collapsed_turns": 0, "dropped_turns": 0}
+
+    calls = _tool_calls_by_id(history)
+    facts = pinned_facts(history, calls)
+    pinned = []
+    if facts:
+        pinned = [{
+            "role": "system",
+            "content": "Facts verified by tools earlier in this conversation (still apply):\n"
+                       + "\n".join(f"- {fact}" for fact in facts)
+        }]
+
+    collapsed = [_collapse_turn(turn, calls) for turn in older]
+    collapsed_sizes = [sum(estimate_tokens(message) for message in turn) for turn in collapsed]
+    total = (sum(estimate_tokens(message) for message in pinned)
+             + sum(collapsed_sizes)
+             + sum(estimate_tokens(message) for turn in recent for message in turn))
+    dropped = 0
+    while dropped < len(collapsed) and total > budget_tokens:
+        total -= collapsed_sizes[dropped]
+        dropped += 1
+
+    messages = list(pinned)
+    for turn in collapsed[dropped:] + recent:
+        messages.extend(turn)
+    return messages, {"tokens": total, "collapsed_turns": len(collapsed) - dropped, "dropped_turns": dropped}
@@ -0,0 +1,127 @@
+"""
+Tool-round loop guard for the Pharmacy AI Agent
+A turn may take several tool rounds before the model answers. A model that stops
+making progress (small models tend to ping-pong between the same lookups) would
+otherwise use up every round and then still need the final tool-less call. The
+guard watches each round and ends the tool loop early, going straight to the
+final answer, when:
+
+- repeated_calls: every call in the round was already made in an earlier round
+- no_new_information: every result in the round was already returned in an earlier round
+- recurring_error: a tool has failed ERROR_LIMIT times in the model's rounds
+- turn_deadline: the turn has run for TURN_DEADLINE_SECONDS
+- round_budget: the model's round budget is used up
+
+Only the model's own rounds count. Calls made for it (prefetch, fast path) are
+not "already made": the safety protocol tells the model to make some of those
+lookups itself, so asking for one again once is expected, not a loop.
+
+So a turn makes at most round_budget(model) + 1 provider calls, and starts no
+new tool round after the deadline.
+"""
+
+import os
+import json
+import time
+from typing import Iterable, Optional, Tuple
+
+
+LOOP_GUARD_ENABLED = os.getenv("AGENT_LOOP_GUARD", "1").lower() not in ("0", "false", "no")
+# Tool rounds for a model not listed in MODEL_ROUND_BUDGETS
+DEFAULT_TOOL_ROUNDS = int(os.getenv("AGENT_MAX_TOOL_ROUNDS", "8"))
+# Tool rounds per model (prefix match, so snapshots and -mini variants are included).
+# The longest legitimate flow is five lookups (allergies, info, interactions,
+# inventory, prescription): models that call tools in parallel need far fewer
+# rounds than ones that call a single tool per response.
+# AGENT_ROUND_BUDGETS (JSON, same shape) adds or overrides.
+MODEL_ROUND_BUDGETS = {
+    "gpt-4o": 4,
+    "gpt-4.1": 4,
+    "meta-llama/Llama-3.2-3B-Instruct": 6,
+}
+MODEL_ROUND_BUDGETS.update({
+    model: int(rounds) for model, rounds in json.loads(os.getenv("AGENT_ROUND_BUDGETS", "{}")).items()
+})
+# Failures of one tool in a turn after which it is not retried
+ERROR_LIMIT = int(os.getenv("AGENT_LOOP_ERROR_LIMIT", "2"))
+# No new tool round starts once a turn has run this long
+TURN_DEADLINE_SECONDS = float(os.getenv("AGENT_TURN_DEADLINE_SECONDS", "30"))
+
+
+def round_budget(model: str) -> int:
+    """Tool rounds allowed per turn for a model (at least 1)"""
+    if model in MODEL_ROUND_BUDGETS:
+        return max(1, MODEL_ROUND_BUDGETS[model])
+    candidates = [known for known in MODEL_ROUND_BUDGETS if model.startswith(known + "-")]
+    rounds = MODEL_ROUND_BUDGETS[max(candidates, key=len)] if candidates else DEFAULT_TOOL_ROUNDS
+    return max(1, rounds)
+
+
+def _error_of(content: str) -> Optional[str]:
+    """The error of a tool message's content, or None if the call succeeded"""
+    try:
+        result = json.loads(content)
+    except ValueError:
+        return None
+    if isinstance(result, dict) and (result.get("success") is False or "error" in result):
+        return str(result.get("error", "failed"))
+    return None
+
+
+class LoopGuard:
+    """Progress of one turn's tool rounds"""
+
+    def __init__(self, budget: int, started: Optional[float] = None, enabled: bool = LOOP_GUARD_ENABLED):
+        """
+        Args:
+            budget: Tool rounds allowed (see round_budget)
+            started: time.perf_counter() at the start of the turn (default: now)
+            enabled: Check for non-progress (the budget applies regardless)
+        """
+        self.budget = budget
+        self.started = time.perf_counter() if started is None else started
+        self.enabled = enabled
+        self.rounds = 0
+        self.stop_reason = None
+        self._calls = set()
+        self._results = set()
+        self._errors = {}
+
+    def observe(self, calls: Iterable[Tuple[str, tuple, str]]) -> Optional[str]:
+        """
+        Record one finished tool round of the model (not prefetched or fast path calls).
+
+        Args:
+            calls: (tool name, call key, tool message content) per call
+
+        Returns:
+            Why the loop should stop now (see the module docstring), or None to continue
+        """
+        calls = list(calls)
+        self.rounds += 1
+        repeated = all(key in self._calls for _, key, _ in calls)
+        seen = all(content in self._results for _, _, content in calls)
+        failing = self._record(calls)
+
+        if self.enabled and repeated:
+            self.stop_reason = "repeated_calls"
+        elif self.enabled and seen:
+            self.stop_reason = "no_new_information"
+        elif self.enabled and failing:
+            self.stop_reason = "recurring_error"
+        elif self.rounds >= self.budget:
+            self.stop_reason = "round_budget"
+        elif self.enabled and time.perf_counter() - self.started >= TURN_DEADLINE_SECONDS:
+            self.stop_reason = "turn_deadline"
+        return self.stop_reason
+
+    def _record(self, calls) -> bool:
+        """Add calls to what the turn has seen; True if a tool reached ERROR_LIMIT failures"""
+        failing = False
+        for tool_name, key, content in calls:
+            self._calls.add(key)
+            self._results.add(content)
+            if _error_of(content) is not None:
+                self._errors[tool_name] = self._errors.get(tool_name, 0) + 1
+                failing = failing or self._errors[tool_name] >= ERROR_LIMIT
+        return failing
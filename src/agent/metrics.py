@@ -0,0 +1,313 @@
+"""
+In-process metrics for the Pharmacy AI Agent
+Minimal thread-safe counters, gauges and histograms rendered in the Prometheus
+text exposition format, so /metrics works without any external service
+"""
+
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+
+# Default latency buckets in seconds (sub-millisecond DB queries up to slow LLM rounds)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(ABC):
+    """Base class: a named metric with a fixed set of label names"""
+
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        lines.extend(self._samples())
+        return lines
+
+    @abstractmethod
+    def _samples(self) -> List[str]:
+        """Sample lines in the exposition format"""
+
+
+class Counter(_Metric):
+    """Monotonically increasing count"""
+
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def _samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """Value that can go up and down, or be read from a callback at scrape time"""
+
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function: Callable[[], Any]):
+        """
+        Read the value from function() at every scrape: a number (unlabelled gauge)
+        or a dict of label-value tuples to numbers (labelled gauge)
+        """
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            value = self._function()
+            if isinstance(value, dict):
+                return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(sample)}"
+                        for key, sample in sorted(value.items())]
+            return [f"{self.name} {_format_value(value)}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """Distribution of observed values over fixed buckets"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets: Iterable[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # key -> [bucket counts..., sum, count]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+                    break
+            state[-2] += value
+            state[-1] += 1
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            return int(state[-1]) if state else 0
+
+    def _samples(self):
+        with self._lock:
+            items = sorted((key, list(state)) for key, state in self._values.items())
+        lines = []
+        for key, state in items:
+            cumulative = 0
+            for i, bound in enumerate(self.buckets):
+                cumulative += state[i]
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {_format_value(cumulative)}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(state[-2])}")
+            lines.append(f"{self.name}_count{labels} {_format_value(state[-1])}")
+        return lines
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered together at /metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                # Module reloads / several apps in one process share the metric
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """All metrics in Prometheus text format (version 0.0.4)"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+# Content-Type for the /metrics response
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Process-wide registry and the agent's metrics
+REGISTRY = MetricsRegistry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "pharmacy_http_request_duration_seconds",
+    "Latency of HTTP requests by endpoint (time to response headers for streams)",
+    ("endpoint", "method", "status"),
+)
+TURN_SECONDS = REGISTRY.histogram(
+    "pharmacy_agent_turn_duration_seconds",
+    "Wall time of a full agent turn, from user message to final reply",
+    ("mode",),
+)
+LLM_ROUNDS_PER_TURN = REGISTRY.histogram(
+    "pharmacy_agent_llm_rounds_per_turn",
+    "Provider calls needed per turn (the model's tool round budget plus one final call at most)",
+    ("mode",),
+    buckets=range(1, 10),
+)
+TOOL_LOOP_STOPS = REGISTRY.counter(
+    "pharmacy_agent_tool_loop_stops_total",
+    "Turns whose tool rounds were ended and sent to the final answer call, by reason (see loop_guard.py)",
+    ("reason", "model"),
+)
+TURNS_ABORTED = REGISTRY.counter(
+    "pharmacy_agent_turns_aborted_total",
+    "Turns abandoned before finishing because the client went away",
+    ("mode",),
+)
+PROMPT_HISTORY_TOKENS = REGISTRY.histogram(
+    "pharmacy_agent_prompt_history_tokens",
+    "Estimated tokens of conversation history sent per provider call, after compaction",
+    buckets=(250, 500, 1000, 2000, 3000, 4000, 6000, 8000, 16000, 32000),
+)
+LLM_REQUEST_SECONDS = REGISTRY.histogram(
+    "pharmacy_llm_request_duration_seconds",
+    "Latency of a single provider chat.completions call",
+    ("provider", "model"),
+)
+LLM_TOKENS = REGISTRY.counter(
+    "pharmacy_llm_tokens_total",
+    "Tokens used by provider calls, by kind (prompt, completion, cached = prompt tokens served from the provider's cache)",
+    ("provider", "model", "kind"),
+)
+PROMPT_COMPONENT_TOKENS = REGISTRY.counter(
+    "pharmacy_llm_prompt_component_tokens_total",
+    "Prompt tokens by component (system, tool_definitions, history, tool_results), estimated split of the reported total",
+    ("model", "component"),
+)
+LLM_COST_USD = REGISTRY.counter(
+    "pharmacy_llm_cost_usd_total",
+    "Estimated provider cost in USD (models with a known price only)",
+    ("provider", "model"),
+)
+TURN_TOKENS = REGISTRY.histogram(
+    "pharmacy_agent_turn_tokens",
+    "Prompt + completion tokens used by a full agent turn",
+    ("mode",),
+    buckets=(0, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000),
+)
+PROVIDER_ERRORS = REGISTRY.counter(
+    "pharmacy_provider_errors_total",
+    "Provider calls that raised, by error type",
+    ("provider", "error"),
+)
+TOOL_CALLS = REGISTRY.counter(
+    "pharmacy_tool_calls_total",
+    "Tool calls executed, by tool and outcome",
+    ("tool", "status"),
+)
+FAST_PATH_TURNS = REGISTRY.counter(
+    "pharmacy_agent_fast_path_turns_total",
+    "Messages matched by the deterministic router, answered from a template or handed to the LLM",
+    ("intent", "language", "outcome"),
+)
+PREFETCHED_TOOL_CALLS = REGISTRY.counter(
+    "pharmacy_agent_prefetched_tool_calls_total",
+    "Tool calls run speculatively from names found in the user message",
+    ("tool",),
+)
+TOOL_SCHEMAS_OMITTED = REGISTRY.counter(
+    "pharmacy_agent_tool_schemas_omitted_total",
+    "Tool definitions left out of a provider call because the conversation can't use them yet (see tool_selection.py)",
+    ("tool",),
+)
+TOOL_MEMO_HITS = REGISTRY.counter(
+    "pharmacy_tool_memo_hits_total",
+    "Repeated tool calls answered from the turn/session memo, by the model that repeated them",
+    ("tool", "model", "scope"),
+)
+TOOL_SECONDS = REGISTRY.histogram(
+    "pharmacy_tool_duration_seconds",
+    "Latency of tool calls",
+    ("tool",),
+)
+DB_QUERY_SECONDS = REGISTRY.histogram(
+    "pharmacy_db_query_duration_seconds",
+    "Latency of sqlite operations made by the tools",
+    ("op",),
+)
+ACTIVE_SESSIONS = REGISTRY.gauge(
+    "pharmacy_active_sessions",
+    "Customer sessions currently held in memory",
+)
@@ -6,7 +6,12 @@ Supports streaming responses in English and Hebrew
 
 import os
 import json
-from openai import OpenAI
+import time
+import asyncio
+import threading
+import contextvars
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, Future
 from dotenv import load_dotenv
 import sys
 
@@ -14,12 +19,70 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from tools.medication_tools import MedicationTools, TOOL_DEFINITIONS
+from agent import timing, metrics, tracing, providers, prefetch, router, compaction, tool_encoding, response_cache, usage, loop_guard, tool_selection
 
 # Load environment variables
 load_dotenv()
 
-# Default Hugging Face model (Llama 3.2 3B; supports one tool call per turn, multi-round loop handles chaining)
-DEFAULT_HF_MODEL = "meta-llama/Llama-3.2-3B-Instruct"
+# Default Hugging Face model (see providers.py)
+DEFAULT_HF_MODEL = providers.DEFAULT_HF_MODEL
+
+# Tool-calling rounds per turn before forcing a final (tool-less) answer, for models
+# without a budget of their own (see loop_guard.py)
+MAX_TOOL_ROUNDS = loop_guard.DEFAULT_TOOL_ROUNDS
+
+# Tool calls returned together in one round run concurrently, on a bounded pool
+TOOL_POOL_SIZE = int(os.getenv("AGENT_TOOL_WORKERS", "8"))
+
+_tool_pool = None
+_tool_pool_pid = None
+_tool_pool_lock = threading.Lock()
+
+
+def _get_tool_pool() -> ThreadPoolExecutor:
+    """The process-wide tool pool (rebuilt in a forked worker, whose pool threads didn't survive)"""
+    global _tool_pool, _tool_pool_pid
+    if _tool_pool_pid != os.getpid():
+        with _tool_pool_lock:
+            if _tool_pool_pid != os.getpid():
+                _tool_pool = ThreadPoolExecutor(max_workers=TOOL_POOL_SIZE, thread_name_prefix="tool")
+                _tool_pool_pid = os.getpid()
+    return _tool_pool
+
+# Tools whose results are reused for the rest of a session (catalog and customer
+# facts); other tools (e.g. check_inventory) are only reused within one turn
+SESSION_MEMO_TOOLS = frozenset({
+    "get_medication_info",
+    "check_active_ingredients_and_interactions",
+    "get_user_allergies",
+    "refer_to_professional",
+})
+
+
+def _memo_key(tool_name: str, arguments: dict) -> tuple:
+    """Memo key for a tool call: lookups are case-insensitive, so string arguments are folded"""
+    normalized = {
+        key: " ".join(value.split()).casefold() if isinstance(value, str) else value
+        for key, value in arguments.items()
+    }
+    return tool_name, json.dumps(normalized, sort_keys=True)
+
+
+def _parse_arguments(arguments: str, invalid=None):
+    """A tool call's arguments as a dict, or invalid if the model sent something else (not a JSON object)"""
+    try:
+        parsed = json.loads(arguments)
+    except ValueError:
+        return invalid
+    return parsed if isinstance(parsed, dict) else invalid
+
+# Export every tool's call counter (at 0) before its first call
+for _tool in TOOL_DEFINITIONS:
+    metrics.TOOL_CALLS.inc(0, tool=_tool["function"]["name"], status="ok")
+
+
+class TurnAborted(Exception):
+    """Raised when a turn is abandoned before it finished (e.g. the client disconnected)"""
 
 
 class PharmacyAgent:
@@ -32,11 +95,12 @@ class PharmacyAgent:
     - Supports OpenAI or Hugging Face (Inference API) via env vars
     """
 
-    def __init__(self, api_key=None, model=None):
+    def __init__(self, api_key=None, model=None, provider=None):
         """
         Initialize the pharmacy agent.
 
-        Provider is chosen by environment:
+        Provider is chosen by environment unless one is passed (see providers.from_env):
+        - If LLM_PROVIDER=scripted: use the offline scripted provider (benchmarks, load tests).
         - If HF_TOKEN is set: use Hugging Face Inference (base_url + HF token).
           Model from HF_MODEL or default meta-llama/Llama-3.2-3B-Instruct.
         - Else: use OpenAI. API key from OPENAI_API_KEY (or api_key arg).
@@ -45,25 +109,31 @@ class PharmacyAgent:
         Args:
             api_key: API key for OpenAI (ignored when using Hugging Face)
             model: Model name (overrides env when provided)
+            provider: A providers.Provider to use instead of the environment's
         """
-        hf_token = os.getenv("HF_TOKEN")
-        if hf_token:
-            self._use_huggingface = True
-            self.client = OpenAI(
-                base_url="https://router.huggingface.co/v1",
-                api_key=hf_token,
-            )
-            self.model = model or os.getenv("HF_MODEL", DEFAULT_HF_MODEL)
-        else:
-            self._use_huggingface = False
-            self.api_key = api_key or os.getenv("OPENAI_API_KEY")
-            if not self.api_key:
-                raise ValueError(
-                    "No API key found. Set OPENAI_API_KEY for OpenAI or HF_TOKEN for Hugging Face in .env"
-                )
-            self.client = OpenAI(api_key=self.api_key)
-            self.model = model or os.getenv("OPENAI_MODEL", "gpt-4o")
+        self.provider = provider or providers.from_env(api_key=api_key, model=model)
+        self.model = self.provider.model
+        # Provider clients are shared process-wide and created on first use
+        self._client = None
+        self._async_client = None
         self.tools = MedicationTools()
+        self.tools.on_query = self._observe_query
+        self.provider_name = self.provider.name
+        self._turn_rounds = 0
+        self._turn_started = time.perf_counter()
+        self._turn_history_start = 0
+        self._loop_guard = loop_guard.LoopGuard(MAX_TOOL_ROUNDS)
+        # Tokens and cost of the current (or last) turn and of the whole session
+        self.turn_usage = usage.Usage(keep_calls=True)
+        self.session_usage = usage.Usage()
+        # Root span of the current turn's trace (see tracing.py)
+        self._turn_span = tracing.NOOP_SPAN
+        # Tool results already computed this turn / this session (see _run_tool)
+        self._turn_memo = {}
+        self._session_memo = {}
+        self._memo_lock = threading.Lock()
+        # Customers, medications and intents the session has mentioned (see tool_selection.py)
+        self._mentions = tool_selection.ConversationMentions()
         
         # System prompt defines the agent's behavior and policies
         self.system_prompt = """You are Duane "the Rock" Reade, a helpful pharmacy assistant AI for a retail pharmacy chain. You have the friendly, confident personality of Dwayne "The Rock" Johnson, but you stay professional and follow strict pharmacy policies.
@@ -127,7 +197,53 @@ Remember: You're an informational assistant with personality, not a healthcare p
         
         # Conversation history
         self.conversation_history = []
+        
+        # Look up the customers/medications named in a message before the first LLM call
+        self.prefetch_enabled = prefetch.PREFETCH_ENABLED
+        # Answer simple stock / prescription questions from check_inventory, without the LLM
+        self.fast_path_enabled = router.FAST_PATH_ENABLED
+        # Approximate tokens of history sent per provider call (see compaction.py)
+        self.history_token_budget = compaction.HISTORY_TOKEN_BUDGET
+        # Tool rounds per turn for this model; the loop guard may stop sooner
+        self.max_tool_rounds = loop_guard.round_budget(self.model)
+        # Offer only the tools the conversation can use so far (False: all of them)
+        self.tool_selection_enabled = tool_selection.TOOL_SELECTION_ENABLED
+        # Shared cache of non-streamed provider responses (None disables it)
+        self.response_cache = response_cache.RESPONSE_CACHE
     
+    @property
+    def client(self):
+        """OpenAI client for chat(), shared by all agents in the process"""
+        if self._client is None:
+            self._client = self.provider.get_client()
+        return self._client
+
+    @client.setter
+    def client(self, value):
+        self._client = value
+
+    @property
+    def async_client(self):
+        """AsyncOpenAI client for achat() (same provider as self.client)"""
+        if self._async_client is None:
+            self._async_client = self.provider.get_async_client()
+        return self._async_client
+
+    @async_client.setter
+    def async_client(self, value):
+        self._async_client = value
+
+    @staticmethod
+    def _observe_query(sql, seconds: float):
+        """MedicationTools.on_query observer: request timings, trace span + DB latency metric"""
+        timing.record_db_query(sql, seconds)
+        metrics.DB_QUERY_SECONDS.observe(seconds, op="execute" if sql else "fetch")
+        if tracing.ENABLED:
+            if sql:
+                tracing.record("db_query", seconds, sql=" ".join(sql.split())[:120])
+            else:
+                tracing.record("db_fetch", seconds)
+
     def _call_tool(self, tool_name: str, arguments: dict) -> dict:
         """
         Execute a tool function call
@@ -139,8 +255,9 @@ Remember: You're an informational assistant with personality, not a healthcare p
         Returns:
             Result from the tool
         """
-        print(f"\n🔧 TOOL CALL: {tool_name}")
-        print(f"   Arguments: {json.dumps(arguments, indent=2)}")
+        if tracing.CONSOLE_ENABLED:
+            tracing.console(f"\n🔧 TOOL CALL: {tool_name}")
+            tracing.console(f"   Arguments: {json.dumps(arguments, indent=2)}")
         
         # Map tool names to methods
         tool_map = {
@@ -153,179 +270,921 @@ Remember: You're an informational assistant with personality, not a healthcare p
         }
         
         if tool_name in tool_map:
-            result = tool_map[tool_name](**arguments)
-            print(f"   ✅ Result: {json.dumps(result, indent=2)[:200]}...")
+            start = time.perf_counter()
+            # The tool's database queries become child spans of this one
+            with tracing.span("tool_call", parent=self._turn_span, tool=tool_name) as tool_span:
+                with timing.measure(timing.TOOL, tool_name):
+                    try:
+                        result = tool_map[tool_name](**arguments)
+                    except TypeError as e:
+                        # Missing or unexpected argument names: the model can correct itself
+                        result = {"success": False, "error": f"Invalid arguments for {tool_name}: {e}"}
+                status = "error" if result.get("success") is False or "error" in result else "ok"
+                tool_span.set(status=status)
+            metrics.TOOL_SECONDS.observe(time.perf_counter() - start, tool=tool_name)
+            metrics.TOOL_CALLS.inc(tool=tool_name, status=status)
+            if tracing.CONSOLE_ENABLED:
+                tracing.console(f"   ✅ Result: {json.dumps(result, indent=2)[:200]}...")
             return result
         else:
+            metrics.TOOL_CALLS.inc(tool=tool_name, status="unknown_tool")
             return {"error": f"Unknown tool: {tool_name}"}
     
-    def chat(self, user_message: str, stream: bool = True) -> str:
+    def _build_messages(self) -> list:
         """
-        Send a message to the agent and get a response.
-        Supports multiple rounds of tool calls so models that return only one
-        tool call per response (e.g. Llama-3.2-3B) can still chain several tools.
+        Messages for the next provider call: system prompt + conversation so far,
+        fitted to the token budget, with tool results in their compact model encoding
+        """
+        history, _ = compaction.compact(self.conversation_history, self.history_token_budget)
+        history = tool_encoding.encode_messages(history)
+        metrics.PROMPT_HISTORY_TOKENS.observe(sum(compaction.estimate_tokens(message) for message in history))
+        return [
+            {"role": "system", "content": self.system_prompt}
+        ] + history
 
-        Args:
-            user_message: The customer's question
-            stream: Whether to stream the response (default: True)
+    def _completion_kwargs(self, messages: list, use_tools: bool = True, stream: bool = False) -> dict:
+        """Arguments for chat.completions.create (shared by the sync and async loops)"""
+        kwargs = {
+            "model": self.model,
+            "messages": messages,
+            "stream": stream
+        }
+        if use_tools:
+            kwargs["tools"] = tool_selection.select(self._mentions, self.tool_selection_enabled)
+            kwargs["tool_choice"] = "auto"
+        if stream:
+            # The last chunk then carries the call's token usage
+            kwargs["stream_options"] = {"include_usage": True}
+        return kwargs
+
+    def _record_usage(self, kwargs: dict, phase: str, reported, completion_text: str = ""):
+        """
+        Add one provider call's token usage (and cost) to the turn and the metrics,
+        priced for the provider that answered it (a fallback's model after a failover)
+        """
+        answered = self.provider.answered_by()
+        self.turn_usage.add_call(usage.record_call(
+            answered.name, answered.model, phase, kwargs, reported, completion_text
+        ))
+
+    @staticmethod
+    def _completion_text(message) -> str:
+        """Reply text plus tool call arguments (to estimate completion tokens when usage is missing)"""
+        text = message.content or ""
+        for tool_call in message.tool_calls or []:
+            text += tool_call.function.name + tool_call.function.arguments
+        return text
+
+    def usage_summary(self) -> dict:
+        """Token usage and cost of the last turn (with each provider call) and of the session so far"""
+        return {"turn": self.turn_usage.as_dict(), "session": self.session_usage.as_dict()}
+
+    def _cache_lookup(self, kwargs: dict):
+        """
+        Check the response cache for a non-streamed call.
 
         Returns:
-            The agent's response
+            (cached response or None, key, inventory version to store with, or None)
         """
-        MAX_TOOL_ROUNDS = 8
+        if self.response_cache is None or kwargs.get("stream"):
+            return None, None, None
+        key, uses_inventory = self.response_cache.key_for(kwargs)
+        version = self.tools.get_inventory_version() if uses_inventory else None
+        cached = self.response_cache.get(key, (lambda: version) if uses_inventory else None)
+        return cached, key, version
 
-        # Add user message to history
+    def _collect_stream(self, kwargs: dict, cancel_check):
+        """
+        Make a non-streamed call as a stream and assemble the response, so a cancelled
+        turn closes the stream (aborting the provider request) instead of waiting
+        for, and paying for, the rest of the completion
+
+        Returns:
+            A response shaped like the SDK's non-streamed one
+        """
+        stream = self.client.chat.completions.create(
+            **dict(kwargs, stream=True, stream_options={"include_usage": True})
+        )
+        content = ""
+        buffers = {}
+        reported_usage = None
+        try:
+            for chunk in stream:
+                self._check_cancelled(cancel_check)
+                if getattr(chunk, "usage", None) is not None:
+                    reported_usage = chunk.usage
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content += delta.content
+                if delta.tool_calls:
+                    self._merge_tool_call_deltas(buffers, delta.tool_calls)
+        except TurnAborted:
+            if hasattr(stream, "close"):
+                stream.close()
+            raise
+        message = SimpleNamespace(
+            role="assistant",
+            content=content or None,
+            tool_calls=self._assemble_tool_calls(buffers) if buffers else None
+        )
+        return SimpleNamespace(
+            choices=[SimpleNamespace(index=0, message=message, finish_reason="tool_calls" if buffers else "stop")],
+            usage=reported_usage
+        )
+
+    def _create_completion(self, kwargs: dict, phase: str, cancel_check=None):
+        """
+        Make one provider call (or answer it from the response cache), recording its timing, latency and errors.
+        With a cancel_check, a non-streamed call is streamed internally (see _collect_stream).
+        """
+        cached, cache_key, inventory_version = self._cache_lookup(kwargs)
+        if cached is not None:
+            self.turn_usage.cache_hits += 1
+            tracing.record("llm_request", 0.0, parent=self._turn_span, phase=phase, cached=True)
+            return cached
+        self._turn_rounds += 1
+        start = time.perf_counter()
+        try:
+            with tracing.span("llm_request", parent=self._turn_span, phase=phase, stream=bool(kwargs.get("stream")),
+                              tools=len(kwargs.get("tools") or ())), \
+                    timing.measure(timing.LLM, phase):
+                if cancel_check is not None and not kwargs.get("stream"):
+                    response = self._collect_stream(kwargs, cancel_check)
+                else:
+                    response = self.client.chat.completions.create(**kwargs)
+            if not kwargs.get("stream"):
+                self._record_usage(kwargs, phase, response.usage, self._completion_text(response.choices[0].message))
+            if cache_key is not None:
+                self.response_cache.put(cache_key, response, inventory_version)
+            return response
+        except TurnAborted:
+            raise
+        except Exception as e:
+            metrics.PROVIDER_ERRORS.inc(provider=self.provider_name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.LLM_REQUEST_SECONDS.observe(
+                time.perf_counter() - start, provider=self.provider_name, model=self.model
+            )
+
+    async def _acreate_completion(self, kwargs: dict, phase: str):
+        """Async version of _create_completion()"""
+        # The inventory version is a sqlite read: keep it off the event loop
+        cached, cache_key, inventory_version = await asyncio.to_thread(self._cache_lookup, kwargs)
+        if cached is not None:
+            self.turn_usage.cache_hits += 1
+            tracing.record("llm_request", 0.0, parent=self._turn_span, phase=phase, cached=True)
+            return cached
+        self._turn_rounds += 1
+        start = time.perf_counter()
+        try:
+            with tracing.span("llm_request", parent=self._turn_span, phase=phase, stream=bool(kwargs.get("stream")),
+                              tools=len(kwargs.get("tools") or ())), \
+                    timing.measure(timing.LLM, phase):
+                response = await self.async_client.chat.completions.create(**kwargs)
+            if not kwargs.get("stream"):
+                self._record_usage(kwargs, phase, response.usage, self._completion_text(response.choices[0].message))
+            if cache_key is not None:
+                self.response_cache.put(cache_key, response, inventory_version)
+            return response
+        except Exception as e:
+            metrics.PROVIDER_ERRORS.inc(provider=self.provider_name, error=type(e).__name__)
+            raise
+        finally:
+            metrics.LLM_REQUEST_SECONDS.observe(
+                time.perf_counter() - start, provider=self.provider_name, model=self.model
+            )
+
+    def _start_turn(self, user_message: str, add_mentions: bool = True) -> list:
+        """
+        Add the user message to history and return the first round's messages.
+
+        Args:
+            user_message: The customer's message
+            add_mentions: Also add its names to the session's mentions (a catalog
+                lookup: the async paths pass False and do it off the event loop)
+        """
+        self._turn_rounds = 0
+        self._turn_started = time.perf_counter()
+        self._turn_history_start = len(self.conversation_history)
+        self._turn_memo = {}
+        self.turn_usage = usage.Usage(keep_calls=True)
+        self._loop_guard = loop_guard.LoopGuard(self.max_tool_rounds, self._turn_started)
+        self._turn_span = tracing.start_trace("turn", provider=self.provider_name, model=self.model)
         self.conversation_history.append({
             "role": "user",
             "content": user_message
         })
+        if add_mentions:
+            self._mentions.add_message(self.tools, user_message)
+        tracing.console(f"\n💬 USER: {user_message}")
+        return self._build_messages()
 
-        messages = [
-            {"role": "system", "content": self.system_prompt}
-        ] + self.conversation_history
+    def _finish_turn(self, content, echo: bool = True, mode: str = "chat") -> str:
+        """Record the final assistant reply in history (and the turn's metrics); return its text"""
+        metrics.LLM_ROUNDS_PER_TURN.observe(self._turn_rounds, mode=mode)
+        metrics.TURN_SECONDS.observe(time.perf_counter() - self._turn_started, mode=mode)
+        metrics.TURN_TOKENS.observe(self.turn_usage.total_tokens, mode=mode)
+        self.session_usage.add(self.turn_usage)
+        response_text = content or ""
+        self.conversation_history.append({
+            "role": "assistant",
+            "content": response_text
+        })
+        turn_usage = self.turn_usage
+        self._turn_span.end(
+            mode=mode, llm_rounds=self._turn_rounds, prompt_tokens=turn_usage.prompt_tokens,
+            completion_tokens=turn_usage.completion_tokens, cached_tokens=turn_usage.cached_tokens
+        )
+        if echo:
+            tracing.console(f"\n🤖 ASSISTANT: {response_text}")
+        if tracing.CONSOLE_ENABLED:
+            tracing.console(f"📊 Tokens: {turn_usage.prompt_tokens} prompt ({turn_usage.cached_tokens} cached), "
+                            f"{turn_usage.completion_tokens} completion in {turn_usage.calls} call(s)")
+        return response_text
+
+    @staticmethod
+    def _check_cancelled(cancel_check):
+        """Raise TurnAborted if the caller asked to abandon the turn"""
+        if cancel_check is not None and cancel_check():
+            raise TurnAborted("Turn cancelled: client disconnected")
+
+    def _abort_turn(self, mode: str):
+        """Drop a cancelled turn's partial history (user message, tool rounds) and count it"""
+        del self.conversation_history[self._turn_history_start:]
+        metrics.TURNS_ABORTED.inc(mode=mode)
+        # Tokens already spent on the abandoned turn still count for the session
+        self.session_usage.add(self.turn_usage)
+        self._turn_span.end(mode=mode, aborted=True, llm_rounds=self._turn_rounds)
+        tracing.console(f"\n⛔ Turn aborted after {self._turn_rounds} LLM round(s)")
+
+    def _run_tool(self, tool_name: str, arguments: dict) -> dict:
+        """
+        _call_tool() with memoization: a repeat of a call made earlier in this turn
+        (or earlier in the session, for SESSION_MEMO_TOOLS) returns the earlier
+        result instead of querying the database again. Identical calls running in
+        parallel share one execution.
+        """
+        key = _memo_key(tool_name, arguments)
+        with self._memo_lock:
+            future, scope = self._turn_memo.get(key), "turn"
+            if future is None and key in self._session_memo:
+                future, scope = self._session_memo[key], "session"
+            owner = future is None
+            if owner:
+                future = self._turn_memo[key] = Future()
+
+        if not owner:
+            metrics.TOOL_MEMO_HITS.inc(tool=tool_name, model=self.model, scope=scope)
+            tracing.record("tool_call", 0.0, parent=self._turn_span, tool=tool_name, memo=scope)
+            tracing.console(f"\n♻️  TOOL CALL (memoized, same {scope}): {tool_name}")
+            return future.result()
+
+        try:
+            result = self._call_tool(tool_name, arguments)
+        except BaseException as e:
+            with self._memo_lock:
+                self._turn_memo.pop(key, None)
+            future.set_exception(e)
+            raise
+        future.set_result(result)
+        if tool_name in SESSION_MEMO_TOOLS and result.get("success") is not False:
+            with self._memo_lock:
+                self._session_memo[key] = future
+        return result
+
+    def _execute_tool_call(self, tool_call) -> dict:
+        """
+        Run one tool call from the model and build its tool message. Arguments that
+        aren't a JSON object become a failed result for the model to correct.
+        """
+        function_name = tool_call.function.name
+        function_args = _parse_arguments(tool_call.function.arguments)
+        if function_args is None:
+            metrics.TOOL_CALLS.inc(tool=function_name, status="invalid_arguments")
+            result = {
+                "success": False,
+                "error": f"Invalid arguments for {function_name}: expected a JSON object, "
+                         f"got {tool_call.function.arguments[:100]!r}"
+            }
+        else:
+            result = self._run_tool(function_name, function_args)
+        return {
+            "role": "tool",
+            "tool_call_id": tool_call.id,
+            "content": json.dumps(result)
+        }
+
+    def _execute_tool_calls(self, tool_calls, cancel_check=None) -> list:
+        """
+        Run one round's tool calls concurrently (they are independent lookups, each
+        on its own sqlite connection), so the round costs about as much as its
+        slowest tool. Results come back in tool_call order.
+        """
+        self._check_cancelled(cancel_check)
+        if len(tool_calls) == 1:
+            return [self._execute_tool_call(tool_calls[0])]
+        pool = _get_tool_pool()
+        # copy_context: request timing follows each tool onto its pool thread
+        futures = [
+            pool.submit(contextvars.copy_context().run, self._execute_tool_call, tool_call)
+            for tool_call in tool_calls
+        ]
+        return [future.result() for future in futures]
 
-        print(f"\n💬 USER: {user_message}")
+    async def _aexecute_tool_calls(self, tool_calls, cancel_check=None) -> list:
+        """Async version of _execute_tool_calls() (same pool, the event loop stays free)"""
+        self._check_cancelled(cancel_check)
+        loop = asyncio.get_running_loop()
+        pool = _get_tool_pool()
+        return list(await asyncio.gather(*(
+            loop.run_in_executor(pool, contextvars.copy_context().run, self._execute_tool_call, tool_call)
+            for tool_call in tool_calls
+        )))
 
-        for _ in range(MAX_TOOL_ROUNDS):
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                tools=TOOL_DEFINITIONS,
-                tool_choice="auto",
-                stream=False
+    def _fast_path(self, user_message: str):
+        """
+        Try the deterministic router (see router.py). When it matches, check_inventory
+        runs as a normal tool round, so the history reads as if the model had called it.
+        Once the session has identified a customer (by name or an allergy lookup),
+        every turn goes to the LLM: availability must follow a safety check.
+
+        Returns:
+            None if the router doesn't apply, else (messages, reply) where reply is
+            None when the tool result can't be templated (continue with the LLM)
+        """
+        if not self.fast_path_enabled:
+            return None
+        if self._mentions.customers or "get_user_allergies" in self._mentions.tools_used:
+            return None
+        route = router.match(self.tools, user_message)
+        if route is None:
+            return None
+        tool_call = SimpleNamespace(
+            id=f"fastpath_{len(self.conversation_history)}",
+            type="function",
+            function=SimpleNamespace(
+                name="check_inventory",
+                arguments=json.dumps({"medication_name": route.medication})
             )
-            assistant_message = response.choices[0].message
-
-            if not assistant_message.tool_calls:
-                # Model is done with tools (content-only response)
-                response_text = assistant_message.content or ""
-                self.conversation_history.append({
-                    "role": "assistant",
-                    "content": response_text
-                })
-                print(f"\n🤖 ASSISTANT: {response_text}")
-                return response_text
-
-            # Execute all tool calls in this round
-            tool_results = []
-            for tool_call in assistant_message.tool_calls:
-                function_name = tool_call.function.name
-                function_args = json.loads(tool_call.function.arguments)
-                result = self._call_tool(function_name, function_args)
-                tool_results.append({
-                    "role": "tool",
-                    "tool_call_id": tool_call.id,
-                    "content": json.dumps(result)
-                })
-
-            self.conversation_history.append({
-                "role": "assistant",
-                "content": assistant_message.content,
-                "tool_calls": [
-                    {
-                        "id": tc.id,
-                        "type": "function",
-                        "function": {
-                            "name": tc.function.name,
-                            "arguments": tc.function.arguments
-                        }
-                    }
-                    for tc in assistant_message.tool_calls
-                ]
-            })
-            self.conversation_history.extend(tool_results)
-            messages = [
-                {"role": "system", "content": self.system_prompt}
-            ] + self.conversation_history
-
-        # Max tool rounds reached; get final natural-language reply (no tools)
-        final_response = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            stream=False
         )
-        final_message = final_response.choices[0].message.content or ""
+        tool_message = self._execute_tool_call(tool_call)
+        messages = self._record_tool_round(SimpleNamespace(content=None, tool_calls=[tool_call]), [tool_message])
+        reply = router.render(route, json.loads(tool_message["content"]))
+        metrics.FAST_PATH_TURNS.inc(intent=route.intent, language=route.language,
+                                    outcome="answered" if reply is not None else "fell_through")
+        return messages, reply
+
+    def _prefetch_tool_calls(self, user_message: str) -> list:
+        """
+        Speculative tool calls for the known names in the message (see prefetch.py),
+        minus lookups this conversation already has. Shaped like the SDK's tool_calls.
+        """
+        if not self.prefetch_enabled:
+            return []
+        already_done = set()
+        for message in self.conversation_history:
+            for tc in message.get("tool_calls") or []:
+                try:
+                    arguments = json.loads(tc["function"]["arguments"])
+                except ValueError:
+                    continue
+                already_done.add((tc["function"]["name"], json.dumps(arguments, sort_keys=True)))
+
+        tool_calls = []
+        for name, arguments in prefetch.plan(self.tools, user_message):
+            if (name, json.dumps(arguments, sort_keys=True)) in already_done:
+                continue
+            tool_calls.append(SimpleNamespace(
+                id=f"prefetch_{len(self.conversation_history)}_{len(tool_calls)}",
+                type="function",
+                function=SimpleNamespace(name=name, arguments=json.dumps(arguments))
+            ))
+            metrics.PREFETCHED_TOOL_CALLS.inc(tool=name)
+        return tool_calls
+
+    def _append_tool_round(self, assistant_message, tool_results: list):
+        """Add an assistant tool-call message and its results to history"""
         self.conversation_history.append({
             "role": "assistant",
-            "content": final_message
+            "content": assistant_message.content,
+            "tool_calls": [
+                {
+                    "id": tc.id,
+                    "type": "function",
+                    "function": {
+                        "name": tc.function.name,
+                        "arguments": tc.function.arguments
+                    }
+                }
+                for tc in assistant_message.tool_calls
+            ]
         })
-        print(f"\n🤖 ASSISTANT: {final_message}")
-        return final_message
+        self.conversation_history.extend(tool_results)
+        self._mentions.tools_used.update(tc.function.name for tc in assistant_message.tool_calls)
+
+    def _record_tool_round(self, assistant_message, tool_results: list) -> list:
+        """Add an assistant tool-call message and its results to history; return the next round's messages"""
+        self._append_tool_round(assistant_message, tool_results)
+        return self._build_messages()
+
+    def _record_prefetched_calls(self, tool_calls: list, tool_results: list) -> list:
+        """
+        Add prefetched calls to history as one assistant/tool message pair per call
+        (the chat template of single-call models such as Llama 3.x rejects an
+        assistant message with several tool calls); return the next round's messages
+        """
+        for tool_call, tool_message in zip(tool_calls, tool_results):
+            self._append_tool_round(SimpleNamespace(content=None, tool_calls=[tool_call]), [tool_message])
+        return self._build_messages()
+
+    @staticmethod
+    def _guard_calls(tool_calls, tool_results: list) -> list:
+        """A round's calls as the loop guard sees them: (tool name, memo key, result content)"""
+        calls = []
+        for tc, tool_message in zip(tool_calls, tool_results):
+            arguments = _parse_arguments(tc.function.arguments)
+            if arguments is None:
+                key = (tc.function.name, tc.function.arguments)
+            else:
+                key = _memo_key(tc.function.name, arguments)
+            calls.append((tc.function.name, key, tool_message["content"]))
+        return calls
+
+    def _tool_loop_should_stop(self, tool_calls, tool_results: list) -> bool:
+        """
+        Pass a finished tool round of the model to the loop guard (see loop_guard.py).
+
+        Returns:
+            True if the next provider call should be the final, tool-less one
+        """
+        reason = self._loop_guard.observe(self._guard_calls(tool_calls, tool_results))
+        if reason is None:
+            return False
+        metrics.TOOL_LOOP_STOPS.inc(reason=reason, model=self.model)
+        self._turn_span.set(stop_reason=reason)
+        tracing.console(f"\n🛑 Tool rounds stopped after {self._loop_guard.rounds}: {reason}")
+        return True
+
+    def chat(self, user_message: str, stream: bool = True, cancel_check=None) -> str:
+        """
+        Send a message to the agent and get a response.
+        Supports multiple rounds of tool calls so models that return only one
+        tool call per response (e.g. Llama-3.2-3B) can still chain several tools.
+
+        Args:
+            user_message: The customer's question
+            stream: Whether to stream the response (default: True)
+            cancel_check: Optional callable returning True once the turn should be
+                abandoned (e.g. the client disconnected); checked before every
+                provider call and tool call, and between the chunks of the provider
+                call in flight (which is then streamed, so it can be closed)
+
+        Returns:
+            The agent's response
+
+        Raises:
+            TurnAborted: cancel_check fired; the turn is removed from history
+        """
+        messages = self._start_turn(user_message)
+
+        try:
+            # Simple catalog questions are answered without the LLM
+            fast = self._fast_path(user_message)
+            if fast is not None:
+                messages, reply = fast
+                if reply is not None:
+                    return self._finish_turn(reply, mode="fast_path")
+
+            # Safety lookups for the names in the message, as an already-completed tool round
+            prefetched = self._prefetch_tool_calls(user_message)
+            if prefetched:
+                tool_results = self._execute_tool_calls(prefetched, cancel_check)
+                messages = self._record_prefetched_calls(prefetched, tool_results)
+
+            for round_index in range(self.max_tool_rounds):
+                self._check_cancelled(cancel_check)
+                response = self._create_completion(
+                    self._completion_kwargs(messages), f"llm_round_{round_index + 1}", cancel_check
+                )
+                assistant_message = response.choices[0].message
+
+                if not assistant_message.tool_calls:
+                    # Model is done with tools (content-only response)
+                    return self._finish_turn(assistant_message.content)
+
+                # Execute all tool calls in this round (concurrently when there are several)
+                tool_results = self._execute_tool_calls(assistant_message.tool_calls, cancel_check)
+                messages = self._record_tool_round(assistant_message, tool_results)
+                if self._tool_loop_should_stop(assistant_message.tool_calls, tool_results):
+                    break
+
+            # Round budget used up or no progress (see loop_guard.py); get final natural-language reply (no tools)
+            self._check_cancelled(cancel_check)
+            final_response = self._create_completion(
+                self._completion_kwargs(messages, use_tools=False), "llm_final", cancel_check
+            )
+            return self._finish_turn(final_response.choices[0].message.content)
+        except TurnAborted:
+            self._abort_turn("chat")
+            raise
+        except Exception as e:
+            self._turn_span.end(e, mode="chat")
+            raise
+
+    async def achat(self, user_message: str, cancel_check=None) -> str:
+        """
+        Async version of chat() for the ASGI app.
+        Provider calls go through the async client, so a waiting turn holds no
+        thread; the sqlite-backed tools run on the tool thread pool.
+        If the task is cancelled (the ASGI server does this when the client
+        disconnects) the in-flight provider request is abandoned with it.
+
+        Args:
+            user_message: The customer's question
+            cancel_check: Same as for chat()
+
+        Returns:
+            The agent's response
+        """
+        messages = self._start_turn(user_message, add_mentions=False)
+
+        try:
+            # Name matching and the fast path may query sqlite: keep them off the event loop
+            await asyncio.to_thread(self._mentions.add_message, self.tools, user_message)
+            fast = await asyncio.to_thread(self._fast_path, user_message)
+            if fast is not None:
+                messages, reply = fast
+                if reply is not None:
+                    return self._finish_turn(reply, mode="fast_path")
+
+            prefetched = await asyncio.to_thread(self._prefetch_tool_calls, user_message)
+            if prefetched:
+                tool_results = await self._aexecute_tool_calls(prefetched, cancel_check)
+                messages = self._record_prefetched_calls(prefetched, tool_results)
+
+            for round_index in range(self.max_tool_rounds):
+                self._check_cancelled(cancel_check)
+                response = await self._acreate_completion(
+                    self._completion_kwargs(messages), f"llm_round_{round_index + 1}"
+                )
+                assistant_message = response.choices[0].message
+
+                if not assistant_message.tool_calls:
+                    return self._finish_turn(assistant_message.content)
+
+                tool_results = await self._aexecute_tool_calls(assistant_message.tool_calls, cancel_check)
+                messages = self._record_tool_round(assistant_message, tool_results)
+                if self._tool_loop_should_stop(assistant_message.tool_calls, tool_results):
+                    break
+
+            self._check_cancelled(cancel_check)
+            final_response = await self._acreate_completion(
+                self._completion_kwargs(messages, use_tools=False), "llm_final"
+            )
+            return self._finish_turn(final_response.choices[0].message.content)
+        except (TurnAborted, asyncio.CancelledError):
+            self._abort_turn("chat")
+            raise
+        except Exception as e:
+            self._turn_span.end(e, mode="chat")
+            raise
+
+    def get_last_tool_calls(self) -> list:
+        """
+        Tool calls from the most recent assistant tool round, for display in the UI
+
+        Returns:
+            List of {"name": ..., "arguments": {...}} dicts
+        """
+        round_calls = []
+        round_prefix = None
+        for msg in reversed(self.conversation_history):
+            if msg.get('role') == 'tool':
+                continue
+            if msg.get('role') != 'assistant' or not msg.get('tool_calls'):
+                if round_calls:
+                    break
+                continue
+            if round_calls and not msg['tool_calls'][0]['id'].startswith(round_prefix or "\0"):
+                break
+            round_calls = msg['tool_calls'] + round_calls
+            # Prefetched calls of one round are stored as one message each (prefetch_<round>_<n>)
+            first_id = msg['tool_calls'][0]['id']
+            if not first_id.startswith('prefetch_'):
+                break
+            round_prefix = first_id.rsplit('_', 1)[0] + '_'
+        return [
+            {
+                'name': tc['function']['name'],
+                'arguments': _parse_arguments(tc['function']['arguments'], tc['function']['arguments'])
+            }
+            for tc in round_calls
+        ]
     
-    def chat_stream(self, user_message: str):
+    @staticmethod
+    def _merge_tool_call_deltas(buffers: dict, delta_tool_calls):
+        """Accumulate streamed tool_call fragments (keyed by index) into buffers"""
+        for delta in delta_tool_calls:
+            buffer = buffers.setdefault(delta.index, {"id": None, "name": "", "arguments": ""})
+            if delta.id:
+                buffer["id"] = delta.id
+            function = getattr(delta, "function", None)
+            if function is not None:
+                if function.name:
+                    buffer["name"] += function.name
+                if function.arguments:
+                    buffer["arguments"] += function.arguments
+
+    @staticmethod
+    def _assemble_tool_calls(buffers: dict) -> list:
+        """Turn accumulated tool_call buffers into tool_call objects shaped like the SDK's"""
+        return [
+            SimpleNamespace(
+                id=buffer["id"] or f"call_{index}",
+                type="function",
+                function=SimpleNamespace(
+                    name=buffer["name"],
+                    arguments=buffer["arguments"] or "{}"
+                )
+            )
+            for index, buffer in sorted(buffers.items())
+        ]
+
+    @staticmethod
+    def _tool_call_started_event(tool_call) -> dict:
+        return {
+            "type": "tool_call_started",
+            "data": {
+                "id": tool_call.id,
+                "name": tool_call.function.name,
+                "arguments": _parse_arguments(tool_call.function.arguments, tool_call.function.arguments)
+            }
+        }
+
+    @staticmethod
+    def _tool_result_event(tool_call, tool_message: dict) -> dict:
+        return {
+            "type": "tool_result",
+            "data": {
+                "id": tool_call.id,
+                "name": tool_call.function.name,
+                "result": json.loads(tool_message["content"])
+            }
+        }
+
+    def stream_turn(self, user_message: str, cancel_check=None):
         """
-        Stream the agent's response token by token
-        
+        Run one full turn with streaming, in a single pass.
+        Each round is one streaming provider call: content tokens are yielded as they
+        arrive, tool calls are rebuilt from the deltas, executed, and the next round
+        streams on from there.
+
+        If cancel_check fires or the consumer closes the generator (the client went
+        away), the open provider stream is closed, no further rounds run, and the
+        partial turn is removed from history.
+
         Args:
             user_message: The customer's question
-            
+            cancel_check: Optional callable returning True once the turn should be abandoned
+
         Yields:
-            Response tokens as they arrive
+            Event dicts: {"type": "content", "data": token},
+            {"type": "tool_call_started", "data": {...}}, {"type": "tool_result", "data": {...}},
+            then {"type": "usage", "data": usage_summary()}
+            and finally {"type": "done", "data": full_response}
         """
-        # Add user message to history
-        self.conversation_history.append({
-            "role": "user",
-            "content": user_message
-        })
-        
-        # Create messages array with system prompt
-        messages = [
-            {"role": "system", "content": self.system_prompt}
-        ] + self.conversation_history
+        messages = self._start_turn(user_message)
+        stream = None
+
+        try:
+            fast = self._fast_path(user_message)
+            if fast is not None:
+                messages, reply = fast
+                if reply is not None:
+                    self._finish_turn(reply, echo=False, mode="fast_path")
+                    stream = False
+                    yield {"type": "content", "data": reply}
+                    yield {"type": "usage", "data": self.usage_summary()}
+                    yield {"type": "done", "data": reply}
+                    return
+
+            prefetched = self._prefetch_tool_calls(user_message)
+            if prefetched:
+                for tool_call in prefetched:
+                    yield self._tool_call_started_event(tool_call)
+                tool_results = self._execute_tool_calls(prefetched, cancel_check)
+                for tool_call, tool_message in zip(prefetched, tool_results):
+                    yield self._tool_result_event(tool_call, tool_message)
+                messages = self._record_prefetched_calls(prefetched, tool_results)
+
+            # After the last tool round (see loop_guard.py) one more, tool-less call gives the answer
+            stop_tools = False
+            for round_index in range(self.max_tool_rounds + 1):
+                self._check_cancelled(cancel_check)
+                use_tools = not stop_tools
+                kwargs = self._completion_kwargs(messages, use_tools=use_tools, stream=True)
+                phase = f"llm_round_{round_index + 1}" if use_tools else "llm_final"
+                stream = self._create_completion(kwargs, phase)
+
+                content = ""
+                buffers = {}
+                reported_usage = None
+                for chunk in stream:
+                    self._check_cancelled(cancel_check)
+                    if getattr(chunk, "usage", None) is not None:
+                        reported_usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content += delta.content
+                        yield {"type": "content", "data": delta.content}
+                    if delta.tool_calls:
+                        self._merge_tool_call_deltas(buffers, delta.tool_calls)
+                stream = None
+                self._record_usage(kwargs, phase, reported_usage, content + "".join(
+                    buffer["name"] + buffer["arguments"] for buffer in buffers.values()
+                ))
+
+                if not buffers or not use_tools:
+                    self._finish_turn(content, echo=False, mode="stream")
+                    stream = False
+                    yield {"type": "usage", "data": self.usage_summary()}
+                    yield {"type": "done", "data": content}
+                    return
+
+                assistant_message = SimpleNamespace(
+                    content=content or None,
+                    tool_calls=self._assemble_tool_calls(buffers)
+                )
+                for tool_call in assistant_message.tool_calls:
+                    yield self._tool_call_started_event(tool_call)
+                tool_results = self._execute_tool_calls(assistant_message.tool_calls, cancel_check)
+                for tool_call, tool_message in zip(assistant_message.tool_calls, tool_results):
+                    yield self._tool_result_event(tool_call, tool_message)
+                messages = self._record_tool_round(assistant_message, tool_results)
+                stop_tools = self._tool_loop_should_stop(assistant_message.tool_calls, tool_results)
+        except (TurnAborted, GeneratorExit):
+            if stream is False:
+                # Closed after the turn was already complete
+                raise
+            if stream is not None and hasattr(stream, "close"):
+                # Closing the response aborts the provider request
+                stream.close()
+            self._abort_turn("stream")
+            raise
+        except Exception as e:
+            self._turn_span.end(e, mode="stream")
+            raise
+
+    async def astream_turn(self, user_message: str, cancel_check=None):
+        """
+        Async version of stream_turn() for the ASGI app.
+        Task cancellation (client disconnect) aborts the turn the same way.
+
+        Args:
+            user_message: The customer's question
+            cancel_check: Optional callable returning True once the turn should be abandoned
+
+        Yields:
+            The same event dicts as stream_turn()
+        """
+        messages = self._start_turn(user_message, add_mentions=False)
+        stream = None
+
+        try:
+            await asyncio.to_thread(self._mentions.add_message, self.tools, user_message)
+            fast = await asyncio.to_thread(self._fast_path, user_message)
+            if fast is not None:
+                messages, reply = fast
+                if reply is not None:
+                    self._finish_turn(reply, echo=False, mode="fast_path")
+                    stream = False
+                    yield {"type": "content", "data": reply}
+                    yield {"type": "usage", "data": self.usage_summary()}
+                    yield {"type": "done", "data": reply}
+                    return
+
+            prefetched = await asyncio.to_thread(self._prefetch_tool_calls, user_message)
+            if prefetched:
+                for tool_call in prefetched:
+                    yield self._tool_call_started_event(tool_call)
+                tool_results = await self._aexecute_tool_calls(prefetched, cancel_check)
+                for tool_call, tool_message in zip(prefetched, tool_results):
+                    yield self._tool_result_event(tool_call, tool_message)
+                messages = self._record_prefetched_calls(prefetched, tool_results)
+
+            # After the last tool round (see loop_guard.py) one more, tool-less call gives the answer
+            stop_tools = False
+            for round_index in range(self.max_tool_rounds + 1):
+                self._check_cancelled(cancel_check)
+                use_tools = not stop_tools
+                kwargs = self._completion_kwargs(messages, use_tools=use_tools, stream=True)
+                phase = f"llm_round_{round_index + 1}" if use_tools else "llm_final"
+                stream = await self._acreate_completion(kwargs, phase)
+
+                content = ""
+                buffers = {}
+                reported_usage = None
+                async for chunk in stream:
+                    self._check_cancelled(cancel_check)
+                    if getattr(chunk, "usage", None) is not None:
+                        reported_usage = chunk.usage
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        content += delta.content
+                        yield {"type": "content", "data": delta.content}
+                    if delta.tool_calls:
+                        self._merge_tool_call_deltas(buffers, delta.tool_calls)
+                stream = None
+                self._record_usage(kwargs, phase, reported_usage, content + "".join(
+                    buffer["name"] + buffer["arguments"] for buffer in buffers.values()
+                ))
+
+                if not buffers or not use_tools:
+                    self._finish_turn(content, echo=False, mode="stream")
+                    stream = False
+                    yield {"type": "usage", "data": self.usage_summary()}
+                    yield {"type": "done", "data": content}
+                    return
+
+                assistant_message = SimpleNamespace(
+                    content=content or None,
+                    tool_calls=self._assemble_tool_calls(buffers)
+                )
+                for tool_call in assistant_message.tool_calls:
+                    yield self._tool_call_started_event(tool_call)
+                tool_results = await self._aexecute_tool_calls(assistant_message.tool_calls, cancel_check)
+                for tool_call, tool_message in zip(assistant_message.tool_calls, tool_results):
+                    yield self._tool_result_event(tool_call, tool_message)
+                messages = self._record_tool_round(assistant_message, tool_results)
+                stop_tools = self._tool_loop_should_stop(assistant_message.tool_calls, tool_results)
+        except (TurnAborted, GeneratorExit, asyncio.CancelledError):
+            if stream is False:
+                raise
+            if stream is not None and hasattr(stream, "close"):
+                try:
+                    await stream.close()
+                except Exception:
+                    pass
+            self._abort_turn("stream")
+            raise
+        except Exception as e:
+            self._turn_span.end(e, mode="stream")
+            raise
+
+    def chat_stream(self, user_message: str) -> str:
+        """
+        Stream the agent's response token by token to stdout (interactive mode)
         
-        print(f"\n💬 USER: {user_message}")
+        Args:
+            user_message: The customer's question
+            
+        Returns:
+            The agent's full response
+        """
         print("🤖 ASSISTANT: ", end="", flush=True)
-        
-        # Make streaming API call
-        stream = self.client.chat.completions.create(
-            model=self.model,
-            messages=messages,
-            tools=TOOL_DEFINITIONS,
-            tool_choice="auto",
-            stream=True
-        )
-        
-        # Collect the response
         full_response = ""
-        tool_calls_buffer = []
-        
-        for chunk in stream:
-            delta = chunk.choices[0].delta
-            
-            # Handle text content
-            if delta.content:
-                print(delta.content, end="", flush=True)
-                full_response += delta.content
-            
-            # Handle tool calls
-            if delta.tool_calls:
-                tool_calls_buffer.extend(delta.tool_calls)
-        
+        for event in self.stream_turn(user_message):
+            if event["type"] == "content":
+                print(event["data"], end="", flush=True)
+            elif event["type"] == "tool_call_started":
+                print(f"\n[Calling {event['data']['name']}...]")
+            elif event["type"] == "done":
+                full_response = event["data"]
         print()  # New line after streaming
-        
-        # If there were tool calls, process them
-        if tool_calls_buffer:
-            print("\n[Processing tool calls...]")
-            # For simplicity in streaming, we'll use the non-streaming approach for tool execution
-            # In a production app, you'd want to stream this too
-            return self.chat(user_message, stream=False)
-        
-        # Add response to history
-        self.conversation_history.append({
-            "role": "assistant",
-            "content": full_response
-        })
-        
         return full_response
     
+    def restore_history(self, history: list):
+        """
+        Continue a saved conversation (e.g. a session loaded by another worker):
+        take its history and rebuild what is derived from it
+
+        Args:
+            history: The conversation history to continue
+        """
+        self.conversation_history = history
+        self._mentions = tool_selection.ConversationMentions.from_history(self.tools, history)
+
     def reset_conversation(self):
         """Clear the conversation history"""
         self.conversation_history = []
-        print("🔄 Conversation history cleared")
+        self._turn_memo = {}
+        self._session_memo = {}
+        self._mentions = tool_selection.ConversationMentions()
+        self.turn_usage = usage.Usage(keep_calls=True)
+        self.session_usage = usage.Usage()
+        tracing.console("🔄 Conversation history cleared")
 
 
 def test_agent():
     """Test the pharmacy agent with various scenarios"""
+    tracing.enable_console()
     print("="*80)
     print("🏥 PHARMACY AI AGENT - TEST SCENARIOS")
     print("="*80)
@@ -379,6 +1238,7 @@ def test_agent():
 
 def interactive_mode():
     """Run the agent in interactive mode for testing"""
+    tracing.enable_console()
     print("="*80)
     print("🏥 PHARMACY AI AGENT - INTERACTIVE MODE")
     print("="*80)
@@ -412,12 +1272,181 @@ def interactive_mode():
             print(f"\n❌ Error: {str(e)}")
 
 
+def test_loop_guard():
+    """
+    Offline scenarios (scripted provider) for the loop guard together with prefetch:
+    a model that repeats a prefetched lookup once keeps going, one that ping-pongs stops,
+    and tool calls with bad arguments come back as errors the model can correct
+    """
+    print("="*80)
+    print("🛑 PHARMACY AI AGENT - LOOP GUARD SCENARIOS (scripted provider)")
+    print("="*80)
+    message = "I'm Jalen Brunson, can I get Aspirin?"
+
+    def run(script, stream=False):
+        provider = providers.ScriptedProvider(script=script)
+        agent = PharmacyAgent(provider=provider)
+        agent.response_cache = None
+        agent.fast_path_enabled = False
+        agent.prefetch_enabled = True
+        if stream:
+            for _ in agent.stream_turn(message):
+                pass
+        else:
+            agent.chat(message)
+        tools_run = [
+            tc["function"]["name"]
+            for msg in agent.conversation_history for tc in msg.get("tool_calls") or []
+        ]
+        return provider.calls, agent._loop_guard.stop_reason, tools_run
+
+    # Test 1: the safety protocol makes the model ask for the prefetched allergy lookup again
+    calls, stop_reason, tools_run = run([
+        [{"name": "get_user_allergies", "arguments": {"user_name": "Jalen Brunson"}}],
+        [{"name": "check_inventory", "arguments": {"medication_name": "Aspirin"}}],
+        "Aspirin is in stock.",
+    ])
+    print(f"TEST 1: repeat of a prefetched lookup -> {calls} provider calls, stop: {stop_reason}")
+    assert calls == 3 and stop_reason is None and "check_inventory" in tools_run, tools_run
+
+    # Test 2: the model keeps asking for the same lookup
+    same_call = [{"name": "get_user_allergies", "arguments": {"user_name": "Jalen Brunson"}}]
+    calls, stop_reason, _ = run([same_call, same_call, same_call, same_call, "Done."])
+    print(f"TEST 2: ping-pong on one lookup -> {calls} provider calls, stop: {stop_reason}")
+    assert calls == 3 and stop_reason == "repeated_calls"
+
+    # Test 3: malformed arguments, then a corrected call
+    for stream in (False, True):
+        calls, stop_reason, tools_run = run([
+            [{"name": "check_inventory", "arguments": '{"medication_name": "Aspirin"'}],
+            [{"name": "check_inventory", "arguments": {"medication_name": "Aspirin"}}],
+            "Aspirin is in stock.",
+        ], stream)
+        print(f"TEST 3: malformed arguments, then corrected (stream={stream}) -> {calls} provider calls, stop: {stop_reason}")
+        assert calls == 3 and stop_reason is None and tools_run.count("check_inventory") == 2
+
+    # Test 4: the model keeps sending bad arguments (malformed, then an unknown argument name)
+    calls, stop_reason, _ = run([
+        [{"name": "check_inventory", "arguments": "medication_name=Aspirin"}],
+        [{"name": "check_inventory", "arguments": {"medication": "Aspirin"}}],
+        "Sorry, I couldn't check the stock.",
+    ])
+    print(f"TEST 4: bad arguments twice -> {calls} provider calls, stop: {stop_reason}")
+    assert calls == 3 and stop_reason == "recurring_error"
+
+    print("\n✅ ALL LOOP GUARD SCENARIOS PASSED!")
+
+
+def test_fast_path():
+    """
+    Offline scenarios (scripted provider) for the fast path: a stock question is
+    answered from the template, unless the session has identified a customer
+    """
+    print("="*80)
+    print("⚡ PHARMACY AI AGENT - FAST PATH SCENARIOS (scripted provider)")
+    print("="*80)
+
+    def new_agent(script):
+        provider = providers.ScriptedProvider(script=script)
+        agent = PharmacyAgent(provider=provider)
+        agent.response_cache = None
+        agent.fast_path_enabled = True
+        return provider, agent
+
+    # Test 1: an anonymous stock question is answered without the LLM
+    provider, agent = new_agent([])
+    agent.chat("Do you have Amoxicillin in stock?")
+    print(f"TEST 1: anonymous stock question -> {provider.calls} provider calls")
+    assert provider.calls == 0
+
+    # Test 2: the same question after the customer (penicillin allergy) introduced themselves
+    provider, agent = new_agent([
+        "Hey Jalen, what can I get you?",
+        [{"name": "get_user_allergies", "arguments": {"user_name": "Jalen Brunson"}}],
+        "Careful: you are allergic to penicillin, and Amoxicillin is a penicillin antibiotic.",
+    ])
+    agent.prefetch_enabled = False
+    agent.chat("Hi, I'm Jalen Brunson.")
+    calls_before = provider.calls
+    agent.chat("Do you have Amoxicillin in stock?")
+    print(f"TEST 2: stock question after an introduction -> {provider.calls - calls_before} provider calls")
+    assert provider.calls - calls_before == 2, provider.calls
+
+    print("\n✅ ALL FAST PATH SCENARIOS PASSED!")
+
+
+BENCHMARK_MESSAGES = [
+    "What is Aspirin used for?",
+    "I'm Jalen Brunson, can I get Amoxicillin?",
+    "Does Ibuprofen interact with Warfarin?",
+    "Tell me about Metformin side effects",
+]
+
+
+def benchmark_mode(turns: int = 200, concurrency: int = 8):
+    """
+    Benchmark the full agent loop offline against the scripted provider.
+    Every turn runs tool rounds against the real database; the provider answers
+    instantly (or after SCRIPTED_LATENCY_SECONDS), so the numbers are the agent's
+    own per-turn overhead. Response cache and fast path are off so every turn does
+    the full work.
+    """
+    import contextlib
+    from concurrent.futures import ThreadPoolExecutor as BenchmarkPool
+
+    provider = providers.ScriptedProvider.from_env()
+    local = threading.local()
+
+    def run(index):
+        agent = getattr(local, "agent", None)
+        if agent is None:
+            agent = local.agent = PharmacyAgent(provider=provider)
+            agent.response_cache = None
+            agent.fast_path_enabled = False
+        agent.reset_conversation()
+        message = BENCHMARK_MESSAGES[index % len(BENCHMARK_MESSAGES)]
+        start = time.perf_counter()
+        if index % 2:
+            for _ in agent.stream_turn(message):
+                pass
+        else:
+            agent.chat(message)
+        return time.perf_counter() - start
+
+    print("="*80)
+    print(f"⏱️  PHARMACY AI AGENT - BENCHMARK ({turns} turns, concurrency {concurrency}, scripted provider)")
+    print("="*80)
+    started = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        with BenchmarkPool(max_workers=concurrency) as pool:
+            durations = sorted(pool.map(run, range(turns)))
+    elapsed = time.perf_counter() - started
+
+    def percentile(q):
+        return durations[min(len(durations) - 1, int(q * len(durations)))] * 1000
+
+    print(f"Turns/s:  {turns / elapsed:.1f}")
+    print(f"p50:      {percentile(0.50):.2f} ms")
+    print(f"p95:      {percentile(0.95):.2f} ms")
+    print(f"p99:      {percentile(0.99):.2f} ms")
+    print(f"Provider calls: {provider.calls}")
+
+
 if __name__ == "__main__":
     import sys
     
     if len(sys.argv) > 1 and sys.argv[1] == "interactive":
         # Run in interactive mode
         interactive_mode()
+    elif len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        # Offline benchmark: python pharmacy_agent.py benchmark [turns] [concurrency]
+        benchmark_mode(*(int(arg) for arg in sys.argv[2:4]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "test-loop-guard":
+        # Offline loop guard + prefetch scenarios
+        test_loop_guard()
+    elif len(sys.argv) > 1 and sys.argv[1] == "test-fast-path":
+        # Offline fast path scenarios
+        test_fast_path()
     else:
         # Run automated tests
         test_agent()
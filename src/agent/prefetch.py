@@ -0,0 +1,115 @@
+"""
+Speculative tool prefetch for the Pharmacy AI Agent
+The safety protocol makes the model look up a customer's allergies and the
+medication's info whenever both are named. Models that make one tool call per
+response (e.g. Llama-3.2-3B) spend a provider round on each lookup. Instead,
+before the first provider call, the message is scanned for known customer and
+medication names, and those lookups run up front as one already-completed tool
+round.
+"""
+
+import os
+import re
+import time
+import threading
+from typing import Dict, List, Optional, Tuple
+
+
+PREFETCH_ENABLED = os.getenv("AGENT_PREFETCH", "1").lower() not in ("0", "false", "no")
+# How long the list of known names is reused before it is reloaded from the database
+INDEX_TTL_SECONDS = float(os.getenv("AGENT_PREFETCH_INDEX_TTL_SECONDS", "300"))
+# Upper bound on speculative lookups per message (a pasted list shouldn't fan out)
+MAX_PREFETCH_CALLS = 4
+
+
+class EntityIndex:
+    """Customer and medication names from the database, matched as whole words"""
+
+    def __init__(self, customers: List[str], medications: List[Dict[str, Optional[str]]]):
+        self.customers = {name.lower(): name for name in customers if name}
+        # Brand and generic names both map to the catalog (brand) name
+        self.medications = {}
+        # Catalog names of the medications that need a prescription
+        self.prescription_only = {
+            medication["name"] for medication in medications if medication.get("requires_prescription")
+        }
+        for medication in medications:
+            for alias in (medication.get("generic_name"), medication["name"]):
+                if alias:
+                    self.medications[alias.lower()] = medication["name"]
+        self._customer_pattern = self._compile(self.customers)
+        self._medication_pattern = self._compile(self.medications)
+        self.loaded_at = time.monotonic()
+
+    @staticmethod
+    def _compile(names) -> Optional[re.Pattern]:
+        if not names:
+            return None
+        # Longest first, so "Tylenol PM" wins over "Tylenol"
+        alternatives = "|".join(re.escape(name) for name in sorted(names, key=len, reverse=True))
+        return re.compile(rf"(?<!\w)(?:{alternatives})(?!\w)", re.IGNORECASE)
+
+    @staticmethod
+    def _find(pattern: Optional[re.Pattern], names: Dict[str, str], text: str) -> List[str]:
+        if pattern is None:
+            return []
+        found = []
+        for match in pattern.finditer(text):
+            name = names[match.group(0).lower()]
+            if name not in found:
+                found.append(name)
+        return found
+
+    def remove_medications(self, text: str) -> str:
+        """text with the catalog medication names in it blanked out"""
+        if self._medication_pattern is None:
+            return text
+        return self._medication_pattern.sub(" ", text)
+
+    def find(self, text: str) -> Tuple[List[str], List[str]]:
+        """
+        Known names mentioned in text.
+
+        Returns:
+            (customer names, medication names) in order of appearance
+        """
+        return (
+            self._find(self._customer_pattern, self.customers, text),
+            self._find(self._medication_pattern, self.medications, text),
+        )
+
+
+_indexes: Dict[str, EntityIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+def get_index(tools) -> Optional[EntityIndex]:
+    """The (cached) EntityIndex for a MedicationTools' database, or None if it can't be loaded"""
+    index = _indexes.get(tools.db_path)
+    if index is not None and time.monotonic() - index.loaded_at < INDEX_TTL_SECONDS:
+        return index
+    with _indexes_lock:
+        index = _indexes.get(tools.db_path)
+        if index is not None and time.monotonic() - index.loaded_at < INDEX_TTL_SECONDS:
+            return index
+        names = tools.get_known_names()
+        if not names.get("success"):
+            return index
+        index = _indexes[tools.db_path] = EntityIndex(names["customers"], names["medications"])
+        return index
+
+
+def plan(tools, user_message: str) -> List[Tuple[str, Dict[str, str]]]:
+    """
+    The lookups the safety protocol will ask for, given the names in user_message.
+
+    Returns:
+        [(tool_name, arguments), ...] - allergies first, then medication info
+    """
+    index = get_index(tools)
+    if index is None:
+        return []
+    customers, medications = index.find(user_message)
+    calls = [("get_user_allergies", {"user_name": name}) for name in customers]
+    calls += [("get_medication_info", {"medication_name": name}) for name in medications]
+    return calls[:MAX_PREFETCH_CALLS]
@@ -0,0 +1,378 @@
+"""
+LLM providers for the Pharmacy AI Agent
+A provider supplies the OpenAI-compatible clients the agent talks to:
+- OpenAI and Hugging Face (Inference router) through the openai SDK
+- A scripted, in-process fake that returns predefined tool calls and content,
+  streams chunks and can simulate latency and errors, so the whole agent loop
+  (message building, tool dispatch, database access) can be benchmarked and
+  load-tested with no network
+
+The provider is chosen by environment (see from_env) or passed to PharmacyAgent.
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import itertools
+import threading
+from abc import ABC, abstractmethod
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from agent import clients
+
+
+HF_BASE_URL = "https://router.huggingface.co/v1"
+# Default Hugging Face model (Llama 3.2 3B; supports one tool call per turn, multi-round loop handles chaining)
+DEFAULT_HF_MODEL = "meta-llama/Llama-3.2-3B-Instruct"
+DEFAULT_OPENAI_MODEL = "gpt-4o"
+
+
+class Provider(ABC):
+    """Interface: a named model endpoint with sync and async OpenAI-compatible clients"""
+
+    name = "provider"
+
+    def __init__(self, model: str):
+        self.model = model
+
+    @abstractmethod
+    def get_client(self):
+        """Client with chat.completions.create() (OpenAI SDK shape)"""
+
+    @abstractmethod
+    def get_async_client(self):
+        """Async client with an awaitable chat.completions.create()"""
+
+    def answered_by(self) -> "Provider":
+        """The provider that answered the last call made in this context (a wrapper: the one it used)"""
+        return self
+
+
+class OpenAICompatibleProvider(Provider):
+    """OpenAI or any endpoint speaking its API (e.g. Hugging Face); clients are shared process-wide"""
+
+    def __init__(self, name: str, model: str, api_key: str, base_url: Optional[str] = None):
+        super().__init__(model)
+        self.name = name
+        self.api_key = api_key
+        self.base_url = base_url
+
+    def get_client(self):
+        return clients.get_client(api_key=self.api_key, base_url=self.base_url)
+
+    def get_async_client(self):
+        return clients.get_client(api_key=self.api_key, base_url=self.base_url, async_client=True)
+
+
+class ScriptedProviderError(Exception):
+    """Simulated provider failure raised by ScriptedProvider"""
+
+
+# A script step: reply text, a list of tool calls ({"name": ..., "arguments": {...}},
+# or arguments as a raw string, e.g. malformed JSON), or an exception to raise
+Step = Union[str, List[Dict[str, Any]], BaseException]
+
+
+def default_responder(messages: List[Dict[str, Any]]) -> Step:
+    """
+    Deterministic stand-in for a model: each turn gets one round of typical
+    safety calls (medication info + inventory), then a short reply.
+    """
+    turn_start = max((i for i, message in enumerate(messages) if message.get("role") == "user"), default=0)
+    turn = messages[turn_start:]
+    called_tools = any(
+        tool_call["id"].startswith("call_scripted_")
+        for message in turn for tool_call in message.get("tool_calls") or []
+    )
+    if called_tools:
+        results = sum(1 for message in turn if message.get("role") == "tool")
+        return f"Scripted reply based on {results} tool results. Please consult our pharmacist with any questions."
+    return [
+        {"name": "get_medication_info", "arguments": {"medication_name": "Aspirin"}},
+        {"name": "check_inventory", "arguments": {"medication_name": "Aspirin"}},
+    ]
+
+
+class ScriptedProvider(Provider):
+    """
+    In-process fake provider. Each provider call takes the next step of the
+    script; once the script runs out (or without one), responder(messages)
+    decides. Responses and stream chunks have the same shape as the openai SDK's.
+    """
+
+    name = "scripted"
+
+    def __init__(
+        self,
+        script: Optional[List[Step]] = None,
+        responder: Callable[[List[Dict[str, Any]]], Step] = default_responder,
+        latency: float = 0.0,
+        chunk_latency: float = 0.0,
+        error_rate: float = 0.0,
+        chunk_size: int = 16,
+        seed: int = 0,
+        model: str = "scripted",
+    ):
+        """
+        Args:
+            script: Steps returned in order (see Step)
+            responder: Decides the step once the script is exhausted
+            latency: Seconds before each response (or first chunk) arrives
+            chunk_latency: Seconds between stream chunks
+            error_rate: Probability that a call raises ScriptedProviderError
+            chunk_size: Characters of content per stream chunk
+            seed: Seed for the error simulation (runs are reproducible)
+            model: Model name reported in metrics
+        """
+        super().__init__(model)
+        self.script = list(script or [])
+        self.responder = responder
+        self.latency = latency
+        self.chunk_latency = chunk_latency
+        self.error_rate = error_rate
+        self.chunk_size = chunk_size
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._client = self._make_client()
+        self._async_client = self._make_client(async_client=True)
+
+    @classmethod
+    def from_env(cls) -> "ScriptedProvider":
+        """Configured by SCRIPTED_LATENCY_SECONDS, SCRIPTED_CHUNK_LATENCY_SECONDS, SCRIPTED_ERROR_RATE"""
+        return cls(
+            latency=float(os.getenv("SCRIPTED_LATENCY_SECONDS", "0")),
+            chunk_latency=float(os.getenv("SCRIPTED_CHUNK_LATENCY_SECONDS", "0")),
+            error_rate=float(os.getenv("SCRIPTED_ERROR_RATE", "0")),
+        )
+
+    def get_client(self):
+        return self._client
+
+    def get_async_client(self):
+        return self._async_client
+
+    def _make_client(self, async_client: bool = False, timeout: Optional[float] = None):
+        """Client shaped like the SDK's; with_options(timeout=...) makes slower calls time out"""
+        create = self._acreate if async_client else self._create
+
+        def create_with_timeout(**kwargs):
+            return create(_timeout=timeout, **kwargs)
+
+        return SimpleNamespace(
+            chat=SimpleNamespace(completions=SimpleNamespace(create=create_with_timeout)),
+            models=SimpleNamespace(list=self._alist_models if async_client else (lambda: [])),
+            with_options=lambda timeout=timeout, **options: self._make_client(async_client, timeout)
+        )
+
+    # Scripting
+
+    def _next_step(self, messages) -> Step:
+        with self._lock:
+            self.calls += 1
+            if self.error_rate and self._random.random() < self.error_rate:
+                return ScriptedProviderError("Simulated provider error")
+            if self.script:
+                return self.script.pop(0)
+        return self.responder(messages)
+
+    def _message(self, step: Step, use_tools: bool):
+        if isinstance(step, BaseException):
+            raise step
+        if isinstance(step, str) or not use_tools:
+            content = step if isinstance(step, str) else "Scripted reply."
+            return SimpleNamespace(role="assistant", content=content, tool_calls=None)
+        tool_calls = [
+            SimpleNamespace(
+                id=f"call_scripted_{next(self._ids)}",
+                type="function",
+                function=SimpleNamespace(name=call["name"], arguments=(
+                    call["arguments"] if isinstance(call.get("arguments"), str) else json.dumps(call.get("arguments", {}))
+                ))
+            )
+            for call in step
+        ]
+        return SimpleNamespace(role="assistant", content=None, tool_calls=tool_calls)
+
+    @staticmethod
+    def _usage(kwargs, message):
+        """Token counts estimated at ~4 characters per token"""
+        prompt = len(json.dumps([kwargs["messages"], kwargs.get("tools")], ensure_ascii=False)) // 4
+        completion = len(message.content or "") // 4 + sum(
+            len(tool_call.function.arguments) // 4 + 8 for tool_call in message.tool_calls or []
+        )
+        return SimpleNamespace(
+            prompt_tokens=prompt,
+            completion_tokens=completion,
+            total_tokens=prompt + completion,
+            prompt_tokens_details=SimpleNamespace(cached_tokens=0)
+        )
+
+    def _response(self, kwargs):
+        messages = kwargs["messages"]
+        message = self._message(self._next_step(messages), bool(kwargs.get("tools")))
+        return SimpleNamespace(
+            id=f"chatcmpl-scripted-{next(self._ids)}",
+            model=self.model,
+            choices=[SimpleNamespace(
+                index=0,
+                message=message,
+                finish_reason="tool_calls" if message.tool_calls else "stop"
+            )],
+            usage=self._usage(kwargs, message)
+        )
+
+    def _chunks(self, response):
+        """Split a response into stream chunks (content pieces, then tool call deltas, then usage)"""
+        message = response.choices[0].message
+
+        def chunk(delta, finish_reason=None, usage=None):
+            return SimpleNamespace(
+                id=response.id, model=self.model, usage=usage,
+                choices=[SimpleNamespace(index=0, delta=delta, finish_reason=finish_reason)]
+            )
+
+        content = message.content or ""
+        for start in range(0, len(content), self.chunk_size):
+            yield chunk(SimpleNamespace(content=content[start:start + self.chunk_size], tool_calls=None))
+        for index, tool_call in enumerate(message.tool_calls or []):
+            arguments = tool_call.function.arguments
+            half = len(arguments) // 2
+            yield chunk(SimpleNamespace(content=None, tool_calls=[SimpleNamespace(
+                index=index, id=tool_call.id, type="function",
+                function=SimpleNamespace(name=tool_call.function.name, arguments=arguments[:half])
+            )]))
+            yield chunk(SimpleNamespace(content=None, tool_calls=[SimpleNamespace(
+                index=index, id=None, type=None,
+                function=SimpleNamespace(name=None, arguments=arguments[half:])
+            )]))
+        yield chunk(SimpleNamespace(content=None, tool_calls=None), response.choices[0].finish_reason)
+        # Final usage-only chunk, as with stream_options={"include_usage": True}
+        yield SimpleNamespace(id=response.id, model=self.model, choices=[], usage=response.usage)
+
+    # OpenAI SDK surface
+
+    @staticmethod
+    async def _alist_models():
+        return []
+
+    def _create(self, _timeout=None, **kwargs):
+        if _timeout is not None and self.latency > _timeout:
+            time.sleep(_timeout)
+            raise TimeoutError(f"Scripted provider: no answer within {_timeout}s")
+        if self.latency:
+            time.sleep(self.latency)
+        response = self._response(kwargs)
+        if not kwargs.get("stream"):
+            return response
+        return _ScriptedStream(self._chunks(response), self.chunk_latency)
+
+    async def _acreate(self, _timeout=None, **kwargs):
+        if _timeout is not None and self.latency > _timeout:
+            await asyncio.sleep(_timeout)
+            raise TimeoutError(f"Scripted provider: no answer within {_timeout}s")
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        response = self._response(kwargs)
+        if not kwargs.get("stream"):
+            return response
+        return _AsyncScriptedStream(self._chunks(response), self.chunk_latency)
+
+
+class _ScriptedStream:
+    """Iterable stream with close(), like the SDK's Stream"""
+
+    def __init__(self, chunks, chunk_latency: float):
+        self._chunks = chunks
+        self._chunk_latency = chunk_latency
+
+    def __iter__(self):
+        for chunk in self._chunks:
+            if self._chunk_latency:
+                time.sleep(self._chunk_latency)
+            yield chunk
+
+    def close(self):
+        self._chunks.close()
+
+
+class _AsyncScriptedStream:
+    """Async iterable stream with an awaitable close(), like the SDK's AsyncStream"""
+
+    def __init__(self, chunks, chunk_latency: float):
+        self._chunks = chunks
+        self._chunk_latency = chunk_latency
+
+    async def __aiter__(self):
+        for chunk in self._chunks:
+            if self._chunk_latency:
+                await asyncio.sleep(self._chunk_latency)
+            yield chunk
+
+    async def close(self):
+        self._chunks.close()
+
+
+def _openai_provider(api_key: Optional[str], model: Optional[str]) -> Optional[Provider]:
+    api_key = api_key or os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        return None
+    # base_url None lets the SDK honor OPENAI_BASE_URL (e.g. a local stub server)
+    return OpenAICompatibleProvider("openai", model or os.getenv("OPENAI_MODEL", DEFAULT_OPENAI_MODEL), api_key)
+
+
+def _huggingface_provider(model: Optional[str]) -> Optional[Provider]:
+    hf_token = os.getenv("HF_TOKEN")
+    if not hf_token:
+        return None
+    return OpenAICompatibleProvider(
+        "huggingface", model or os.getenv("HF_MODEL", DEFAULT_HF_MODEL), hf_token,
+        os.getenv("HF_BASE_URL", HF_BASE_URL)
+    )
+
+
+def from_env(api_key: Optional[str] = None, model: Optional[str] = None) -> Provider:
+    """
+    The provider selected by the environment:
+    - LLM_PROVIDER=scripted: ScriptedProvider (no network, no key)
+    - HF_TOKEN set: Hugging Face Inference, model from HF_MODEL
+    - otherwise OpenAI, key from OPENAI_API_KEY (or api_key), model from OPENAI_MODEL
+
+    When both HF_TOKEN and OPENAI_API_KEY are set, the other one becomes the
+    fallback provider (LLM_PRIMARY=openai|huggingface picks the preferred one,
+    LLM_FAILOVER=0 disables the fallback). Unless LLM_RESILIENCE=0, the
+    providers are wrapped in resilience.ResilientProvider (deadlines, retries,
+    hedging, failover).
+
+    Raises:
+        ValueError: No credentials for a real provider
+    """
+    # Imported here: resilience builds on this module's Provider
+    from agent import resilience
+
+    if os.getenv("LLM_PROVIDER", "").lower() == "scripted":
+        backends = [ScriptedProvider.from_env()]
+    else:
+        primary = os.getenv("LLM_PRIMARY", "huggingface" if os.getenv("HF_TOKEN") else "openai").lower()
+        order = ["huggingface", "openai"] if primary == "huggingface" else ["openai", "huggingface"]
+        if os.getenv("LLM_FAILOVER", "1").lower() in ("0", "false", "no"):
+            order = order[:1]
+        builders = {
+            "openai": lambda model: _openai_provider(api_key, model),
+            "huggingface": _huggingface_provider,
+        }
+        # The model argument applies to the preferred provider only
+        backends = [builders[name](model if index == 0 else None) for index, name in enumerate(order)]
+        backends = [backend for backend in backends if backend is not None]
+        if not backends:
+            raise ValueError(
+                "No API key found. Set OPENAI_API_KEY for OpenAI or HF_TOKEN for Hugging Face in .env"
+            )
+
+    if not resilience.RESILIENCE_ENABLED:
+        return backends[0]
+    return resilience.ResilientProvider(backends)
@@ -0,0 +1,495 @@
+"""
+Provider resilience layer for the Pharmacy AI Agent
+Wraps one or more providers (e.g. OpenAI, then Hugging Face as a fallback) behind
+the same client interface, so one slow or failing provider call can't stall a turn:
+
+- Deadlines: every attempt has a wall-clock timeout, every call an overall deadline
+- Retries: retryable errors (timeouts, connection errors, 408/409/429/5xx) are
+  retried with jittered exponential backoff (honoring Retry-After)
+- Hedging (optional): if an attempt hasn't answered within the provider's
+  observed p95 latency, a second identical request is sent and whichever
+  answers first is used
+- Circuit breakers: a provider that keeps failing is skipped for a while, and
+  calls fail over to the next provider; one trial call then checks if it is back
+
+Breakers and latency statistics are shared by every agent in the process.
+After a failover, answered_by() tells the caller which provider (and model) answered.
+Streams are protected until the provider starts answering; an error in the
+middle of a stream is not retried (tokens were already sent to the client).
+"""
+
+import os
+import time
+import random
+import asyncio
+import threading
+import contextvars
+from collections import deque
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List, Optional
+
+from agent import metrics, tracing
+from agent.providers import Provider
+
+
+RESILIENCE_ENABLED = os.getenv("LLM_RESILIENCE", "1").lower() not in ("0", "false", "no")
+# Timeout of a single attempt, and of the whole call (retries, hedges and failover included)
+ATTEMPT_TIMEOUT_SECONDS = float(os.getenv("LLM_ATTEMPT_TIMEOUT_SECONDS", "20"))
+CALL_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "45"))
+# Retries per provider after the first attempt
+MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+RETRY_BASE_SECONDS = float(os.getenv("LLM_RETRY_BASE_SECONDS", "0.25"))
+RETRY_MAX_SECONDS = float(os.getenv("LLM_RETRY_MAX_SECONDS", "4"))
+# Hedged requests: off by default (a hedge is a second, billed request)
+HEDGE_ENABLED = os.getenv("LLM_HEDGE", "0").lower() in ("1", "true", "yes")
+# Hedge delay until enough latencies were observed for a p95
+HEDGE_DELAY_SECONDS = float(os.getenv("LLM_HEDGE_DELAY_SECONDS", "2.0"))
+HEDGE_MIN_SAMPLES = 20
+# Consecutive failures that open a provider's breaker, and how long it stays open
+BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+
+RETRYABLE_STATUS = frozenset({408, 409, 429, 500, 502, 503, 504})
+# Errors that say nothing about the request itself, only about this provider (bad key, unknown model)
+FAILOVER_STATUS = frozenset({401, 403, 404})
+_RETRYABLE_ERROR_NAMES = frozenset({"APITimeoutError", "APIConnectionError", "ScriptedProviderError"})
+
+CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+RETRIES = metrics.REGISTRY.counter(
+    "pharmacy_provider_retries_total",
+    "Provider attempts retried after a retryable error",
+    ("provider", "error"),
+)
+HEDGES = metrics.REGISTRY.counter(
+    "pharmacy_provider_hedged_requests_total",
+    "Hedged provider requests by which attempt answered first (primary, hedge) or failed (both_failed)",
+    ("provider", "outcome"),
+)
+FAILOVERS = metrics.REGISTRY.counter(
+    "pharmacy_provider_failovers_total",
+    "Calls moved to another provider (breaker open or attempts exhausted)",
+    ("source", "target"),
+)
+BREAKER_STATE = metrics.REGISTRY.gauge(
+    "pharmacy_provider_breaker_state",
+    "Provider circuit breaker state (0 closed, 1 half-open, 2 open)",
+    ("provider",),
+)
+
+
+class ProviderUnavailable(Exception):
+    """Every provider's circuit breaker is open"""
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether a failed attempt may succeed if repeated (timeouts, connection errors, overload)"""
+    if isinstance(error, (TimeoutError, asyncio.TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    return type(error).__name__ in _RETRYABLE_ERROR_NAMES
+
+
+def _should_fail_over(error: BaseException) -> bool:
+    return is_retryable(error) or getattr(error, "status_code", None) in FAILOVER_STATUS
+
+
+def _retry_after(error: BaseException) -> Optional[float]:
+    """Seconds from a Retry-After header on the error's response, if any"""
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt: int, error: Optional[BaseException] = None) -> float:
+    """Full-jitter exponential backoff before retry number attempt + 1 (Retry-After wins if given)"""
+    retry_after = _retry_after(error) if error is not None else None
+    if retry_after is not None:
+        return min(retry_after, RETRY_MAX_SECONDS)
+    return random.uniform(0, min(RETRY_MAX_SECONDS, RETRY_BASE_SECONDS * 2 ** attempt))
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker for one provider"""
+
+    def __init__(self, name: str, failures: int = BREAKER_FAILURES, reset_seconds: float = BREAKER_RESET_SECONDS):
+        self.name = name
+        self.failure_threshold = failures
+        self.reset_seconds = reset_seconds
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._lock = threading.Lock()
+        BREAKER_STATE.set(0, provider=name)
+
+    def _set_state(self, state: str):
+        if state != self.state:
+            tracing.console(f"\n🔌 Provider {self.name}: circuit {self.state} -> {state}")
+        self.state = state
+        BREAKER_STATE.set(_STATE_VALUES[state], provider=self.name)
+
+    def allow(self) -> bool:
+        """Whether a call may go to this provider now (in half-open state: one trial call at a time)"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_seconds:
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._trial_running = False
+            self._set_state(CLOSED)
+
+    def release(self):
+        """
+        Give up a call that ended without an outcome (cancelled, deadline passed):
+        in half-open state, the next call becomes the trial
+        """
+        with self._lock:
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_running = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                self._set_state(OPEN)
+
+
+class LatencyTracker:
+    """
+    Recent successful attempt latencies of one provider, for one kind of call
+    (for the hedge delay): time to response headers for streams, full completion otherwise
+    """
+
+    def __init__(self, size: int = 200):
+        self._samples = deque(maxlen=size)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def p95(self) -> Optional[float]:
+        with self._lock:
+            if len(self._samples) < HEDGE_MIN_SAMPLES:
+                return None
+            samples = sorted(self._samples)
+        return samples[int(0.95 * (len(samples) - 1))]
+
+
+_state_lock = threading.Lock()
+_breakers: Dict[str, CircuitBreaker] = {}
+_latencies: Dict[tuple, LatencyTracker] = {}
+# The backend that answered the last call made in this context (see ResilientProvider.answered_by)
+_answered_by: contextvars.ContextVar = contextvars.ContextVar("answered_by", default=None)
+
+
+def _backend_key(backend: Provider) -> str:
+    return f"{backend.name}:{getattr(backend, 'base_url', None) or ''}"
+
+
+def get_breaker(backend: Provider) -> CircuitBreaker:
+    """The process-wide breaker of a provider"""
+    key = _backend_key(backend)
+    with _state_lock:
+        if key not in _breakers:
+            _breakers[key] = CircuitBreaker(backend.name)
+        return _breakers[key]
+
+
+def get_latency(backend: Provider, stream: bool = False) -> LatencyTracker:
+    """The process-wide latency statistics of a provider's streamed or non-streamed calls"""
+    key = (_backend_key(backend), stream)
+    with _state_lock:
+        if key not in _latencies:
+            _latencies[key] = LatencyTracker()
+        return _latencies[key]
+
+
+_attempt_pool = None
+_attempt_pool_pid = None
+
+
+def _get_attempt_pool() -> ThreadPoolExecutor:
+    """Threads for sync attempts, so each can be bounded by wall-clock time (rebuilt in a forked worker)"""
+    global _attempt_pool, _attempt_pool_pid
+    if _attempt_pool_pid != os.getpid():
+        with _state_lock:
+            if _attempt_pool_pid != os.getpid():
+                _attempt_pool = ThreadPoolExecutor(max_workers=64, thread_name_prefix="llm_attempt")
+                _attempt_pool_pid = os.getpid()
+    return _attempt_pool
+
+
+def _close_quietly(response):
+    """Close a losing hedge's stream (ignored for plain responses)"""
+    close = getattr(response, "close", None)
+    if close is not None:
+        try:
+            close()
+        except Exception:
+            pass
+
+
+async def _aclose_quietly(response):
+    close = getattr(response, "close", None)
+    if close is not None:
+        try:
+            await close()
+        except Exception:
+            pass
+
+
+class ResilientProvider(Provider):
+    """
+    Providers in order of preference behind one client, with deadlines, retries,
+    optional hedging and breaker-driven failover (see the module docstring).
+    Reports the first provider's name and model; answered_by() gives the one
+    that answered a call.
+    """
+
+    def __init__(
+        self,
+        backends: List[Provider],
+        attempt_timeout: float = ATTEMPT_TIMEOUT_SECONDS,
+        deadline: float = CALL_DEADLINE_SECONDS,
+        max_retries: int = MAX_RETRIES,
+        hedge: bool = HEDGE_ENABLED,
+        hedge_delay: float = HEDGE_DELAY_SECONDS,
+    ):
+        """
+        Args:
+            backends: Providers to try, first = preferred
+            attempt_timeout: Seconds per attempt
+            deadline: Seconds per call, across all attempts and providers
+            max_retries: Retries per provider after its first attempt
+            hedge: Send a second request when an attempt is slower than the provider's p95
+            hedge_delay: Hedge delay until enough latencies were observed
+        """
+        super().__init__(backends[0].model)
+        self.name = backends[0].name
+        self.backends = list(backends)
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.hedge_delay = hedge_delay
+        self._client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=self.create)))
+        self._async_client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=self.acreate)))
+        # Connection warm-up (clients.warm_up) goes to the preferred provider
+        self._client.with_options = lambda **options: self.backends[0].get_client().with_options(**options)
+        self._async_client.with_options = lambda **options: self.backends[0].get_async_client().with_options(**options)
+
+    def get_client(self):
+        return self._client
+
+    def get_async_client(self):
+        return self._async_client
+
+    def answered_by(self) -> Provider:
+        """The backend that answered the last call made in this context (after a failover: not the first)"""
+        return _answered_by.get() or self.backends[0]
+
+    def _kwargs_for(self, backend: Provider, kwargs: dict) -> dict:
+        """A fallback provider gets its own model name"""
+        return kwargs if backend is self.backends[0] else dict(kwargs, model=backend.model)
+
+    def _hedge_delay(self, backend: Provider, kwargs: dict) -> float:
+        return get_latency(backend, bool(kwargs.get("stream"))).p95() or self.hedge_delay
+
+    def _fail_over(self, source: Optional[Provider], target: Provider):
+        if source is not None:
+            FAILOVERS.inc(source=source.name, target=target.name)
+            tracing.console(f"\n🔀 Provider failover: {source.name} -> {target.name}")
+
+    # Sync
+
+    def _call(self, backend: Provider, kwargs: dict, timeout: float):
+        client = backend.get_client().with_options(timeout=timeout, max_retries=0)
+        start = time.perf_counter()
+        response = client.chat.completions.create(**kwargs)
+        get_latency(backend, bool(kwargs.get("stream"))).observe(time.perf_counter() - start)
+        return response
+
+    def _bounded_call(self, backend: Provider, kwargs: dict, timeout: float):
+        """
+        _call() within timeout seconds of wall-clock time. The client's timeout only
+        bounds each read, so a response that keeps trickling in could run past it.
+        An attempt out of time is abandoned (its stream closed if it answers later).
+        """
+        attempt = _get_attempt_pool().submit(self._call, backend, kwargs, timeout)
+        done, _ = wait([attempt], timeout=timeout)
+        if not done:
+            attempt.add_done_callback(lambda f: f.exception() is None and _close_quietly(f.result()))
+            raise TimeoutError(f"{backend.name}: no answer within {timeout:.1f}s")
+        return attempt.result()
+
+    def _hedged_call(self, backend: Provider, kwargs: dict, timeout: float):
+        pool = _get_attempt_pool()
+        started = time.monotonic()
+        primary = pool.submit(self._call, backend, kwargs, timeout)
+        done, _ = wait([primary], timeout=min(self._hedge_delay(backend, kwargs), timeout))
+        if done:
+            return primary.result()
+        hedge = pool.submit(self._call, backend, kwargs, timeout)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            remaining = timeout - (time.monotonic() - started)
+            done, pending = wait(pending, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    for loser in pending:
+                        loser.add_done_callback(lambda f: f.exception() is None and _close_quietly(f.result()))
+                    HEDGES.inc(provider=backend.name, outcome="primary" if future is primary else "hedge")
+                    return future.result()
+                error = future.exception()
+        HEDGES.inc(provider=backend.name, outcome="both_failed")
+        raise error or TimeoutError(f"{backend.name}: no answer within {timeout:.1f}s")
+
+    def create(self, **kwargs):
+        """chat.completions.create() across the providers (see the module docstring)"""
+        deadline = time.monotonic() + self.deadline
+        last_error, previous = None, None
+        for backend in self.backends:
+            breaker = get_breaker(backend)
+            if not breaker.allow():
+                continue
+            self._fail_over(previous, backend)
+            previous = backend
+            call_kwargs = self._kwargs_for(backend, kwargs)
+            try:
+                for attempt in range(self.max_retries + 1):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise last_error or TimeoutError(f"Provider call exceeded its {self.deadline:.0f}s deadline")
+                    timeout = min(self.attempt_timeout, remaining)
+                    try:
+                        if self.hedge:
+                            response = self._hedged_call(backend, call_kwargs, timeout)
+                        else:
+                            response = self._bounded_call(backend, call_kwargs, timeout)
+                    except Exception as e:
+                        if not _should_fail_over(e):
+                            # The provider answered (e.g. 400 for this request): it is up
+                            breaker.record_success()
+                            raise
+                        last_error = e
+                        breaker.record_failure()
+                        if not is_retryable(e) or attempt == self.max_retries or not breaker.allow():
+                            break
+                        RETRIES.inc(provider=backend.name, error=type(e).__name__)
+                        time.sleep(min(backoff_delay(attempt, e), max(0.0, deadline - time.monotonic())))
+                        continue
+                    breaker.record_success()
+                    _answered_by.set(backend)
+                    return response
+            except BaseException:
+                # Cancelled (client gone, hedge loser) or out of time without an outcome:
+                # a half-open breaker's trial must not stay taken
+                breaker.release()
+                raise
+        raise last_error or ProviderUnavailable("All providers are unavailable (circuit open)")
+
+    # Async
+
+    async def _acall(self, backend: Provider, kwargs: dict, timeout: float):
+        client = backend.get_async_client().with_options(timeout=timeout, max_retries=0)
+        start = time.perf_counter()
+        response = await asyncio.wait_for(client.chat.completions.create(**kwargs), timeout)
+        get_latency(backend, bool(kwargs.get("stream"))).observe(time.perf_counter() - start)
+        return response
+
+    async def _ahedged_call(self, backend: Provider, kwargs: dict, timeout: float):
+        started = time.monotonic()
+        primary = asyncio.ensure_future(self._acall(backend, kwargs, timeout))
+        done, _ = await asyncio.wait({primary}, timeout=min(self._hedge_delay(backend, kwargs), timeout))
+        if done:
+            return primary.result()
+        hedge = asyncio.ensure_future(self._acall(backend, kwargs, timeout))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                remaining = timeout - (time.monotonic() - started)
+                done, pending = await asyncio.wait(pending, timeout=max(0.0, remaining), return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                winners = [task for task in done if task.exception() is None]
+                if winners:
+                    winner = primary if primary in winners else winners[0]
+                    for task in winners:
+                        if task is not winner:
+                            # Both answered at once: close the stream that isn't used
+                            await _aclose_quietly(task.result())
+                    HEDGES.inc(provider=backend.name, outcome="primary" if winner is primary else "hedge")
+                    return winner.result()
+                error = next(iter(done)).exception()
+            HEDGES.inc(provider=backend.name, outcome="both_failed")
+            raise error or TimeoutError(f"{backend.name}: no answer within {timeout:.1f}s")
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def acreate(self, **kwargs):
+        """Async version of create()"""
+        deadline = time.monotonic() + self.deadline
+        last_error, previous = None, None
+        for backend in self.backends:
+            breaker = get_breaker(backend)
+            if not breaker.allow():
+                continue
+            self._fail_over(previous, backend)
+            previous = backend
+            call_kwargs = self._kwargs_for(backend, kwargs)
+            try:
+                for attempt in range(self.max_retries + 1):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise last_error or TimeoutError(f"Provider call exceeded its {self.deadline:.0f}s deadline")
+                    timeout = min(self.attempt_timeout, remaining)
+                    try:
+                        if self.hedge:
+                            response = await self._ahedged_call(backend, call_kwargs, timeout)
+                        else:
+                            response = await self._acall(backend, call_kwargs, timeout)
+                    except Exception as e:
+                        if not _should_fail_over(e):
+                            # The provider answered (e.g. 400 for this request): it is up
+                            breaker.record_success()
+                            raise
+                        last_error = e
+                        breaker.record_failure()
+                        if not is_retryable(e) or attempt == self.max_retries or not breaker.allow():
+                            break
+                        RETRIES.inc(provider=backend.name, error=type(e).__name__)
+                        await asyncio.sleep(min(backoff_delay(attempt, e), max(0.0, deadline - time.monotonic())))
+                        continue
+                    breaker.record_success()
+                    _answered_by.set(backend)
+                    return response
+            except BaseException:
+                # Cancelled (client gone, hedge loser) or out of time without an outcome:
+                # a half-open breaker's trial must not stay taken
+                breaker.release()
+                raise
+        raise last_error or ProviderUnavailable("All providers are unavailable (circuit open)")
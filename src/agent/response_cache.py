@@ -0,0 +1,186 @@
+"""
+LLM response cache for the Pharmacy AI Agent
+Many sessions open with the same question ("What is Aspirin used for?"), and
+each one pays a full provider round trip for the same answer. Non-streamed
+provider responses are cached per round, keyed on a normalized form of
+everything the model sees: model, tool definitions, system prompt and the
+conversation so far (user text with case and whitespace folded, tool call ids
+renumbered). Entries are evicted LRU and after a TTL.
+
+A round whose input contains inventory data (a check_inventory result) is
+stamped with the inventory version it saw and is only reused while stock levels
+are unchanged, so a cached answer never shows stale stock.
+"""
+
+import os
+import json
+import time
+import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from types import SimpleNamespace
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from agent import metrics
+
+
+DEFAULT_MAX_ENTRIES = int(os.getenv("AGENT_RESPONSE_CACHE_SIZE", "512"))
+DEFAULT_TTL_SECONDS = float(os.getenv("AGENT_RESPONSE_CACHE_TTL_SECONDS", "600"))
+
+# Tool results that carry stock levels
+INVENTORY_TOOLS = frozenset({"check_inventory"})
+
+LOOKUPS = metrics.REGISTRY.counter(
+    "pharmacy_llm_cache_lookups_total",
+    "LLM response cache lookups by result (hit, miss, stale = invalidated by an inventory change)",
+    ("result",),
+)
+
+
+def _normalize_arguments(arguments: str) -> Any:
+    try:
+        return json.loads(arguments or "{}")
+    except ValueError:
+        return arguments
+
+
+def normalize_messages(messages: List[Dict[str, Any]]) -> Tuple[list, bool]:
+    """
+    Canonical form of a message list for cache keys.
+
+    Returns:
+        (normalized messages, whether any tool result in them carries inventory data)
+    """
+    ids: Dict[str, str] = {}
+    names: Dict[str, str] = {}
+    normalized = []
+    uses_inventory = False
+    for message in messages:
+        role = message.get("role")
+        content = message.get("content")
+        if role == "user" and isinstance(content, str):
+            content = " ".join(content.split()).casefold()
+        entry = [role, content]
+        if message.get("tool_calls"):
+            calls = []
+            for tool_call in message["tool_calls"]:
+                short_id = ids.setdefault(tool_call["id"], f"t{len(ids)}")
+                names[tool_call["id"]] = tool_call["function"]["name"]
+                calls.append([short_id, tool_call["function"]["name"],
+                              _normalize_arguments(tool_call["function"]["arguments"])])
+            entry.append(calls)
+        if role == "tool":
+            tool_call_id = message.get("tool_call_id")
+            entry.append(ids.get(tool_call_id, tool_call_id))
+            uses_inventory = uses_inventory or names.get(tool_call_id) in INVENTORY_TOOLS
+        normalized.append(entry)
+    return normalized, uses_inventory
+
+
+class ResponseCache:
+    """Thread-safe LRU + TTL cache of provider responses, shared by every agent in the process"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, ttl: float = DEFAULT_TTL_SECONDS):
+        """
+        Args:
+            max_entries: Cached responses kept at most (least recently used evicted first)
+            ttl: Seconds a response stays valid
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[float, Optional[str], str, list]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._entries)
+
+    @staticmethod
+    def key_for(kwargs: Dict[str, Any]) -> Tuple[str, bool]:
+        """
+        Cache key for chat.completions.create arguments.
+
+        Returns:
+            (key, whether the response depends on inventory data)
+        """
+        normalized, uses_inventory = normalize_messages(kwargs["messages"])
+        payload = json.dumps(
+            [kwargs.get("model"), kwargs.get("tools"), kwargs.get("tool_choice"), normalized],
+            ensure_ascii=False, separators=(",", ":"), sort_keys=True
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest(), uses_inventory
+
+    def get(self, key: str, inventory_version: Optional[Callable[[], Optional[str]]] = None):
+        """
+        Cached response for key, shaped like the SDK's (fresh tool call ids), or None.
+
+        Args:
+            key: From key_for()
+            inventory_version: Returns the current inventory version; pass it for
+                entries that depend on inventory data
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self._entries[key]
+                LOOKUPS.inc(result="miss")
+                return None
+            self._entries.move_to_end(key)
+        _, version, content, tool_calls = entry
+        if inventory_version is not None:
+            current = inventory_version()
+            if current is None or current != version:
+                with self._lock:
+                    self._entries.pop(key, None)
+                LOOKUPS.inc(result="stale")
+                return None
+        LOOKUPS.inc(result="hit")
+        return self._response(content, tool_calls)
+
+    def put(self, key: str, response, inventory_version: Optional[str] = None):
+        """Cache a provider response (inventory_version: what the response's input was based on)"""
+        try:
+            message = response.choices[0].message
+        except (AttributeError, IndexError):
+            return
+        tool_calls = [
+            (tool_call.function.name, tool_call.function.arguments)
+            for tool_call in (message.tool_calls or [])
+        ]
+        with self._lock:
+            self._entries[key] = (time.monotonic(), inventory_version, message.content, tool_calls)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    @staticmethod
+    def _response(content: Optional[str], tool_calls: list):
+        """A response object with the same shape as the SDK's ChatCompletion"""
+        message = SimpleNamespace(
+            role="assistant",
+            content=content,
+            tool_calls=[
+                SimpleNamespace(
+                    # Ids must stay unique within a conversation
+                    id=f"call_{uuid.uuid4().hex[:24]}",
+                    type="function",
+                    function=SimpleNamespace(name=name, arguments=arguments)
+                )
+                for name, arguments in tool_calls
+            ] or None
+        )
+        return SimpleNamespace(
+            choices=[SimpleNamespace(index=0, message=message, finish_reason="tool_calls" if tool_calls else "stop")],
+            usage=None,
+            cached=True
+        )
+
+
+# Process-wide cache (None when disabled with AGENT_RESPONSE_CACHE_SIZE=0)
+RESPONSE_CACHE = ResponseCache() if DEFAULT_MAX_ENTRIES > 0 else None
@@ -0,0 +1,221 @@
+"""
+Deterministic fast path for simple catalog questions
+"Do you have X in stock?" and "Does X need a prescription?" are answered
+completely by check_inventory, so they don't need the LLM. This router
+recognizes such single-intent questions (English and Hebrew) with high
+confidence and answers them from the tool result with a fixed template.
+Anything involving a person, an allergy or a request for advice is left to the
+full agent loop, and so is anything that may name a second item the catalog
+doesn't know ("Do you have Advil or Aspirin?"): only the catalog one would be
+answered.
+"""
+
+import os
+import re
+from typing import Any, Dict, FrozenSet, Optional
+
+from agent import prefetch
+
+
+FAST_PATH_ENABLED = os.getenv("AGENT_FAST_PATH", "1").lower() not in ("0", "false", "no")
+# Longer messages are rarely a single, simple question
+MAX_MESSAGE_LENGTH = 120
+
+STOCK = "stock"
+PRESCRIPTION = "prescription"
+
+_HEBREW = re.compile(r"[֐-׿]")
+
+_INTENT_PATTERNS = {
+    "en": {
+        STOCK: re.compile(
+            r"\b(do you (have|carry|stock|sell)|in stock|out of stock|available|availability|got any)\b",
+            re.IGNORECASE),
+        PRESCRIPTION: re.compile(
+            r"\b(prescription|rx|over[- ]the[- ]counter|otc)\b", re.IGNORECASE),
+    },
+    "he": {
+        STOCK: re.compile(r"(יש לכם|יש לך|במלאי|זמין|זמינה|מוכרים)"),
+        PRESCRIPTION: re.compile(r"(מרשם|ללא מרשם|בלי מרשם)"),
+    },
+}
+
+# Anything that makes the question about a person, their safety or advice
+_FALL_THROUGH_PATTERNS = {
+    "en": re.compile(
+        r"\b(i'?m|i am|i|me|my|mine|name|for (him|her|them)|wife|husband|son|daughter|mother|mom|father|dad|"
+        r"kid|child|children|baby|pregnan\w*|breastfeed\w*|allerg\w*|safe|should|take|taking|dose|dosage|"
+        r"how much|side effects?|interact\w*|mix|with|symptoms?|pain|sick|treat|recommend\w*|advice|pick ?up|refill)\b",
+        re.IGNORECASE),
+    "he": re.compile(
+        # Whole words (with an optional one-letter prefix), plus a few stems
+        r"(?<![֐-׿])[הובלמש]?(אני|שלי|לי|שמי|קוראים|בשבילי|בטוח|כדאי|לקחת|נוטל|נוטלת|מינון|כמה|תופעות|שילוב|עם|"
+        r"ילד|ילדה|תינוק|אבא|אמא|בן|בת|כאב|חולה|ממליץ|ממליצה|עצה|לאסוף)(?![֐-׿])"
+        r"|אלרג|הריון|מניק"),
+}
+
+# Lists and conjunctions: the message may ask about more than one item
+_LIST_PATTERNS = {
+    "en": re.compile(r"\b(or|and|also|plus|too|either|both|as well)\b|[,;/&+]", re.IGNORECASE),
+    "he": re.compile(r"[,;/&+]|(?<![֐-׿])(או|גם|וגם|ועוד)(?![֐-׿])|(?<![֐-׿])ו[֐-׿]"),
+}
+# Common generic-drug name endings, for medications the catalog doesn't know
+_DRUG_LIKE_PATTERN = re.compile(
+    r"\w+(cillin|cycline|mycin|floxacin|azole|statin|sartan|pril|olol|dipine|oxetine|aline|afil|tidine|"
+    r"zepam|zolam|codone|profen|fenac|triptan|gliptin|glutide|formin|mab|vir)\b",
+    re.IGNORECASE)
+_LATIN_WORD = re.compile(r"[A-Za-z][A-Za-z0-9-]*")
+# Capitalized words that are just how an English question starts
+_OPENERS = frozenset({
+    "do", "does", "is", "are", "can", "could", "have", "has", "got", "any", "hi", "hello", "hey",
+    "please", "what", "how", "yes", "no", "ok", "okay", "thanks", "the", "we", "you",
+})
+
+# Hebrew spellings of catalog medications (only used if the catalog has them)
+HEBREW_MEDICATION_NAMES = {
+    "אספירין": "Aspirin",
+    "מטפורמין": "Metformin",
+    "סמגלוטייד": "Semaglutide",
+    "איבופרופן": "Ibuprofen",
+    "אמוקסיצילין": "Amoxicillin",
+    "וורפרין": "Warfarin",
+    "גליבוריד": "Glyburide",
+    "פרובנציד": "Probenecid",
+}
+# Hebrew attaches prepositions/articles as prefixes ("האספירין", "לאיבופרופן")
+_HEBREW_MEDICATION_PATTERN = re.compile(
+    r"(?<![֐-׿])[הובלמש]?(" + "|".join(HEBREW_MEDICATION_NAMES) + r")(?![֐-׿])"
+)
+
+_TEMPLATES = {
+    "en": {
+        "in_stock": "Yes, we have {medication} in stock ({status}).",
+        "out_of_stock": "Sorry, {medication} is currently out of stock.",
+        "rx": "{medication} requires a valid prescription.",
+        "otc": "{medication} is available without a prescription.",
+        "stock_rx_note": " Please note it requires a valid prescription.",
+        "closing": " Ask our pharmacist if you have any questions about it.",
+    },
+    "he": {
+        "in_stock": "כן, {medication} זמין במלאי.",
+        "out_of_stock": "מצטערים, {medication} אזל מהמלאי כרגע.",
+        "rx": "{medication} דורש מרשם בתוקף.",
+        "otc": "{medication} זמין ללא מרשם.",
+        "stock_rx_note": " שימו לב: נדרש מרשם בתוקף.",
+        "closing": " לכל שאלה נוספת, הרוקח שלנו ישמח לעזור.",
+    },
+}
+
+
+class Route:
+    """A message the fast path can answer: one medication, stock and/or prescription intent"""
+
+    def __init__(self, medication: str, intents: FrozenSet[str], language: str):
+        self.medication = medication
+        self.intents = intents
+        self.language = language
+
+    @property
+    def intent(self) -> str:
+        """Label for metrics"""
+        return "+".join(sorted(self.intents))
+
+
+def language_of(text: str) -> str:
+    """Language of a message: he if it has Hebrew letters, else en"""
+    return "he" if _HEBREW.search(text) else "en"
+
+
+def intents_of(text: str, language: str) -> FrozenSet[str]:
+    """The stock / prescription intents a message expresses"""
+    return frozenset(intent for intent, pattern in _INTENT_PATTERNS[language].items() if pattern.search(text))
+
+
+def find_names(tools, text: str, language: str):
+    """
+    Known customer and catalog medication names in text, including Hebrew
+    spellings of medications.
+
+    Returns:
+        (customer names, medication names), or (None, []) if the catalog can't be loaded
+    """
+    index = prefetch.get_index(tools)
+    if index is None:
+        return None, []
+    customers, medications = index.find(text)
+    if language == "he":
+        catalog = set(index.medications.values())
+        for match in _HEBREW_MEDICATION_PATTERN.finditer(text):
+            name = HEBREW_MEDICATION_NAMES[match.group(1)]
+            if name in catalog and name not in medications:
+                medications.append(name)
+    return customers, medications
+
+
+def _may_name_another_item(tools, text: str, language: str) -> bool:
+    """
+    Whether text, besides its catalog medication, may name something else: a list
+    or conjunction, a drug-like word, or (English) a capitalized word the catalog
+    doesn't know, (Hebrew) any Latin word
+    """
+    index = prefetch.get_index(tools)
+    remainder = index.remove_medications(text) if index is not None else text
+    remainder = _HEBREW_MEDICATION_PATTERN.sub(" ", remainder)
+    for pattern in _INTENT_PATTERNS[language].values():
+        remainder = pattern.sub(" ", remainder)
+    if _LIST_PATTERNS[language].search(remainder) or _DRUG_LIKE_PATTERN.search(remainder):
+        return True
+    words = _LATIN_WORD.findall(remainder)
+    if language == "he":
+        return bool(words)
+    return any(word[0].isupper() and word.lower() not in _OPENERS for word in words)
+
+
+def match(tools, user_message: str) -> Optional[Route]:
+    """
+    Decide whether user_message can be answered without the LLM.
+
+    Returns:
+        A Route, or None to fall through to the agent loop
+    """
+    text = user_message.strip()
+    if not text or len(text) > MAX_MESSAGE_LENGTH or text.count("?") > 1:
+        return None
+    language = language_of(text)
+    if _FALL_THROUGH_PATTERNS[language].search(text):
+        return None
+    intents = intents_of(text, language)
+    if not intents:
+        return None
+    customers, medications = find_names(tools, text, language)
+    # Exactly one medication, nobody named, and nothing else asked about
+    if customers or len(medications) != 1 or _may_name_another_item(tools, text, language):
+        return None
+    return Route(medications[0], intents, language)
+
+
+def render(route: Route, result: Dict[str, Any]) -> Optional[str]:
+    """
+    The templated answer for a route from its check_inventory result.
+
+    Returns:
+        The reply text, or None if the result can't be answered from (fall through)
+    """
+    if not result.get("success"):
+        return None
+    templates = _TEMPLATES[route.language]
+    medication = result["medication"]
+    requires_rx = result.get("requires_prescription")
+    parts = []
+    if STOCK in route.intents:
+        key = "in_stock" if result.get("in_stock") else "out_of_stock"
+        parts.append(templates[key].format(medication=medication, status=result.get("status", "")))
+        if requires_rx and PRESCRIPTION not in route.intents:
+            # Availability is never confirmed without the prescription requirement
+            parts.append(templates["stock_rx_note"])
+    if PRESCRIPTION in route.intents:
+        if parts:
+            parts.append(" ")
+        parts.append(templates["rx" if requires_rx else "otc"].format(medication=medication))
+    parts.append(templates["closing"])
+    return "".join(parts)
@@ -0,0 +1,124 @@
+"""
+Per-request phase timing for the Pharmacy AI Agent
+Records how long each LLM round, tool call and sqlite query took while serving
+one request, and renders the breakdown as a Server-Timing header or a JSON block
+"""
+
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+
+# Phase categories, in the order they are reported
+LLM = "llm"
+TOOL = "tool"
+DB = "db"
+SERIALIZE = "serialize"
+CATEGORIES = (LLM, TOOL, DB, SERIALIZE)
+
+# Timings of the request currently being served (None when nobody is measuring)
+_current: ContextVar[Optional["RequestTimings"]] = ContextVar("request_timings", default=None)
+
+
+class RequestTimings:
+    """Phase durations collected while serving one request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: List[Dict[str, Any]] = []
+
+    def add(self, category: str, name: str, seconds: float, **detail):
+        """Record a finished phase"""
+        phase = {"category": category, "name": name, "ms": round(seconds * 1000, 3)}
+        if detail:
+            phase.update(detail)
+        self.phases.append(phase)
+
+    @contextmanager
+    def measure(self, category: str, name: str, **detail):
+        """Time the enclosed block as one phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(category, name, time.perf_counter() - start, **detail)
+
+    def elapsed_ms(self) -> float:
+        """Milliseconds since the request started"""
+        return round((time.perf_counter() - self.started) * 1000, 3)
+
+    def totals(self) -> Dict[str, Dict[str, float]]:
+        """Total time and number of phases per category"""
+        totals = {}
+        for phase in self.phases:
+            entry = totals.setdefault(phase["category"], {"ms": 0.0, "count": 0})
+            entry["ms"] = round(entry["ms"] + phase["ms"], 3)
+            entry["count"] += 1
+        return totals
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Breakdown for the optional `timings` block of the JSON response"""
+        return {
+            "total_ms": self.elapsed_ms(),
+            "totals": self.totals(),
+            "phases": list(self.phases)
+        }
+
+    def server_timing(self) -> str:
+        """
+        Value for the Server-Timing response header, e.g.
+        llm;dur=812.4;desc="2 calls", tool;dur=3.1;desc="2 calls", db;dur=1.2;desc="3 calls", total;dur=820.0
+        """
+        totals = self.totals()
+        entries = []
+        for category in CATEGORIES:
+            if category in totals:
+                entry = totals[category]
+                entries.append(f'{category};dur={entry["ms"]:.1f};desc="{entry["count"]} calls"')
+        entries.append(f"total;dur={self.elapsed_ms():.1f}")
+        return ", ".join(entries)
+
+
+def current() -> Optional[RequestTimings]:
+    """The RequestTimings being recorded in this context, if any"""
+    return _current.get()
+
+
+@contextmanager
+def activate(timings: RequestTimings):
+    """Make timings the recorder for everything run inside the block (including to_thread tools)"""
+    token = _current.set(timings)
+    try:
+        yield timings
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def measure(category: str, name: str, **detail):
+    """Time the enclosed block into the active RequestTimings; a no-op when none is active"""
+    timings = _current.get()
+    if timings is None:
+        yield
+        return
+    with timings.measure(category, name, **detail):
+        yield
+
+
+def record_db_query(sql: Optional[str], seconds: float):
+    """
+    Observer for MedicationTools.on_query.
+    sql is None for the fetch that completes the previous query; its time is
+    added to that query's phase.
+    """
+    timings = _current.get()
+    if timings is None:
+        return
+    if sql is None:
+        for phase in reversed(timings.phases):
+            if phase["category"] == DB:
+                phase["ms"] = round(phase["ms"] + seconds * 1000, 3)
+                return
+    name = " ".join((sql or "query").split())[:60]
+    timings.add(DB, name, seconds)
@@ -0,0 +1,105 @@
+"""
+Compact, model-facing encoding of tool results
+Tool results are stored in the conversation as the tools' full JSON, which the
+UI and logs show as is. The model doesn't need most of it (success flags,
+database ids, constant disclaimers, resource blocks, status text derived from
+numbers), yet pays input tokens for it in every later round. When messages are
+built for the provider, each tool result is re-encoded with only the fields the
+model needs, under stable short keys, with no whitespace.
+"""
+
+import json
+from functools import lru_cache
+from typing import Any, Dict, List
+
+
+# Per tool: (field in the tool result, key sent to the model), in a stable order
+_FIELDS = {
+    "get_medication_info": (
+        ("name", "name"), ("generic_name", "generic"), ("active_ingredients", "ingredients"),
+        ("dosage_forms", "forms"), ("common_dosages", "dosages"), ("description", "about"),
+        ("requires_prescription", "rx"), ("side_effects", "side_effects"),
+        ("contraindications", "contraindications"),
+    ),
+    "check_active_ingredients_and_interactions": (
+        ("medication", "med"), ("active_ingredients", "ingredients"), ("interactions", "interactions"),
+    ),
+    "check_inventory": (
+        ("medication", "med"), ("in_stock", "in_stock"), ("stock_quantity", "qty"),
+        ("requires_prescription", "rx"),
+    ),
+    "get_user_allergies": (
+        ("user", "user"), ("allergies", "allergies"), ("current_medications", "current_meds"),
+    ),
+    "check_prescription": (
+        ("requires_prescription", "rx"), ("has_prescription", "has_rx"), ("message", "msg"),
+    ),
+    "refer_to_professional": (
+        ("query_type", "referral"), ("message", "msg"), ("resources", "resources"),
+    ),
+}
+
+_PRESCRIPTION_FIELDS = (
+    ("medication", "med"), ("prescribing_doctor", "doctor"),
+    ("date_prescribed", "date"), ("refills_remaining", "refills"),
+)
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def compact_result(tool_name: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """The fields of a tool result the model needs, under short keys"""
+    if result.get("success") is False or ("error" in result and "success" not in result):
+        return {"error": result.get("error", "failed")}
+    fields = _FIELDS.get(tool_name)
+    if fields is None:
+        return {key: value for key, value in result.items() if key != "success"}
+
+    source = result
+    if tool_name == "get_medication_info" and isinstance(result.get("medication"), dict):
+        source = result["medication"]
+    compact = {}
+    for field, key in fields:
+        value = source.get(field)
+        if value is None or value == "":
+            continue
+        if field == "resources" and isinstance(value, list):
+            # The descriptions are generic; the model only needs which resources to name
+            value = [resource.get("type") for resource in value if isinstance(resource, dict)]
+        compact[key] = value
+    prescription = result.get("prescription")
+    if tool_name == "check_prescription" and isinstance(prescription, dict):
+        compact["prescription"] = {key: prescription[field] for field, key in _PRESCRIPTION_FIELDS
+                                   if prescription.get(field) is not None}
+        compact.pop("msg", None)
+    return compact
+
+
+@lru_cache(maxsize=2048)
+def encode(tool_name: str, content: str) -> str:
+    """
+    Model-facing encoding of a stored tool message's content.
+    Cached: the same results are re-sent in every later round of a conversation.
+    """
+    try:
+        result = json.loads(content)
+    except (TypeError, ValueError):
+        return content
+    if not isinstance(result, dict):
+        return content
+    return _dumps(compact_result(tool_name, result))
+
+
+def encode_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Copy of messages with every tool result compactly encoded (others are passed through)"""
+    tool_names = {}
+    encoded = []
+    for message in messages:
+        for tool_call in message.get("tool_calls") or []:
+            tool_names[tool_call["id"]] = tool_call["function"]["name"]
+        if message.get("role") == "tool" and message.get("tool_call_id") in tool_names:
+            message = dict(message, content=encode(tool_names[message["tool_call_id"]], message["content"]))
+        encoded.append(message)
+    return encoded
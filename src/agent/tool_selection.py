@@ -0,0 +1,123 @@
+"""
+Per-turn tool selection for the Pharmacy AI Agent
+Every tool round used to send all tool schemas, even for tools the conversation
+can't use yet: check_prescription needs a customer and a prescription-only
+medication, check_inventory needs a medication or a stock question. The schemas
+are a large part of each round's prompt, so only the tools relevant to what the
+conversation has mentioned so far are offered:
+
+- ALWAYS_OFFERED (the safety, information and referral tools): every round
+- check_inventory: once a catalog medication is named or stock is asked about
+- check_prescription: once a customer on file and a prescription-only
+  medication have both been named
+
+If the catalog of names can't be loaded, every tool is offered.
+
+What a conversation has mentioned only grows, so a tool, once offered, stays
+offered for the rest of the session (as do tools the conversation already used).
+"""
+
+import os
+from typing import Dict, FrozenSet, List
+
+from agent import metrics, prefetch, router
+from tools.medication_tools import TOOL_DEFINITIONS
+
+
+TOOL_SELECTION_ENABLED = os.getenv("AGENT_TOOL_SELECTION", "1").lower() not in ("0", "false", "no")
+
+# Offered in every tool round, whatever the conversation is about
+ALWAYS_OFFERED = frozenset({
+    "get_user_allergies",
+    "get_medication_info",
+    "check_active_ingredients_and_interactions",
+    "refer_to_professional",
+})
+
+_DEFINITIONS = {definition["function"]["name"]: definition for definition in TOOL_DEFINITIONS}
+# One list per offered set, reused by every round that offers it
+_subsets: Dict[FrozenSet[str], List[dict]] = {}
+
+
+class ConversationMentions:
+    """What a conversation has mentioned so far (one per session)"""
+
+    def __init__(self):
+        self.customers = set()
+        self.medications = set()
+        self.prescription_medications = set()
+        self.stock_question = False
+        self.tools_used = set()
+        # Names couldn't be matched (catalog not loaded): every tool is offered
+        self.unmatched = False
+
+    @classmethod
+    def from_history(cls, tools, history: List[dict]) -> "ConversationMentions":
+        """
+        Rebuild a conversation's mentions from its history (a session loaded from
+        the store, e.g. after a restart or on another worker).
+
+        Args:
+            tools: The agent's MedicationTools
+            history: The conversation history
+        """
+        mentions = cls()
+        for message in history:
+            if message.get("role") == "user" and isinstance(message.get("content"), str):
+                mentions.add_message(tools, message["content"])
+            elif message.get("role") == "assistant":
+                mentions.tools_used.update(
+                    tool_call["function"]["name"] for tool_call in message.get("tool_calls") or []
+                )
+        return mentions
+
+    def add_message(self, tools, text: str):
+        """
+        Add a customer message's customer and medication names and intents.
+
+        Args:
+            tools: The agent's MedicationTools (for the catalog of known names)
+            text: The customer's message
+        """
+        language = router.language_of(text)
+        self.stock_question = self.stock_question or router.STOCK in router.intents_of(text, language)
+        customers, medications = router.find_names(tools, text, language)
+        if customers is None:
+            self.unmatched = True
+            return
+        self.customers.update(customers)
+        self.medications.update(medications)
+        index = prefetch.get_index(tools)
+        self.prescription_medications.update(name for name in medications if name in index.prescription_only)
+
+
+def offered_tools(mentions: ConversationMentions, enabled: bool = TOOL_SELECTION_ENABLED) -> FrozenSet[str]:
+    """Names of the tools to offer for a conversation's mentions"""
+    if not enabled or mentions.unmatched:
+        return frozenset(_DEFINITIONS)
+    names = set(ALWAYS_OFFERED) | mentions.tools_used
+    if mentions.medications or mentions.stock_question:
+        names.add("check_inventory")
+    if mentions.customers and mentions.prescription_medications:
+        names.add("check_prescription")
+    return frozenset(name for name in names if name in _DEFINITIONS)
+
+
+def select(mentions: ConversationMentions, enabled: bool = TOOL_SELECTION_ENABLED) -> List[dict]:
+    """
+    The tool definitions for the next tool round, in TOOL_DEFINITIONS order.
+
+    Args:
+        mentions: The conversation's mentions so far
+        enabled: False offers every tool
+
+    Returns:
+        A (shared, not to be modified) list of tool definitions
+    """
+    names = offered_tools(mentions, enabled)
+    subset = _subsets.get(names)
+    if subset is None:
+        subset = _subsets[names] = [definition for name, definition in _DEFINITIONS.items() if name in names]
+    for name in _DEFINITIONS.keys() - names:
+        metrics.TOOL_SCHEMAS_OMITTED.inc(tool=name)
+    return subset
@@ -0,0 +1,246 @@
+"""
+Structured tracing for the Pharmacy AI Agent
+Spans for each turn, LLM request, tool call and database query replace the
+print-based logging of the request path. A trace is one turn. Whether a turn is
+traced is decided once at its root (sampling), so an unsampled or disabled turn
+costs one check per span: span() then returns a shared no-op span.
+
+Finished spans go to a sink, never written in the request path:
+- ring: the last AGENT_TRACE_RING_SIZE spans in memory, served at /debug/traces
+- jsonl: appended to AGENT_TRACE_FILE by a background writer thread, in batches
+
+Human-readable console output (the old prints) is separate and off by default;
+the CLI modes of pharmacy_agent.py turn it on.
+"""
+
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import atexit
+import threading
+from collections import deque
+from contextvars import ContextVar
+from typing import Any, Dict, List, Optional
+
+
+# off | ring | jsonl
+TRACE_SINK = os.getenv("AGENT_TRACE", "off").lower()
+TRACE_SAMPLE_RATE = float(os.getenv("AGENT_TRACE_SAMPLE_RATE", "1.0"))
+TRACE_RING_SIZE = int(os.getenv("AGENT_TRACE_RING_SIZE", "2000"))
+TRACE_FILE = os.getenv("AGENT_TRACE_FILE", "traces.jsonl")
+# Seconds between writes of the JSONL sink
+FLUSH_INTERVAL_SECONDS = 0.5
+
+ENABLED = TRACE_SINK in ("ring", "jsonl")
+CONSOLE_ENABLED = os.getenv("AGENT_CONSOLE_LOG", "0").lower() in ("1", "true", "yes")
+
+# The span that new spans in this context are children of
+_current: ContextVar[Optional["Span"]] = ContextVar("trace_span", default=None)
+
+
+class _NoopSpan:
+    """Stands in for a span when the turn isn't traced; every method does nothing"""
+
+    __slots__ = ()
+    recording = False
+
+    def set(self, **attributes):
+        pass
+
+    def end(self, error: Optional[BaseException] = None, **attributes):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    """One timed operation of a traced turn"""
+
+    __slots__ = ("trace_id", "span_id", "parent_id", "name", "attributes", "started", "_start", "_ended", "_token")
+    recording = True
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace_id = trace_id
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = attributes
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self._ended = False
+        self._token = None
+
+    def set(self, **attributes):
+        """Add attributes (e.g. results known only at the end)"""
+        self.attributes.update(attributes)
+
+    def end(self, error: Optional[BaseException] = None, **attributes):
+        """Finish the span and hand it to the sink (only the first call counts)"""
+        if self._ended:
+            return
+        self._ended = True
+        self.attributes.update(attributes)
+        if error is not None:
+            self.attributes["error"] = f"{type(error).__name__}: {error}"
+        _emit(self, time.perf_counter() - self._start)
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _current.reset(self._token)
+        self.end(exc_value)
+        return False
+
+
+def start_trace(name: str, **attributes):
+    """
+    Start the root span of a trace (one turn), subject to sampling.
+    Not bound to the context: pass it as parent= to child spans, and end() it.
+
+    Returns:
+        A Span, or NOOP_SPAN when tracing is off or this trace isn't sampled
+    """
+    if not ENABLED or random.random() >= TRACE_SAMPLE_RATE:
+        return NOOP_SPAN
+    return Span(name, uuid.uuid4().hex, None, attributes)
+
+
+def span(name: str, parent=None, **attributes):
+    """
+    Child span of parent (default: the current span), used as a context manager;
+    it becomes the current span inside the block. No-op outside a traced turn.
+    """
+    if not ENABLED:
+        return NOOP_SPAN
+    parent = parent if parent is not None else _current.get()
+    if parent is None or not parent.recording:
+        return NOOP_SPAN
+    return Span(name, parent.trace_id, parent.span_id, attributes)
+
+
+def record(name: str, seconds: float, parent=None, **attributes):
+    """Record an operation that already finished (and took seconds) as a child span"""
+    if not ENABLED:
+        return
+    parent = parent if parent is not None else _current.get()
+    if parent is None or not parent.recording:
+        return
+    child = Span(name, parent.trace_id, parent.span_id, attributes)
+    child.started -= seconds
+    child._ended = True
+    _emit(child, seconds)
+
+
+def _as_record(finished: Span, seconds: float) -> Dict[str, Any]:
+    return {
+        "trace_id": finished.trace_id,
+        "span_id": finished.span_id,
+        "parent_id": finished.parent_id,
+        "name": finished.name,
+        "start": round(finished.started, 6),
+        "duration_ms": round(seconds * 1000, 3),
+        "attributes": finished.attributes,
+    }
+
+
+# Sinks
+
+_ring: deque = deque(maxlen=TRACE_RING_SIZE)
+_queue: "queue.SimpleQueue" = queue.SimpleQueue()
+_writer_pid = None
+_writer_lock = threading.Lock()
+
+
+def _emit(finished: Span, seconds: float):
+    if TRACE_SINK == "ring":
+        # deque.append is atomic; the record is built lazily when read
+        _ring.append((finished, seconds))
+    elif TRACE_SINK == "jsonl":
+        _ensure_writer()
+        _queue.put((finished, seconds))
+
+
+def _ensure_writer():
+    """Start the JSONL writer thread (once per process, again after a fork)"""
+    global _writer_pid
+    if _writer_pid == os.getpid():
+        return
+    with _writer_lock:
+        if _writer_pid == os.getpid():
+            return
+        _writer_pid = os.getpid()
+        threading.Thread(target=_write_loop, name="trace-writer", daemon=True).start()
+        atexit.register(flush)
+
+
+def _drain() -> List[str]:
+    lines = []
+    while True:
+        try:
+            finished, seconds = _queue.get_nowait()
+        except queue.Empty:
+            return lines
+        lines.append(json.dumps(_as_record(finished, seconds), ensure_ascii=False, default=str))
+
+
+def flush():
+    """Write the queued spans to the JSONL file now"""
+    lines = _drain()
+    if not lines:
+        return
+    try:
+        with open(TRACE_FILE, "a", encoding="utf-8") as trace_file:
+            trace_file.write("\n".join(lines) + "\n")
+    except OSError as e:
+        print(f"⚠️  Trace write failed: {e}", file=sys.stderr)
+
+
+def _write_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL_SECONDS)
+        flush()
+
+
+def recent_traces(limit: int = 20) -> List[Dict[str, Any]]:
+    """
+    The most recent traces from the ring sink, newest first, each with its spans
+    in start order (for the /debug/traces endpoint)
+    """
+    traces: Dict[str, List[Dict[str, Any]]] = {}
+    for finished, seconds in reversed(list(_ring)):
+        if finished.trace_id not in traces:
+            if len(traces) >= limit:
+                continue
+            traces[finished.trace_id] = []
+        traces[finished.trace_id].append(_as_record(finished, seconds))
+    return [
+        {"trace_id": trace_id, "spans": sorted(spans, key=lambda record: record["start"])}
+        for trace_id, spans in traces.items()
+    ]
+
+
+# Console output
+
+def enable_console(enabled: bool = True):
+    """Turn the human-readable console log on (CLI modes) or off"""
+    global CONSOLE_ENABLED
+    CONSOLE_ENABLED = enabled
+
+
+def console(message: str):
+    """Print a console log line if the console log is on (guard costly messages with CONSOLE_ENABLED)"""
+    if CONSOLE_ENABLED:
+        print(message)
@@ -0,0 +1,214 @@
+"""
+Token usage and cost accounting for the Pharmacy AI Agent
+Every provider call reports prompt, completion and cached (prompt-cache) tokens.
+They are recorded per call and rolled up per turn and per session. The prompt is
+also split by component, so it is visible what drives cost and latency:
+
+- system: the system prompt
+- tool_definitions: the tool JSON schemas sent with tool rounds
+- history: user and assistant messages (and the compaction note)
+- tool_results: tool messages
+
+The provider only reports the total, so the split is estimated from message
+sizes and scaled to the reported total. If a provider reports no usage (e.g. a
+stream without usage), all counts are estimated and marked as such.
+"""
+
+import os
+import json
+from typing import Any, Dict, Optional
+
+from agent import metrics
+from agent.compaction import estimate_tokens
+
+
+COMPONENTS = ("system", "tool_definitions", "history", "tool_results")
+
+# USD per 1M tokens: (input, cached input, output); AGENT_MODEL_PRICES (same JSON shape) adds or overrides
+MODEL_PRICES = {
+    "gpt-4o": (2.50, 1.25, 10.00),
+    "gpt-4o-mini": (0.15, 0.075, 0.60),
+    "gpt-4.1": (2.00, 0.50, 8.00),
+    "gpt-4.1-mini": (0.40, 0.10, 1.60),
+    "scripted": (0.0, 0.0, 0.0),
+}
+MODEL_PRICES.update({
+    model: tuple(prices) for model, prices in json.loads(os.getenv("AGENT_MODEL_PRICES", "{}")).items()
+})
+
+
+def price_for(model: str) -> Optional[tuple]:
+    """Prices for a model, also matching dated snapshots (gpt-4o-2024-08-06); None if unknown"""
+    if model in MODEL_PRICES:
+        return MODEL_PRICES[model]
+    candidates = [known for known in MODEL_PRICES if model.startswith(known + "-")]
+    return MODEL_PRICES[max(candidates, key=len)] if candidates else None
+
+
+def cost_usd(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0) -> Optional[float]:
+    """Estimated cost of a call in USD, or None for a model without a known price"""
+    prices = price_for(model)
+    if prices is None:
+        return None
+    input_price, cached_price, output_price = prices
+    return ((prompt_tokens - cached_tokens) * input_price
+            + cached_tokens * cached_price
+            + completion_tokens * output_price) / 1_000_000
+
+
+def prompt_components(kwargs: Dict[str, Any], prompt_tokens: Optional[int] = None) -> Dict[str, int]:
+    """
+    Split a call's prompt tokens by component.
+
+    Args:
+        kwargs: The chat.completions.create arguments
+        prompt_tokens: The provider-reported total to scale the estimate to (None: keep the estimate)
+
+    Returns:
+        Tokens per component (see COMPONENTS)
+    """
+    components = dict.fromkeys(COMPONENTS, 0)
+    for index, message in enumerate(kwargs["messages"]):
+        role = message.get("role")
+        if role == "system" and index == 0:
+            component = "system"
+        elif role == "tool":
+            component = "tool_results"
+        else:
+            component = "history"
+        components[component] += estimate_tokens(message)
+    if kwargs.get("tools"):
+        components["tool_definitions"] = len(json.dumps(kwargs["tools"], ensure_ascii=False)) // 4
+    estimated = sum(components.values())
+    if prompt_tokens is None or estimated == 0:
+        return components
+
+    scaled = {name: int(tokens * prompt_tokens / estimated) for name, tokens in components.items()}
+    # Rounding remainder goes to the largest component, so the parts add up to the total
+    largest = max(scaled, key=scaled.get)
+    scaled[largest] += prompt_tokens - sum(scaled.values())
+    return scaled
+
+
+class Usage:
+    """Token counts and cost accumulated over provider calls (one turn, or one session)"""
+
+    def __init__(self, keep_calls: bool = False):
+        """
+        Args:
+            keep_calls: Also keep each call's own record (per turn; not per session)
+        """
+        self.calls = 0
+        self.cache_hits = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.cost_usd = 0.0
+        self.cost_known = True
+        self.estimated = False
+        self.prompt_components = dict.fromkeys(COMPONENTS, 0)
+        self.call_records = [] if keep_calls else None
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add_call(self, record: Dict[str, Any]):
+        """Add one call's record (see record_call)"""
+        self.calls += 1
+        self.prompt_tokens += record["prompt_tokens"]
+        self.completion_tokens += record["completion_tokens"]
+        self.cached_tokens += record["cached_tokens"]
+        if record["cost_usd"] is None:
+            self.cost_known = False
+        else:
+            self.cost_usd += record["cost_usd"]
+        self.estimated = self.estimated or record["estimated"]
+        for component, tokens in record["prompt_components"].items():
+            self.prompt_components[component] += tokens
+        if self.call_records is not None:
+            self.call_records.append(record)
+
+    def add(self, other: "Usage"):
+        """Roll another Usage (e.g. a finished turn) into this one"""
+        self.calls += other.calls
+        self.cache_hits += other.cache_hits
+        self.prompt_tokens += other.prompt_tokens
+        self.completion_tokens += other.completion_tokens
+        self.cached_tokens += other.cached_tokens
+        self.cost_usd += other.cost_usd
+        self.cost_known = self.cost_known and other.cost_known
+        self.estimated = self.estimated or other.estimated
+        for component, tokens in other.prompt_components.items():
+            self.prompt_components[component] += tokens
+
+    def as_dict(self) -> Dict[str, Any]:
+        """JSON-ready summary (cost_usd is None when a model's price is unknown)"""
+        summary = {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "total_tokens": self.total_tokens,
+            "cost_usd": round(self.cost_usd, 6) if self.cost_known else None,
+            "estimated": self.estimated,
+            "prompt_components": dict(self.prompt_components),
+        }
+        if self.call_records is not None:
+            summary["rounds"] = list(self.call_records)
+        return summary
+
+
+def _field(usage, name: str):
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        return usage.get(name)
+    return getattr(usage, name, None)
+
+
+def record_call(provider: str, model: str, phase: str, kwargs: Dict[str, Any],
+                reported=None, completion_text: str = "") -> Dict[str, Any]:
+    """
+    Build one provider call's usage record and export it to the metrics.
+
+    Args:
+        provider: Provider name (metrics label)
+        model: Model name (metrics label, pricing)
+        phase: The call's round (e.g. llm_round_1, llm_final)
+        kwargs: The chat.completions.create arguments
+        reported: The provider's usage object (None if it reported none)
+        completion_text: Reply text + tool call arguments, to estimate completion tokens without usage
+
+    Returns:
+        The call record (see Usage.add_call)
+    """
+    prompt_tokens = _field(reported, "prompt_tokens")
+    completion_tokens = _field(reported, "completion_tokens")
+    estimated = prompt_tokens is None or completion_tokens is None
+    components = prompt_components(kwargs, None if estimated else prompt_tokens)
+    if estimated:
+        prompt_tokens = sum(components.values())
+        completion_tokens = len(completion_text) // 4
+    cached_tokens = _field(_field(reported, "prompt_tokens_details"), "cached_tokens") or 0
+    cost = cost_usd(model, prompt_tokens, completion_tokens, cached_tokens)
+
+    metrics.LLM_TOKENS.inc(prompt_tokens, provider=provider, model=model, kind="prompt")
+    metrics.LLM_TOKENS.inc(completion_tokens, provider=provider, model=model, kind="completion")
+    metrics.LLM_TOKENS.inc(cached_tokens, provider=provider, model=model, kind="cached")
+    for component, tokens in components.items():
+        metrics.PROMPT_COMPONENT_TOKENS.inc(tokens, model=model, component=component)
+    if cost is not None:
+        metrics.LLM_COST_USD.inc(cost, provider=provider, model=model)
+
+    return {
+        "phase": phase,
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "cached_tokens": cached_tokens,
+        "cost_usd": round(cost, 6) if cost is not None else None,
+        "estimated": estimated,
+        "prompt_components": components,
+    }
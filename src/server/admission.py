@@ -0,0 +1,231 @@
+"""
+Admission Control for LLM-bound endpoints
+Caps the number of agent turns running at once and queues a bounded number of
+extra requests. Anything beyond that is rejected immediately (429 when the queue
+is full, 503 when a request waited too long) with a Retry-After hint, so a
+traffic spike degrades gracefully instead of rate-limiting every customer.
+"""
+
+import os
+import sys
+import math
+import time
+import asyncio
+import threading
+from collections import deque
+from contextlib import contextmanager, asynccontextmanager
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent import metrics
+
+
+DEFAULT_MAX_CONCURRENT = int(os.getenv("AGENT_MAX_CONCURRENT_TURNS", "16"))
+DEFAULT_MAX_QUEUE = int(os.getenv("AGENT_MAX_QUEUED_TURNS", "64"))
+DEFAULT_QUEUE_TIMEOUT_SECONDS = float(os.getenv("AGENT_QUEUE_TIMEOUT_SECONDS", "30"))
+
+QUEUE_WAIT_SECONDS = metrics.REGISTRY.histogram(
+    "pharmacy_admission_queue_wait_seconds",
+    "Time an admitted agent turn waited in the queue",
+)
+REJECTIONS = metrics.REGISTRY.counter(
+    "pharmacy_admission_rejections_total",
+    "Agent turns rejected by admission control",
+    ("reason",),
+)
+IN_FLIGHT = metrics.REGISTRY.gauge(
+    "pharmacy_admission_in_flight",
+    "Agent turns currently running",
+)
+QUEUED = metrics.REGISTRY.gauge(
+    "pharmacy_admission_queued",
+    "Agent turns currently waiting for a slot",
+)
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted; carries the HTTP status and Retry-After seconds"""
+
+    def __init__(self, message: str, status_code: int, retry_after: int):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """An admitted slot. release() is idempotent, so it can be tied to several cleanup paths."""
+
+    def __init__(self, release):
+        self._release = release
+        self._acquired_at = time.monotonic()
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._release(time.monotonic() - self._acquired_at)
+
+
+class _AdmissionBase:
+    """Shared configuration, Retry-After estimate and metrics"""
+
+    def __init__(
+        self,
+        max_concurrent: int = DEFAULT_MAX_CONCURRENT,
+        max_queue: int = DEFAULT_MAX_QUEUE,
+        queue_timeout: float = DEFAULT_QUEUE_TIMEOUT_SECONDS,
+    ):
+        """
+        Args:
+            max_concurrent: Agent turns allowed to run at the same time
+            max_queue: Requests allowed to wait for a slot; beyond that -> 429
+            queue_timeout: Seconds a request may wait before giving up -> 503
+        """
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.active = 0
+        # Moving average of how long a turn holds its slot, for Retry-After
+        self._avg_hold_seconds = 5.0
+
+    def _retry_after(self, waiting: int) -> int:
+        """Seconds until the queue in front of a new request has likely drained"""
+        return max(1, math.ceil(self._avg_hold_seconds * (waiting + 1) / max(1, self.max_concurrent)))
+
+    def _record_hold(self, held_seconds: float):
+        self._avg_hold_seconds = 0.9 * self._avg_hold_seconds + 0.1 * held_seconds
+
+    def _reject_full(self, waiting: int):
+        REJECTIONS.inc(reason="queue_full")
+        raise Overloaded("Server is busy, please retry shortly", 429, self._retry_after(waiting))
+
+    def _reject_timeout(self, waiting: int):
+        REJECTIONS.inc(reason="queue_timeout")
+        raise Overloaded("Timed out waiting for capacity, please retry", 503, self._retry_after(waiting))
+
+    def _publish(self, waiting: int):
+        IN_FLIGHT.set(self.active)
+        QUEUED.set(waiting)
+
+
+class AdmissionController(_AdmissionBase):
+    """Admission control for the threaded (Flask/WSGI) app"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cond = threading.Condition()
+        self.waiting = 0
+
+    def acquire(self) -> Ticket:
+        """
+        Wait for a slot and return its Ticket.
+
+        Raises:
+            Overloaded: queue full (429) or queue_timeout exceeded (503)
+        """
+        start = time.monotonic()
+        with self._cond:
+            if self.active >= self.max_concurrent or self.waiting:
+                if self.waiting >= self.max_queue:
+                    self._reject_full(self.waiting)
+                self.waiting += 1
+                self._publish(self.waiting)
+                deadline = start + self.queue_timeout
+                try:
+                    while self.active >= self.max_concurrent:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._reject_timeout(self.waiting)
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.active += 1
+            self._publish(self.waiting)
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - start)
+        return Ticket(self._release)
+
+    def _release(self, held_seconds: float):
+        with self._cond:
+            self.active -= 1
+            self._record_hold(held_seconds)
+            self._publish(self.waiting)
+            self._cond.notify()
+
+    @contextmanager
+    def admit(self):
+        """Hold a slot for the duration of the block"""
+        ticket = self.acquire()
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+
+class AsyncAdmissionController(_AdmissionBase):
+    """Admission control for the ASGI app; waiters are served first come, first served"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._waiters = deque()
+
+    async def acquire(self) -> Ticket:
+        """
+        Wait for a slot and return its Ticket.
+
+        Raises:
+            Overloaded: queue full (429) or queue_timeout exceeded (503)
+        """
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            self._publish(0)
+            QUEUE_WAIT_SECONDS.observe(0.0)
+            return Ticket(self._release)
+
+        if len(self._waiters) >= self.max_queue:
+            self._reject_full(len(self._waiters))
+
+        start = time.monotonic()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._publish(len(self._waiters))
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not waiter.done():
+                self._waiters.remove(waiter)
+                waiter.cancel()
+                self._publish(len(self._waiters))
+                self._reject_timeout(len(self._waiters))
+            # The slot was handed over just as we timed out: keep it
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # We own a slot we will never use; pass it on
+                self._release(0.0)
+            elif waiter in self._waiters:
+                self._waiters.remove(waiter)
+                waiter.cancel()
+            self._publish(len(self._waiters))
+            raise
+        QUEUE_WAIT_SECONDS.observe(time.monotonic() - start)
+        return Ticket(self._release)
+
+    def _release(self, held_seconds: float):
+        self._record_hold(held_seconds)
+        # Hand the slot straight to the next waiter (active stays the same)
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._publish(len(self._waiters))
+                return
+        self.active -= 1
+        self._publish(0)
+
+    @asynccontextmanager
+    async def admit(self):
+        """Hold a slot for the duration of the block"""
+        ticket = await self.acquire()
+        try:
+            yield ticket
+        finally:
+            ticket.release()
@@ -0,0 +1,58 @@
+"""
+Client disconnect detection for the threaded (WSGI) app
+A WSGI handler is never told that its client went away, so this peeks at the
+request's socket: a readable socket with no data means the peer closed it.
+(The ASGI app doesn't need this; the server cancels the handler task instead.)
+"""
+
+import time
+import socket
+from typing import Optional
+
+
+def socket_from_environ(environ) -> Optional[socket.socket]:
+    """The client socket, as exposed by gunicorn or the werkzeug dev server"""
+    return environ.get("gunicorn.socket") or environ.get("werkzeug.socket")
+
+
+def is_disconnected(sock: Optional[socket.socket]) -> bool:
+    """Whether the peer has closed the connection (False when it can't be told)"""
+    if sock is None:
+        return False
+    try:
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except (BlockingIOError, InterruptedError):
+        # Nothing to read yet: still connected
+        return False
+    except (ValueError, AttributeError):
+        # TLS sockets and platforms without MSG_DONTWAIT can't be peeked
+        return False
+    except OSError:
+        return True
+
+
+class DisconnectWatcher:
+    """
+    cancel_check callable for PharmacyAgent: True once the client has gone away.
+    The socket is peeked at most once per interval, so it is cheap to call per
+    streamed chunk.
+    """
+
+    def __init__(self, sock: Optional[socket.socket], interval: float = 0.25):
+        self.sock = sock
+        self.interval = interval
+        self._checked_at = 0.0
+        self.disconnected = False
+
+    @classmethod
+    def from_environ(cls, environ, interval: float = 0.25) -> "DisconnectWatcher":
+        return cls(socket_from_environ(environ), interval)
+
+    def __call__(self) -> bool:
+        if self.disconnected or self.sock is None:
+            return self.disconnected
+        now = time.monotonic()
+        if now - self._checked_at >= self.interval:
+            self._checked_at = now
+            self.disconnected = is_disconnected(self.sock)
+        return self.disconnected
@@ -0,0 +1,149 @@
+"""
+Startup lifecycle for the Pharmacy AI Agent web apps
+Prewarms everything the first customer request would otherwise pay for (sqlite
+file, catalog and name index, provider SDK import and client, provider HTTP connection) and
+tracks readiness for the /readyz probe
+"""
+
+import os
+import sys
+import time
+import asyncio
+import importlib
+import threading
+from typing import Any, Callable, Dict
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent import clients, prefetch
+
+
+class Readiness:
+    """Readiness state of this process, with the result of each prewarm check"""
+
+    def __init__(self):
+        self._ready = threading.Event()
+        self._ready_pid = None
+        self._lock = threading.Lock()
+        self.started_at = time.time()
+        self.checks: Dict[str, Dict[str, Any]] = {}
+
+    @property
+    def ready(self) -> bool:
+        # A forked worker inherits its parent's state but still has to prewarm itself
+        return self._ready.is_set() and self._ready_pid == os.getpid()
+
+    def record(self, name: str, result: Dict[str, Any], seconds: float):
+        with self._lock:
+            self.checks[name] = dict(result, ms=round(seconds * 1000, 1))
+
+    def set_ready(self):
+        self._ready_pid = os.getpid()
+        self._ready.set()
+
+    def wait(self, timeout: float = None) -> bool:
+        return self._ready.wait(timeout)
+
+    def status(self) -> Dict[str, Any]:
+        """Body for the /readyz response"""
+        with self._lock:
+            checks = dict(self.checks)
+        return {
+            "status": "ready" if self.ready else "starting",
+            "uptime_seconds": round(time.time() - self.started_at, 1),
+            "checks": checks
+        }
+
+
+# Process-wide readiness (each worker process prewarms and becomes ready on its own)
+readiness = Readiness()
+
+
+def _timed_check(name: str, check: Callable[[], Dict[str, Any]]) -> Dict[str, Any]:
+    start = time.perf_counter()
+    try:
+        result = check()
+    except Exception as e:
+        result = {"success": False, "error": f"{type(e).__name__}: {e}"}
+    readiness.record(name, result, time.perf_counter() - start)
+    return result
+
+
+def _check_database(agent) -> Dict[str, Any]:
+    """Open the sqlite file and load the catalog (fills the OS page cache too) and the name index"""
+    result = agent.tools.get_all_medications_list()
+    if not result.get("success"):
+        return {"success": False, "error": result.get("error", "catalog unavailable")}
+    # Customer and medication names that messages are matched against (see prefetch.py)
+    index = prefetch.get_index(agent.tools)
+    return {"success": True, "medications": result["count"], "name_index": index is not None}
+
+
+def prewarm(agent_factory: Callable[[], Any]) -> bool:
+    """
+    Prewarm this process for the threaded (Flask) app, then mark it ready.
+
+    The database must be usable for the process to become ready; a failed provider
+    warm-up is recorded but does not block readiness (the provider may come back,
+    restarting this process would not help).
+
+    Args:
+        agent_factory: Builds an agent (so the exact production provider config is used)
+
+    Returns:
+        Whether the process is ready
+    """
+    try:
+        agent = agent_factory()
+    except Exception as e:
+        readiness.record("agent", {"success": False, "error": f"{type(e).__name__}: {e}"}, 0.0)
+        return False
+    database = _timed_check("database", lambda: _check_database(agent))
+    _timed_check("provider_client", lambda: {"success": agent.client is not None})
+    _timed_check("provider_connection", lambda: clients.warm_up(agent.client))
+    if database.get("success"):
+        readiness.set_ready()
+    return readiness.ready
+
+
+_prewarm_lock = threading.Lock()
+_prewarm_pid = None
+
+
+def start_prewarm(agent_factory: Callable[[], Any]) -> bool:
+    """
+    Run prewarm() in a background thread so the server can already answer /healthz.
+    Idempotent per process: safe to call on every request and again after a fork.
+
+    Returns:
+        True if this call started the prewarm
+    """
+    global _prewarm_pid
+    if _prewarm_pid == os.getpid():
+        return False
+    with _prewarm_lock:
+        if _prewarm_pid == os.getpid():
+            return False
+        _prewarm_pid = os.getpid()
+    thread = threading.Thread(target=prewarm, args=(agent_factory,), name="prewarm", daemon=True)
+    thread.start()
+    return True
+
+
+async def aprewarm(agent_factory: Callable[[], Any]) -> bool:
+    """Async version of prewarm() for the ASGI app (warms the AsyncOpenAI client's pool)"""
+    try:
+        agent = await asyncio.to_thread(agent_factory)
+    except Exception as e:
+        readiness.record("agent", {"success": False, "error": f"{type(e).__name__}: {e}"}, 0.0)
+        return False
+    database = await asyncio.to_thread(_timed_check, "database", lambda: _check_database(agent))
+    # Import the SDK off the event loop; the client itself must be built on the loop
+    await asyncio.to_thread(importlib.import_module, "openai")
+    _timed_check("provider_client", lambda: {"success": agent.async_client is not None})
+    start = time.perf_counter()
+    connection = await clients.awarm_up(agent.async_client)
+    readiness.record("provider_connection", connection, time.perf_counter() - start)
+    if database.get("success"):
+        readiness.set_ready()
+    return readiness.ready
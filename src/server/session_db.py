@@ -0,0 +1,255 @@
+"""
+SQLite-backed session persistence for the Pharmacy AI Agent web app
+Lets several worker processes share conversations (any worker can continue any
+session) and lets sessions survive restarts. The database runs in WAL mode so
+readers never block the writer. After a turn, only the newly appended messages
+are queued, and a background thread commits the queue in batched transactions
+(turns finishing together share one commit). The request waits for its commit
+(see flush), so the customer's next message finds the turn on any worker.
+"""
+
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import sqlite3
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent import metrics
+
+
+DEFAULT_FLUSH_INTERVAL_SECONDS = float(os.getenv("SESSION_DB_FLUSH_INTERVAL_SECONDS", "0.05"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    first_seq INTEGER NOT NULL DEFAULT 0,
+    revision INTEGER NOT NULL DEFAULT 0,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS session_messages (
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (session_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_last_seen ON sessions(last_seen);
+"""
+
+FLUSH_SECONDS = metrics.REGISTRY.histogram(
+    "pharmacy_session_db_flush_seconds",
+    "Time to commit one batch of queued session writes",
+)
+PENDING_WRITES = metrics.REGISTRY.gauge(
+    "pharmacy_session_db_pending_writes",
+    "Session writes queued but not yet committed",
+)
+
+
+class SqliteSessionBackend:
+    """
+    Durable store for conversation histories.
+
+    A session's history is kept as one row per message, numbered by an absolute
+    seq; first_seq marks where the history starts after old turns were trimmed.
+    revision grows with every save, so a worker can tell that another worker has
+    moved a conversation on since it last saw it.
+    """
+
+    def __init__(self, db_path: str, flush_interval: float = DEFAULT_FLUSH_INTERVAL_SECONDS,
+                 idle_ttl: float = 0.0):
+        """
+        Args:
+            db_path: SQLite file shared by all workers
+            flush_interval: Seconds the writer waits to batch queued writes
+            idle_ttl: Sessions unseen for this long are deleted by the writer (0 keeps them)
+        """
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.idle_ttl = idle_ttl
+        self._local = threading.local()
+        self._queue: "queue.Queue" = queue.Queue()
+        self._writer_pid = None
+        self._writer_lock = threading.Lock()
+        # Set when someone waits in flush(): the writer commits without batching delay
+        self._flush_requested = threading.Event()
+        self._last_cleanup = 0.0
+        PENDING_WRITES.set_function(self._queue.qsize)
+
+        directory = os.path.dirname(os.path.abspath(db_path))
+        os.makedirs(directory, exist_ok=True)
+        connection = self._connect()
+        connection.executescript(SCHEMA)
+        connection.commit()
+        atexit.register(self.close)
+
+    @classmethod
+    def from_env(cls, idle_ttl: float = 0.0) -> Optional["SqliteSessionBackend"]:
+        """The backend configured by SESSION_DB_PATH, or None to keep sessions in memory only"""
+        db_path = os.getenv("SESSION_DB_PATH")
+        if not db_path:
+            return None
+        return cls(db_path, idle_ttl=idle_ttl)
+
+    def _connect(self) -> sqlite3.Connection:
+        """This thread's connection (connections are never shared across threads or a fork)"""
+        connection = getattr(self._local, "connection", None)
+        if connection is not None and self._local.pid == os.getpid():
+            return connection
+        connection = sqlite3.connect(self.db_path, timeout=30.0)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # WAL + NORMAL: durable across process crashes, and commits don't fsync
+        connection.execute("PRAGMA synchronous=NORMAL")
+        self._local.connection = connection
+        self._local.pid = os.getpid()
+        return connection
+
+    # Reads (request path)
+
+    def revision(self, session_id: str) -> Optional[int]:
+        """Latest committed revision of a session, or None if it isn't stored"""
+        row = self._connect().execute(
+            "SELECT revision FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        return row[0] if row else None
+
+    def load(self, session_id: str) -> Optional[Tuple[List[Dict[str, Any]], int, int]]:
+        """
+        Load a stored session.
+
+        Returns:
+            (history, first_seq, revision), or None if the session isn't stored or has expired
+        """
+        connection = self._connect()
+        row = connection.execute(
+            "SELECT first_seq, revision, last_seen FROM sessions WHERE session_id = ?", (session_id,)
+        ).fetchone()
+        if row is None:
+            return None
+        first_seq, revision, last_seen = row
+        if self.idle_ttl > 0 and time.time() - last_seen > self.idle_ttl:
+            return None
+        rows = connection.execute(
+            "SELECT message FROM session_messages WHERE session_id = ? AND seq >= ? ORDER BY seq",
+            (session_id, first_seq)
+        ).fetchall()
+        return [json.loads(message) for (message,) in rows], first_seq, revision
+
+    # Writes (queued, committed by the writer thread)
+
+    def append(self, session_id: str, first_seq: int, start_seq: int,
+               messages: List[Dict[str, Any]], revision: int):
+        """Queue newly appended messages (and a trim of everything before first_seq)"""
+        rows = [(session_id, start_seq + i, json.dumps(message, ensure_ascii=False))
+                for i, message in enumerate(messages)]
+        self._submit(("append", session_id, first_seq, rows, revision, time.time()))
+
+    def replace(self, session_id: str, first_seq: int, history: List[Dict[str, Any]], revision: int):
+        """Queue a full rewrite of a session's history (after a reset or a reload)"""
+        rows = [(session_id, first_seq + i, json.dumps(message, ensure_ascii=False))
+                for i, message in enumerate(history)]
+        self._submit(("replace", session_id, first_seq, rows, revision, time.time()))
+
+    def delete(self, session_id: str):
+        """Queue removal of a session"""
+        self._submit(("delete", session_id))
+
+    def flush(self, timeout: float = 10.0) -> bool:
+        """Block until everything queued so far is committed"""
+        if self._writer_pid != os.getpid():
+            return True
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        self._flush_requested.set()
+        return done.wait(timeout)
+
+    def close(self):
+        """Commit pending writes (registered with atexit, so a restart loses nothing)"""
+        self.flush()
+
+    def _submit(self, op: tuple):
+        self._ensure_writer()
+        self._queue.put(op)
+
+    def _ensure_writer(self):
+        """Start the writer thread once per process (threads don't survive a fork)"""
+        if self._writer_pid == os.getpid():
+            return
+        with self._writer_lock:
+            if self._writer_pid == os.getpid():
+                return
+            if self._queue.qsize():
+                # Ops inherited from the parent belong to the parent
+                self._queue = queue.Queue()
+                PENDING_WRITES.set_function(self._queue.qsize)
+            self._writer_pid = os.getpid()
+            threading.Thread(target=self._write_loop, name="session-writer", daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            batch = [self._queue.get()]
+            # Let the burst that woke us up land in the same transaction, unless someone is waiting
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            while True:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._apply(batch)
+            except Exception as e:
+                print(f"⚠️  Session store write failed: {e}")
+            for op in batch:
+                if op[0] == "flush":
+                    op[1].set()
+
+    def _apply(self, batch: List[tuple]):
+        start = time.perf_counter()
+        connection = self._connect()
+        with connection:
+            for op in batch:
+                kind = op[0]
+                if kind == "flush":
+                    continue
+                session_id = op[1]
+                if kind == "delete":
+                    connection.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+                    connection.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+                    continue
+                _, _, first_seq, rows, revision, last_seen = op
+                if kind == "replace":
+                    connection.execute("DELETE FROM session_messages WHERE session_id = ?", (session_id,))
+                else:
+                    connection.execute(
+                        "DELETE FROM session_messages WHERE session_id = ? AND seq < ?", (session_id, first_seq)
+                    )
+                connection.executemany(
+                    "INSERT OR REPLACE INTO session_messages (session_id, seq, message) VALUES (?, ?, ?)", rows
+                )
+                connection.execute(
+                    "INSERT INTO sessions (session_id, first_seq, revision, last_seen) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(session_id) DO UPDATE SET first_seq = excluded.first_seq, "
+                    "revision = excluded.revision, last_seen = excluded.last_seen",
+                    (session_id, first_seq, revision, last_seen)
+                )
+            self._cleanup(connection)
+        FLUSH_SECONDS.observe(time.perf_counter() - start)
+
+    def _cleanup(self, connection: sqlite3.Connection):
+        """Delete sessions idle for longer than idle_ttl (at most once a minute)"""
+        now = time.time()
+        if self.idle_ttl <= 0 or now - self._last_cleanup < 60.0:
+            return
+        self._last_cleanup = now
+        cutoff = now - self.idle_ttl
+        connection.execute(
+            "DELETE FROM session_messages WHERE session_id IN "
+            "(SELECT session_id FROM sessions WHERE last_seen < ?)", (cutoff,)
+        )
+        connection.execute("DELETE FROM sessions WHERE last_seen < ?", (cutoff,))
@@ -0,0 +1,324 @@
+"""
+Session Store for the Pharmacy AI Agent web app
+Keeps one conversation (and one agent) per customer session, with bounded memory:
+a cap on the number of sessions, idle expiry, LRU eviction and a per-session
+history size ceiling. With a persistence backend (see session_db.py) the
+in-memory sessions act as a cache in front of a store shared by all workers.
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+
+# Defaults can be tuned per deployment through environment variables
+DEFAULT_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "5000"))
+DEFAULT_IDLE_TTL_SECONDS = float(os.getenv("SESSION_IDLE_TTL_SECONDS", "1800"))
+DEFAULT_MAX_HISTORY_BYTES = int(os.getenv("SESSION_MAX_HISTORY_BYTES", "65536"))
+
+# Cookie / header used by the web app to identify a session
+SESSION_COOKIE_NAME = "pharmacy_session"
+SESSION_HEADER_NAME = "X-Session-ID"
+
+# Session ids come from the client, so only accept short, boring strings
+_SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{8,64}$")
+
+
+def new_session_id() -> str:
+    """Generate a fresh random session id"""
+    return uuid.uuid4().hex
+
+
+def is_valid_session_id(session_id: Optional[str]) -> bool:
+    """Check that a client-supplied session id is well formed"""
+    return bool(session_id) and bool(_SESSION_ID_PATTERN.match(session_id))
+
+
+def history_size_bytes(history: List[Dict[str, Any]]) -> int:
+    """Approximate memory footprint of a conversation history (serialized size)"""
+    return sum(len(json.dumps(message, ensure_ascii=False)) for message in history)
+
+
+def _turn_starts(history: List[Dict[str, Any]]) -> List[int]:
+    """Indexes of the user messages that start each turn in a history"""
+    return [i for i, message in enumerate(history) if message.get("role") == "user"]
+
+
+class Session:
+    """A single customer's conversation and the agent that serves it"""
+
+    def __init__(self, session_id: str, agent):
+        self.session_id = session_id
+        self.agent = agent
+        # Serializes turns within one session (double submits, parallel tabs)
+        self.lock = threading.Lock()
+        # Same, for the ASGI app (must not block the event loop)
+        self.async_lock = asyncio.Lock()
+        self.created_at = time.monotonic()
+        self.last_access = self.created_at
+        # Persistence bookkeeping: what the backend already has of this history
+        self.revision = 0
+        self.first_seq = 0
+        self._saved_history = None
+        self._saved_len = 0
+
+    def touch(self):
+        """Mark the session as used now"""
+        self.last_access = time.monotonic()
+
+    def is_expired(self, idle_ttl: float, now: Optional[float] = None) -> bool:
+        """Whether the session has been idle for longer than idle_ttl seconds"""
+        now = time.monotonic() if now is None else now
+        return idle_ttl > 0 and now - self.last_access > idle_ttl
+
+
+class SessionStore:
+    """
+    Thread-safe, session-keyed store of PharmacyAgent instances.
+
+    - At most max_sessions live sessions; the least recently used one is evicted
+    - Sessions idle for longer than idle_ttl seconds are expired
+    - Each session's history is trimmed (oldest turns first) to max_history_bytes
+    - With a backend, sessions are saved after every turn and loaded on a miss, so
+      they outlive eviction, restarts and the worker process that created them
+    """
+
+    def __init__(
+        self,
+        agent_factory: Callable[[], Any],
+        max_sessions: int = DEFAULT_MAX_SESSIONS,
+        idle_ttl: float = DEFAULT_IDLE_TTL_SECONDS,
+        max_history_bytes: int = DEFAULT_MAX_HISTORY_BYTES,
+        backend=None,
+    ):
+        """
+        Args:
+            agent_factory: Callable returning a new agent for a new session
+            max_sessions: Maximum number of sessions kept in memory
+            idle_ttl: Seconds of inactivity after which a session expires (0 disables)
+            max_history_bytes: Per-session history ceiling in serialized bytes (0 disables)
+            backend: Optional persistence backend (e.g. SqliteSessionBackend)
+        """
+        self.agent_factory = agent_factory
+        self.max_sessions = max_sessions
+        self.idle_ttl = idle_ttl
+        self.max_history_bytes = max_history_bytes
+        self.backend = backend
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_sweep = time.monotonic()
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._sessions)
+
+    def get(self, session_id: Optional[str]) -> Optional[Session]:
+        """Return a live session by id (and mark it used), or None"""
+        if not is_valid_session_id(session_id):
+            return None
+        with self._lock:
+            self._sweep_expired()
+            session = self._sessions.get(session_id)
+            if session is None:
+                return None
+            if session.is_expired(self.idle_ttl):
+                del self._sessions[session_id]
+                self.expirations += 1
+                return None
+            self._sessions.move_to_end(session_id)
+            session.touch()
+        if self.backend is not None:
+            self._refresh(session)
+        return session
+
+    def get_or_create(self, session_id: Optional[str] = None) -> Session:
+        """
+        Return the session for session_id, creating it if it doesn't exist.
+
+        Invalid or missing ids get a freshly generated id; callers should send
+        session.session_id back to the client.
+        """
+        session = self.get(session_id)
+        if session is not None:
+            return session
+
+        stored = None
+        if not is_valid_session_id(session_id):
+            session_id = new_session_id()
+        elif self.backend is not None:
+            # Not in this process's memory: another worker (or a previous run) may have it
+            stored = self.backend.load(session_id)
+
+        # Build the agent outside the store lock, it may be slow
+        agent = self.agent_factory()
+
+        with self._lock:
+            existing = self._sessions.get(session_id)
+            if existing is not None:
+                # Another request created it in the meantime
+                self._sessions.move_to_end(session_id)
+                existing.touch()
+                return existing
+            session = Session(session_id, agent)
+            if stored is not None:
+                self._restore(session, stored)
+            self._sessions[session_id] = session
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evictions += 1
+            return session
+
+    def reset(self, session_id: Optional[str]) -> bool:
+        """Clear a session's conversation. Returns False if there is no such session."""
+        session = self.get(session_id)
+        if session is None:
+            # Not cached here, but it may still be stored
+            self.discard(session_id)
+            return False
+        with session.lock:
+            session.agent.reset_conversation()
+            self.save(session)
+            self.flush()
+        return True
+
+    def discard(self, session_id: str):
+        """Drop a session entirely"""
+        with self._lock:
+            self._sessions.pop(session_id, None)
+        if self.backend is not None and is_valid_session_id(session_id):
+            self.backend.delete(session_id)
+
+    def enforce_history_limit(self, session: Session) -> int:
+        """
+        Trim the oldest whole turns from a session's history until it fits
+        max_history_bytes. The most recent turn is always kept. Call with
+        session.lock held (i.e. right after a turn).
+
+        Returns:
+            Number of messages dropped
+        """
+        if self.max_history_bytes <= 0:
+            return 0
+
+        history = session.agent.conversation_history
+        size = history_size_bytes(history)
+        if size <= self.max_history_bytes:
+            return 0
+
+        sizes = [len(json.dumps(message, ensure_ascii=False)) for message in history]
+        starts = _turn_starts(history)
+        cut = 0
+        # Drop turns from the front, never cutting inside a turn (that would
+        # orphan tool results from their assistant tool_calls)
+        for start in starts[1:]:
+            size -= sum(sizes[cut:start])
+            cut = start
+            if size <= self.max_history_bytes:
+                break
+
+        if cut:
+            del history[:cut]
+            session.first_seq += cut
+            session._saved_len = max(0, session._saved_len - cut)
+        return cut
+
+    def save(self, session: Session):
+        """
+        Persist a session's history. Only messages appended since the last save are
+        written (plus the trim point); a history that was replaced, e.g. by a reset,
+        is rewritten. Writes are queued, not waited for (see flush). Call with
+        session.lock held.
+        """
+        if self.backend is None:
+            return
+        history = session.agent.conversation_history
+        session.revision += 1
+        if history is session._saved_history and len(history) >= session._saved_len:
+            self.backend.append(
+                session.session_id, session.first_seq, session.first_seq + session._saved_len,
+                history[session._saved_len:], session.revision
+            )
+        else:
+            session.first_seq = 0
+            self.backend.replace(session.session_id, 0, history, session.revision)
+        session._saved_history = history
+        session._saved_len = len(history)
+
+    def end_turn(self, session: Session):
+        """
+        Bookkeeping after every turn: enforce the history limit, save, and wait for
+        the save to be committed. Call before the reply is complete: a follow-up
+        that lands on another worker must not load the history without this turn
+        (and then overwrite it).
+        """
+        self.enforce_history_limit(session)
+        self.save(session)
+        self.flush()
+
+    async def aend_turn(self, session: Session):
+        """end_turn() for the ASGI app (waits for the commit off the event loop)"""
+        self.enforce_history_limit(session)
+        self.save(session)
+        await self.aflush()
+
+    def flush(self):
+        """Wait until all queued session writes are committed (no-op without a backend)"""
+        if self.backend is not None:
+            self.backend.flush()
+
+    async def aflush(self):
+        """Async version of flush()"""
+        if self.backend is not None:
+            await asyncio.to_thread(self.backend.flush)
+
+    def _refresh(self, session: Session):
+        """Reload a cached session if another worker has moved the conversation on"""
+        revision = self.backend.revision(session.session_id)
+        if revision is None or revision <= session.revision:
+            return
+        stored = self.backend.load(session.session_id)
+        if stored is not None:
+            self._restore(session, stored)
+
+    @staticmethod
+    def _restore(session: Session, stored):
+        history, first_seq, revision = stored
+        session.agent.restore_history(history)
+        session.first_seq = first_seq
+        session.revision = revision
+        session._saved_history = history
+        session._saved_len = len(history)
+
+    def stats(self) -> Dict[str, Any]:
+        """Counters describing the store, for monitoring"""
+        with self._lock:
+            return {
+                "active_sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _sweep_expired(self):
+        """Expire idle sessions. Called with self._lock held; runs at most every few seconds."""
+        if self.idle_ttl <= 0:
+            return
+        now = time.monotonic()
+        if now - self._last_sweep < min(self.idle_ttl, 30.0):
+            return
+        self._last_sweep = now
+        # OrderedDict is in LRU order, so expired sessions are all at the front
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if not session.is_expired(self.idle_ttl, now):
+                break
+            del self._sessions[session_id]
+            self.expirations += 1
@@ -0,0 +1,208 @@
+"""
+Single-flight coalescing of duplicate chat submissions
+A double-click or a client retry sends the same message twice. Instead of running
+a second agent turn (and appending the exchange to the history twice), the
+duplicate attaches to the turn already in flight and gets the same result.
+Finished results are remembered for a short window, so a retry that arrives
+just after the reply was sent is answered from memory too.
+
+Requests are matched by session plus either the client's Idempotency-Key header
+or, without one, a hash of the message text.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import threading
+from typing import Any, Callable, Dict, Optional
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent import metrics
+
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+# How long a finished result answers duplicates: short for content matches (the
+# customer may really send "yes" twice), longer for explicit idempotency keys
+DEFAULT_CONTENT_WINDOW_SECONDS = float(os.getenv("CHAT_DEDUPE_WINDOW_SECONDS", "5"))
+DEFAULT_KEY_WINDOW_SECONDS = float(os.getenv("CHAT_IDEMPOTENCY_KEY_TTL_SECONDS", "300"))
+MAX_IDEMPOTENCY_KEY_LENGTH = 255
+
+COALESCED = metrics.REGISTRY.counter(
+    "pharmacy_chat_coalesced_total",
+    "Duplicate chat submissions answered without running another turn",
+    ("match", "state"),
+)
+
+
+def request_key(session_id: str, message: str, idempotency_key: Optional[str] = None):
+    """
+    Dedupe key for a chat submission.
+
+    Returns:
+        (key, match) where match is "idempotency_key" or "content"
+    """
+    if idempotency_key:
+        return f"{session_id}:key:{idempotency_key[:MAX_IDEMPOTENCY_KEY_LENGTH]}", "idempotency_key"
+    digest = hashlib.sha256(message.strip().encode("utf-8")).hexdigest()
+    return f"{session_id}:msg:{digest}", "content"
+
+
+def window_for(match: str) -> float:
+    """How long a finished result is remembered for this kind of match"""
+    return DEFAULT_KEY_WINDOW_SECONDS if match == "idempotency_key" else DEFAULT_CONTENT_WINDOW_SECONDS
+
+
+class _Call:
+    """One computation and everyone waiting for it"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.expires_at = None
+        self.cancel_checks = []
+
+    def all_cancelled(self) -> bool:
+        """cancel_check for the computation: stop only once every waiter has gone away"""
+        checks = list(self.cancel_checks)
+        return bool(checks) and all(check() for check in checks)
+
+
+class SingleFlight:
+    """Single-flight for the threaded (Flask/WSGI) app"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls: Dict[str, _Call] = {}
+
+    def _prune(self, now: float):
+        expired = [key for key, call in self._calls.items()
+                   if call.expires_at is not None and call.expires_at <= now]
+        for key in expired:
+            del self._calls[key]
+
+    def do(self, key: str, fn: Callable[[Callable[[], bool]], Any], window: float = 0.0,
+           cancel_check: Optional[Callable[[], bool]] = None, match: str = "content"):
+        """
+        Run fn once per key; concurrent callers with the same key share its result.
+
+        Args:
+            key: Dedupe key (see request_key)
+            fn: Computation; called with a cancel_check that fires once all waiters are gone
+            window: Seconds a successful result keeps answering the same key
+            cancel_check: This caller's own disconnect check (optional)
+            match: Label for the coalesced metric
+
+        Returns:
+            (result, shared) - shared is True when another caller's computation was reused
+
+        Raises:
+            Whatever fn raised (failures are shared with waiters but never remembered)
+        """
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            if cancel_check is not None:
+                call.cancel_checks.append(cancel_check)
+
+        if not leader:
+            COALESCED.inc(match=match, state="finished" if call.done.is_set() else "in_flight")
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn(call.all_cancelled)
+        except BaseException as e:
+            call.error = e
+            with self._lock:
+                self._calls.pop(key, None)
+            raise
+        finally:
+            call.done.set()
+
+        with self._lock:
+            if window > 0:
+                call.expires_at = time.monotonic() + window
+            else:
+                self._calls.pop(key, None)
+        return call.result, False
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class AsyncSingleFlight:
+    """
+    Single-flight for the ASGI app.
+    The computation runs in its own task, so a caller that disconnects (and gets
+    cancelled) doesn't take the duplicates down with it; the task is only
+    cancelled once nobody is waiting for it any more.
+    """
+
+    def __init__(self):
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._waiters: Dict[str, int] = {}
+        self._expires_at: Dict[str, float] = {}
+
+    def _prune(self, now: float):
+        expired = [key for key, expires_at in self._expires_at.items() if expires_at <= now]
+        for key in expired:
+            del self._expires_at[key]
+            self._tasks.pop(key, None)
+
+    async def do(self, key: str, fn: Callable[[], Any], window: float = 0.0, match: str = "content"):
+        """
+        Await fn() once per key; concurrent callers with the same key share its result.
+
+        Args:
+            key: Dedupe key (see request_key)
+            fn: Coroutine function computing the result
+            window: Seconds a successful result keeps answering the same key
+            match: Label for the coalesced metric
+
+        Returns:
+            (result, shared) - shared is True when another caller's computation was reused
+        """
+        self._prune(time.monotonic())
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            COALESCED.inc(match=match, state="finished" if task.done() else "in_flight")
+        else:
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._finished(key, done, window))
+
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task), shared
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters.get(key, 0) <= 1:
+                # Last one waiting: nobody wants the result any more
+                task.cancel()
+            raise
+        finally:
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+
+    def _finished(self, key: str, task: asyncio.Task, window: float):
+        if self._tasks.get(key) is not task:
+            return
+        if task.cancelled() or task.exception() is not None or window <= 0:
+            del self._tasks[key]
+        else:
+            self._expires_at[key] = time.monotonic() + window
+
+    def __len__(self):
+        return len(self._tasks)
@@ -5,7 +5,45 @@ These are the functions (tools) that the AI agent can call to interact with the
 
 import sqlite3
 import json
-from typing import Dict, List, Optional, Any
+import time
+from typing import Callable, Dict, List, Optional, Any
+
+
+class _ObservedCursor(sqlite3.Cursor):
+    """Cursor that reports how long each execute/fetch took to the connection's observer"""
+    
+    def _observe(self, sql, start):
+        self.connection.observer(sql, time.perf_counter() - start)
+    
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self._observe(sql, start)
+    
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._observe(None, start)
+    
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._observe(None, start)
+
+
+class _ObservedConnection(sqlite3.Connection):
+    """Connection whose cursors are _ObservedCursors"""
+    
+    observer = None
+    
+    def cursor(self, factory=_ObservedCursor):
+        return super().cursor(factory)
 
 
 class MedicationTools:
@@ -14,10 +52,17 @@ class MedicationTools:
     def __init__(self, db_path: str = "pharmacy.db"):
         """Initialize with database path"""
         self.db_path = db_path
+        # Optional callback(sql, seconds) for query timing; sql is None for the
+        # fetch that completes the previous query
+        self.on_query: Optional[Callable[[Optional[str], float], None]] = None
     
     def _get_connection(self):
         """Create a database connection"""
-        return sqlite3.connect(self.db_path)
+        if self.on_query is None:
+            return sqlite3.connect(self.db_path)
+        conn = sqlite3.connect(self.db_path, factory=_ObservedConnection)
+        conn.observer = self.on_query
+        return conn
     
     def get_medication_info(self, medication_name: str) -> Dict[str, Any]:
         """
@@ -395,6 +440,63 @@ class MedicationTools:
                 "error": f"Database error: {str(e)}"
             }
     
+    def get_inventory_version(self) -> Optional[str]:
+        """
+        Fingerprint of the current stock levels; it changes whenever any
+        medication's stock_quantity changes. Used to invalidate cached answers
+        that were based on inventory data.
+        
+        Returns:
+            Fingerprint string, or None if the database can't be read
+        """
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT group_concat(medication_id || ':' || stock_quantity, ',')
+                FROM (SELECT medication_id, stock_quantity FROM medications ORDER BY medication_id)
+            ''')
+            result = cursor.fetchone()
+            conn.close()
+            return result[0] or ""
+        except Exception:
+            return None
+    
+    def get_known_names(self) -> Dict[str, Any]:
+        """
+        Get the names the agent can recognize in a customer's message:
+        every customer on file and every medication (brand and generic name,
+        and whether it requires a prescription).
+        
+        Returns:
+            Dictionary with lists of customer names and medication records
+        """
+        try:
+            conn = self._get_connection()
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT name FROM users')
+            customers = [row[0] for row in cursor.fetchall()]
+            
+            cursor.execute('SELECT name, generic_name, requires_prescription FROM medications')
+            medications = [
+                {"name": row[0], "generic_name": row[1], "requires_prescription": bool(row[2])}
+                for row in cursor.fetchall()
+            ]
+            conn.close()
+            
+            return {
+                "success": True,
+                "customers": customers,
+                "medications": medications
+            }
+            
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Database error: {str(e)}"
+            }
+    
     def check_prescription(self, user_name: str, medication_name: str) -> Dict[str, Any]:
         """
         Check if a user has a valid prescription on file for a specific medication.